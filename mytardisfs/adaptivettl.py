@@ -0,0 +1,53 @@
+# Per-listing cache times which adapt to how often listings change.
+
+# With fixed cache times, a dataset from 2011 is queried as often as one
+# which an instrument is writing to right now.  AdaptiveTtls keeps a
+# cache time for each listing (keyed like LAST_QUERY_TIME in
+# mytardisfs.py), which starts at the configured cache time (min_seconds)
+# and doubles each time a refresh finds the listing unchanged, up to
+# max_seconds.  When a refresh finds a change, it drops back to
+# min_seconds.  If the listing's latest modification time is known, the
+# cache time is also kept below age_fraction of the time since then,
+# so recently modified datasets stay fresh.
+
+import time
+import threading
+
+import metrics
+
+
+class AdaptiveTtls():
+    def __init__(self, max_seconds, age_fraction):
+        self.max_seconds = max_seconds
+        self.age_fraction = age_fraction
+        self.lock = threading.Lock()
+        self.ttls = dict()
+
+    def ttl(self, key, min_seconds):
+        with self.lock:
+            return self.ttls.get(key, min_seconds)
+
+    def record_refresh(self, key, kind, changed, min_seconds, modified=None):
+        # kind (e.g. "datafiles") names the metric the new cache time is
+        # recorded in, and modified is a timestamp, or None.
+        with self.lock:
+            ttl = self.ttls.get(key, min_seconds)
+            if changed:
+                ttl = min_seconds
+            else:
+                ttl = min(ttl * 2, self.max_seconds)
+            if modified is not None:
+                age = max(0, time.time() - modified)
+                ttl = min(ttl, max(min_seconds, age * self.age_fraction))
+            ttl = max(ttl, min_seconds)
+            self.ttls[key] = ttl
+        metrics.record_time("cache_ttl." + kind, ttl)
+        if changed:
+            metrics.increment("cache_ttl." + kind + ".changed")
+        return ttl
+
+    def reset(self, key):
+        # Goes back to the configured cache time, e.g. when a listing is
+        # known to have changed.
+        with self.lock:
+            self.ttls.pop(key, None)
@@ -0,0 +1,116 @@
+# Bounded in-memory cache of datafile content for mytardisfs.
+
+# Datafile content is cached in fixed-size blocks, so that popular
+# datafiles (e.g. a reference dataset which is downloaded repeatedly) can
+# be served from RAM instead of from the file store.  Blocks are keyed by
+# datafile ID, size and modification time (like the disk cache, so that
+# a datafile whose content is replaced isn't served from old blocks), and
+# block index.
+
+# Eviction uses a segmented LRU, which (like ARC) stops a single large
+# sequential download from flushing out blocks which have been read more
+# than once: new blocks enter a probationary segment, and are promoted to
+# a protected segment (PROTECTED_FRACTION of the byte budget) when they
+# are read again.  Blocks are evicted from the probationary segment first.
+
+import threading
+from collections import OrderedDict
+
+import metrics
+
+PROTECTED_FRACTION = 0.8
+
+
+class BlockCache():
+    def __init__(self, max_bytes, block_size):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.probationary = OrderedDict()
+        self.protected = OrderedDict()
+        self.probationary_bytes = 0
+        self.protected_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.protected:
+                data = self.protected.pop(key)
+                self.protected[key] = data
+            elif key in self.probationary:
+                data = self.probationary.pop(key)
+                self.probationary_bytes -= len(data)
+                self.protected[key] = data
+                self.protected_bytes += len(data)
+                self._demote_protected()
+            else:
+                self.misses = self.misses + 1
+                metrics.increment("block_cache.misses")
+                self._update_hit_ratio()
+                return None
+            self.hits = self.hits + 1
+            metrics.increment("block_cache.hits")
+            metrics.increment("block_cache.bytes_saved", len(data))
+            self._update_hit_ratio()
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.probationary or key in self.protected:
+                return
+            self.probationary[key] = data
+            self.probationary_bytes += len(data)
+            self._evict()
+            metrics.set_gauge("block_cache.bytes",
+                              self.probationary_bytes + self.protected_bytes)
+
+    def read(self, cache_key, datafile_size, offset, length, read_block):
+        # Returns length bytes starting at offset, using read_block(offset,
+        # length) to read any blocks which aren't already in the cache.
+        # cache_key is (datafile_id, datafile_size, modified).
+        end = min(offset + length, datafile_size)
+        chunks = []
+        block_index = offset // self.block_size
+        while block_index * self.block_size < end:
+            block_offset = block_index * self.block_size
+            key = cache_key + (block_index,)
+            data = self.get(key)
+            if data is None:
+                data = read_block(block_offset, self.block_size)
+                if data is None:
+                    return None
+                self.put(key, data)
+            start_in_block = max(offset - block_offset, 0)
+            chunks.append(data[start_in_block:end - block_offset])
+            if len(data) < self.block_size:
+                break
+            block_index = block_index + 1
+        return "".join(chunks)
+
+    def _demote_protected(self):
+        # Move least recently used protected blocks back to probation.
+        max_protected_bytes = int(self.max_bytes * PROTECTED_FRACTION)
+        while self.protected_bytes > max_protected_bytes and self.protected:
+            key, data = self.protected.popitem(last=False)
+            self.protected_bytes -= len(data)
+            self.probationary[key] = data
+            self.probationary_bytes += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self.probationary_bytes + self.protected_bytes > \
+                self.max_bytes:
+            if self.probationary:
+                key, data = self.probationary.popitem(last=False)
+                self.probationary_bytes -= len(data)
+            else:
+                key, data = self.protected.popitem(last=False)
+                self.protected_bytes -= len(data)
+            metrics.increment("block_cache.evictions")
+
+    def _update_hit_ratio(self):
+        metrics.set_gauge("block_cache.hit_ratio",
+                          float(self.hits) / (self.hits + self.misses))
@@ -0,0 +1,114 @@
+# Shared start-up for the sudo helper scripts (_datasetdatafiles,
+# _datafiledescriptord etc.), which run as the mytardis user and need
+# MyTardis's Django settings before they can query anything.
+
+# These helpers are started for every listing and every open, so their
+# start-up time matters.  setup_django adds MyTardis and its eggs to
+# sys.path, using a list of the eggs cached in ~mytardis/.mytardisfs/
+# (until the eggs directory changes), rather than listing the eggs
+# directory every time, and then imports Django and the tardis settings.
+# Each step is timed with the helper's PhaseTimer, so mytardisfs's
+# metrics and traces show where a helper's start-up time goes.
+
+# Before any of that, setup_django takes one of the host-wide helper
+# slots (host_max_concurrent_helpers, in /etc/mytardisfs.cnf, as users'
+# own config files aren't read here), which is held until the helper
+# exits.  The slot files are in ~mytardis/.mytardisfs/slots/, which only
+# the mytardis user can access, so users can't hold slots themselves.
+# Helpers wait until a slot is free, in priority order (see scheduler.py),
+# and the wait is reported as their host_slot phase.  Helpers check their
+# arguments before calling setup_django, and import models and anything
+# else they need from Django afterwards, only where they need them.
+
+import os
+import pwd
+import sys
+import hashlib
+import ConfigParser
+
+from scheduler import PRIORITY_INTERACTIVE
+from scheduler import PRIORITY_VARIABLE
+from scheduler import wait_for_host_slot
+
+# System-wide config files, which only the administrator can change:
+SYSTEM_CNF_FILES = ['/etc/mytardisfs.cnf', '/usr/local/etc/mytardisfs.cnf']
+
+# The helper's host-wide slot, held until it exits:
+HOST_SLOT = None
+
+
+def egg_paths(mytardis_install_dir):
+    # Returns the paths of the eggs in [mytardis_install_dir]/eggs, in
+    # the order os.listdir gives them.
+    eggs_dir = os.path.join(mytardis_install_dir, "eggs")
+    eggs_dir_mtime = repr(os.stat(eggs_dir).st_mtime)
+    cache_path = os.path.join(mytardisfs_dir(),
+                              "eggs-" + hashlib.sha1(eggs_dir).hexdigest())
+    try:
+        with open(cache_path, 'r') as cache_file:
+            lines = cache_file.read().splitlines()
+        if len(lines) > 0 and lines[0] == eggs_dir_mtime:
+            return lines[1:]
+    except (IOError, OSError):
+        pass
+
+    paths = [os.path.join(eggs_dir, egg) for egg in os.listdir(eggs_dir)]
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            cache_file.write("\n".join([eggs_dir_mtime] + paths) + "\n")
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # The cache is only an optimization.
+        pass
+    return paths
+
+
+def mytardisfs_dir():
+    return os.path.join(pwd.getpwuid(os.getuid()).pw_dir, ".mytardisfs")
+
+
+def system_config_int(key, default):
+    # Returns an integer setting from the system config files.
+    config = ConfigParser.SafeConfigParser(allow_no_value=True)
+    config.read(SYSTEM_CNF_FILES)
+    if config.has_option("mytardisfs", key):
+        return config.getint("mytardisfs", key)
+    return default
+
+
+def take_host_slot():
+    global HOST_SLOT
+    host_max_concurrent_helpers = \
+        system_config_int("host_max_concurrent_helpers", 0)
+    if host_max_concurrent_helpers <= 0:
+        return
+    lock_dir = os.path.join(mytardisfs_dir(), "slots")
+    try:
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir, 0700)
+    except OSError:
+        pass
+    try:
+        priority = int(os.environ.get(PRIORITY_VARIABLE,
+                                      PRIORITY_INTERACTIVE))
+    except ValueError:
+        priority = PRIORITY_INTERACTIVE
+    HOST_SLOT = wait_for_host_slot(lock_dir, "helpers",
+                                   host_max_concurrent_helpers, priority)
+
+
+def setup_django(mytardis_install_dir, timer):
+    take_host_slot()
+    timer.mark("host_slot")
+    sys.path.append(mytardis_install_dir)
+    sys.path.extend(egg_paths(mytardis_install_dir))
+    timer.mark("sys_path")
+    from django.core.management import setup_environ
+    timer.mark("import_django")
+    from tardis import settings
+    timer.mark("import_settings")
+    setup_environ(settings)
+    timer.mark("setup_environ")
@@ -19,8 +19,13 @@ import sys
 import getpass
 import traceback
 
+import bootstrap
+from phases import PhaseTimer
+
 
 def run():
+    timer = PhaseTimer()
+
     if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
         print "Usage: sudo -u mytardis _countexpdatasets" + \
             "mytardis_install_dir auth_provider"
@@ -34,12 +39,7 @@ def run():
     _mytardis_install_dir = sys.argv[1].strip('"')
     _auth_provider = sys.argv[2]
 
-    sys.path.append(_mytardis_install_dir)
-    for egg in os.listdir(os.path.join(_mytardis_install_dir, "eggs")):
-        sys.path.append(os.path.join(_mytardis_install_dir, "eggs", egg))
-    from django.core.management import setup_environ
-    from tardis import settings
-    setup_environ(settings)
+    bootstrap.setup_django(_mytardis_install_dir, timer)
 
     from tardis.tardis_portal.models import Experiment
     from tardis.tardis_portal.models import UserAuthentication
@@ -77,3 +77,6 @@ def run():
         #    was not found in MyTardis."
     except:
         print traceback.format_exc()
+
+    timer.mark("query")
+    timer.report()
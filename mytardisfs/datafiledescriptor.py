@@ -2,10 +2,46 @@
 import socket
 import fdsend
 import os
+import stat
+import errno
+import ctypes
+import ctypes.util
 import subprocess
 import time
 import tempfile
 
+from phases import CORRELATION_ID_VARIABLE
+from phases import parse_fields
+from scheduler import PRIORITY_VARIABLE
+
+FILE_DESCRIPTOR_REQUEST = "Request file descriptor"
+DATASET_DIRECTORY_REQUEST = "Request file and dataset directory descriptors"
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def open_in_directory(directory_fd, relative_path):
+    # Opens relative_path (e.g. "subdir/file.dat") for reading, relative
+    # to a directory descriptor from _datafiledescriptord, and returns a
+    # file object.  Only the path components below the directory are
+    # looked up, so this works even where the storage location's own
+    # directory is only accessible to the mytardis user.  Paths which
+    # could lead outside the directory, symbolic links and anything
+    # other than a regular file are refused.
+    components = relative_path.split('/')
+    if relative_path.startswith('/') or \
+            [c for c in components if c in ("", ".", "..")]:
+        raise OSError(errno.EINVAL, "Invalid relative path", relative_path)
+    fd = _libc.openat(directory_fd, relative_path,
+                      os.O_RDONLY | os.O_NOFOLLOW)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), relative_path)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise OSError(errno.EINVAL, "Not a regular file", relative_path)
+    return os.fdopen(fd, 'rb')
+
 
 class MyTardisDatafileDescriptor:
 
@@ -13,9 +49,34 @@ class MyTardisDatafileDescriptor:
         self.message = message
         self.file_descriptor = file_descriptor
 
+        # The daemon reports which storage location served the file,
+        # and how long each of its phases took, e.g.
+        # "Success: location=local fallbacks=0 id=1f2e-17 accept=0.01 ..."
+        self.location = None
+        self.fallbacks = 0
+        self.phases = []
+        # A descriptor for the dataset's directory, if one was requested
+        # and the daemon could provide it:
+        self.dataset_dir_descriptor = None
+        if message is not None and message.startswith("Success: "):
+            fields = []
+            for field in message[len("Success: "):].split(' '):
+                if field.startswith("location="):
+                    self.location = field[len("location="):]
+                elif field.startswith("fallbacks="):
+                    self.fallbacks = int(field[len("fallbacks="):])
+                elif field.startswith("dataset_dir="):
+                    pass
+                else:
+                    fields.append(field)
+            self.phases = parse_fields(" ".join(fields))[1]
+
     @staticmethod
     def get_file_descriptor(mytardis_install_dir, auth_provider,
-                            experiment_id, datafile_id):
+                            experiment_id, datafile_id,
+                            replica_location_priority="",
+                            correlation_id=None, dataset_directory=False,
+                            priority=None):
 
         # Determine the absolute path of the socket
         # for interprocess communication:
@@ -23,27 +84,50 @@ class MyTardisDatafileDescriptor:
         socket_path = f.name
         f.close()
 
+        env = dict(os.environ)
+        if correlation_id is not None:
+            env[CORRELATION_ID_VARIABLE] = correlation_id
+        if priority is not None:
+            env[PRIORITY_VARIABLE] = str(priority)
+
+        start_time = time.time()
         proc = subprocess.Popen(["sudo", "-n", "-u", "mytardis",
                                  "_datafiledescriptord",
                                  mytardis_install_dir, auth_provider,
                                  socket_path, str(experiment_id),
-                                 str(datafile_id)],
-                                stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+                                 str(datafile_id),
+                                 replica_location_priority],
+                                stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                                env=env)
 
         while not os.path.exists(socket_path):
             time.sleep(0.01)
+        # Starting sudo and the daemon, until it is listening:
+        socket_wait_seconds = time.time() - start_time
 
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.connect(socket_path)
-        sock.send("Request file descriptor")
-        (message, file_descriptors) = fdsend.recvfds(sock, 128, numfds=1)
+        if dataset_directory:
+            sock.send(DATASET_DIRECTORY_REQUEST)
+        else:
+            sock.send(FILE_DESCRIPTOR_REQUEST)
+        # (The message includes the daemon's phase timings, so it can be
+        # longer than a line.)
+        (message, file_descriptors) = fdsend.recvfds(sock, 4096, numfds=2)
         sock.close()
 
         file_descriptor = None
         if len(file_descriptors) > 0:
             file_descriptor = file_descriptors[0]
 
-        return MyTardisDatafileDescriptor(message, file_descriptor)
+        mytardis_datafile_descriptor = \
+            MyTardisDatafileDescriptor(message, file_descriptor)
+        if len(file_descriptors) > 1:
+            mytardis_datafile_descriptor.dataset_dir_descriptor = \
+                file_descriptors[1]
+        mytardis_datafile_descriptor.phases.insert(0, ("socket_wait",
+                                                       socket_wait_seconds))
+        return mytardis_datafile_descriptor
 
 if __name__ == "__main__":
     experiment_id = "73"
@@ -13,6 +13,21 @@
 # "cvl_ldap" authentication scheme in our MyTardis deployment
 # (defined in /opt/mytardis/current/tardis/settings.py)
 
+# If a comma-separated list of MyTardis storage location names is given
+# as the optional last argument (replica_location_priority), replicas
+# are tried in that order (fastest storage first), falling back to the
+# next replica if one can't be opened.  Replicas in locations which are
+# not listed are tried afterwards, starting with MyTardis's preferred
+# replica.  The location which served the file is reported back to the
+# client in the message sent with the file descriptor.
+
+# If the client's request is DATASET_DIRECTORY_REQUEST, and the dataset
+# has a directory of its own in the storage location which served the
+# file (i.e. no other dataset's replicas are stored under it), a
+# descriptor for that directory is sent as well, so that the client can
+# open the dataset's other datafiles relative to it, without asking this
+# server again (see open_in_directory in datafiledescriptor.py).
+
 import os
 import socket
 import fdsend
@@ -20,18 +35,60 @@ import sys
 import getpass
 import traceback
 
+import bootstrap
+from phases import PhaseTimer
+
+DATASET_DIRECTORY_REQUEST = "Request file and dataset directory descriptors"
+
+
+def rank_replicas(df, location_priority):
+    preferred_replica = df.get_preferred_replica()
+
+    def rank(replica):
+        location_name = replica.location.name
+        if location_name in location_priority:
+            return (0, location_priority.index(location_name),
+                    not replica.verified)
+        return (1, replica != preferred_replica, not replica.verified)
+
+    return sorted(df.replica_set.all(), key=rank)
+
+
+def open_dataset_directory(df, replica, replica_model):
+    # Returns a descriptor for the directory holding df's dataset in
+    # replica's storage location, or None if the dataset doesn't have a
+    # directory of its own there.
+    relative_path = df.filename
+    if df.directory is not None and df.directory.strip('/') != "":
+        relative_path = df.directory.strip('/') + '/' + df.filename
+    absolute_path = replica.get_absolute_filepath()
+    if not absolute_path.endswith('/' + relative_path) or \
+            not replica.url.endswith('/' + relative_path):
+        return None
+    url_prefix = replica.url[:-len(relative_path)]
+    if url_prefix.strip('/') == "":
+        return None
+    if replica_model.objects \
+            .filter(location=replica.location, url__startswith=url_prefix) \
+            .exclude(datafile__dataset=df.dataset).exists():
+        return None
+    return os.open(absolute_path[:-len(relative_path)],
+                   os.O_RDONLY | os.O_DIRECTORY)
+
 
 def run():
+    timer = PhaseTimer()
+
     if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
         print "Usage: sudo -u mytardis _datafiledescriptord " + \
             "mytardis_install_dir auth_provider " + \
-            "socket_path exp_id datafile_id"
+            "socket_path exp_id datafile_id [replica_location_priority]"
         sys.exit(1)
 
     if len(sys.argv) < 6:
         print "Usage: sudo -u mytardis _datafiledescriptord " + \
             "mytardis_install_dir auth_provider " + \
-            "socket_path exp_id datafile_id"
+            "socket_path exp_id datafile_id [replica_location_priority]"
         sys.exit(1)
 
     _mytardis_install_dir = sys.argv[1].strip('"')
@@ -39,6 +96,11 @@ def run():
     _socket_path = sys.argv[3]
     _experiment_id = int(sys.argv[4])
     _datafile_id = int(sys.argv[5])
+    _replica_location_priority = []
+    if len(sys.argv) > 6:
+        _replica_location_priority = \
+            [location_name.strip() for location_name in sys.argv[6].split(',')
+             if location_name.strip() != ""]
 
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
@@ -49,16 +111,12 @@ def run():
     os.chmod(_socket_path, 0666)
     sock.listen(1)
     conn, addr = sock.accept()
+    timer.mark("accept")
 
-    sys.path.append(_mytardis_install_dir)
-    for egg in os.listdir(os.path.join(_mytardis_install_dir, "eggs")):
-        sys.path.append(os.path.join(_mytardis_install_dir, "eggs", egg))
-    from django.core.management import setup_environ
+    bootstrap.setup_django(_mytardis_install_dir, timer)
     from django.core.exceptions import ObjectDoesNotExist
-    from tardis import settings
-    setup_environ(settings)
 
-    from tardis.tardis_portal.models import Dataset_File, Experiment
+    from tardis.tardis_portal.models import Dataset_File, Experiment, Replica
     from tardis.tardis_portal.models import UserAuthentication
 
     found_user = False
@@ -89,16 +147,41 @@ def run():
                     found_datafile_in_experiment = True
                     break
         df = Dataset_File.objects.get(id=_datafile_id)
-        r = df.get_preferred_replica()
-        filepath = r.get_absolute_filepath()
+        replicas = rank_replicas(df, _replica_location_priority)
+        timer.mark("permissions")
 
         # The following line blocks, waiting for client to start up
         # and send its request:
         file_descriptor_request = conn.recv(1024)
+        timer.mark("request")
         if staff_or_superuser or (found_datafile_in_experiment and
                                   (exp_public or exp_owned_or_shared)):
-            fds = [file(filepath, 'rb')]
-            message = "Success"
+            fds = []
+            fallbacks = 0
+            for replica in replicas:
+                try:
+                    fds = [file(replica.get_absolute_filepath(), 'rb')]
+                    break
+                except (IOError, OSError):
+                    fallbacks = fallbacks + 1
+            if len(fds) > 0:
+                timer.mark("open")
+                dataset_dir_field = ""
+                if file_descriptor_request == DATASET_DIRECTORY_REQUEST:
+                    try:
+                        dataset_dir_fd = \
+                            open_dataset_directory(df, replica, Replica)
+                    except (IOError, OSError):
+                        dataset_dir_fd = None
+                    if dataset_dir_fd is not None:
+                        fds.append(dataset_dir_fd)
+                        dataset_dir_field = " dataset_dir=1"
+                message = "Success: location=%s fallbacks=%d%s %s" % \
+                    (replica.location.name, fallbacks, dataset_dir_field,
+                     timer.format())
+            else:
+                message = "Unable to open any of the %d replica(s) " \
+                    "of datafile (ID %s)." % (len(replicas), str(_datafile_id))
         elif not found_datafile_in_experiment:
             fds = []
             message = "Datafile (ID %s) does not belong " + \
@@ -16,40 +16,135 @@
 # belongs to the supplied experiment ID, because they will have
 # access to that dataset no matter what.
 
+# With "stream" as the optional last argument, each datafile record is
+# printed on a line of its own, as it is read from the database, so that
+# mytardisfs can start listing a very large dataset before the query has
+# finished, without either process holding the whole list in memory.
+
+# With "level=DIRECTORY" (e.g. "level=run1/scan2", or "level=" for the
+# top level of the dataset), only the datafiles directly within that
+# directory are printed, along with one record for each of its immediate
+# subdirectories, e.g.
+#   {'subdirectory': 'run1/scan2/frames', 'modification_time': '...',
+#    'nlink': 3}
+# so that datasets which mirror deep instrument directory trees can be
+# listed one directory at a time, as they are browsed.
+
+# dataset_id can also be a comma-separated list of dataset IDs, or "all"
+# for all of the experiment's datasets, so that a whole experiment can be
+# listed with one call.  The records are then always streamed, each one
+# tagged with its 'dataset_id', and each dataset's records are followed
+# by {'dataset_id': ..., 'done': True}.
+
 import os
 import sys
 import getpass
 import traceback
 
+import bootstrap
+from phases import PhaseTimer
+
+
+def directory_values(level):
+    # The ways MyTardis might record level in Dataset_File.directory.
+    if level == "":
+        return ["", "/"]
+    return [level, "/" + level, level + "/", "/" + level + "/"]
+
+
+def level_records(dfs, level):
+    # Returns a record for each immediate subdirectory of level, with
+    # the latest modification time of the datafiles below it, and its
+    # nlink (2 + its own number of subdirectories).
+    from django.db.models import Max, Q
+    if level == "":
+        below = dfs.exclude(Q(directory__isnull=True) |
+                            Q(directory__in=directory_values(level)))
+    else:
+        below = dfs.filter(Q(directory__startswith=level + "/") |
+                           Q(directory__startswith="/" + level + "/"))
+    subdirectories = dict()
+    for directory, latest in below.values_list('directory') \
+            .annotate(latest=Max('modification_time')).iterator():
+        relative_path = directory.strip('/')[len(level):].strip('/')
+        if relative_path == "":
+            continue
+        parts = relative_path.split('/')
+        subdirectory = subdirectories.setdefault(parts[0], [None, set()])
+        if subdirectory[0] is None or \
+                (latest is not None and latest > subdirectory[0]):
+            subdirectory[0] = latest
+        if len(parts) > 1:
+            subdirectory[1].add(parts[1])
+    records = []
+    for name, (latest, children) in subdirectories.iteritems():
+        if level != "":
+            name = level + "/" + name
+        records.append(dict(subdirectory=name,
+                            modification_time=str(latest),
+                            nlink=len(children) + 2))
+    return records
+
+
+def dataset_records(dataset_file_model, dataset_id, level):
+    # Yields the records to print for a dataset (or for one level of it).
+    dfs = dataset_file_model.objects.filter(dataset__id=dataset_id)
+    if level is not None:
+        for record in level_records(dfs, level):
+            yield record
+        level_dfs = dfs.filter(directory__in=directory_values(level))
+        if level == "":
+            level_dfs = level_dfs | dfs.filter(directory__isnull=True)
+        dfs = level_dfs
+    for df in dfs.iterator():
+        yield dict(id=df.id, directory=df.directory,
+                   created_time=str(df.created_time),
+                   modification_time=str(df.modification_time),
+                   filename=df.filename, size=df.size)
+
 
 def run():
+    timer = PhaseTimer()
+
     if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
         print "Usage: sudo -u mytardis _datasetdatafiles " + \
-            "mytardis_install_dir auth_provider exp_id dataset_id"
+            "mytardis_install_dir auth_provider exp_id " + \
+            "dataset_id[,dataset_id...]|all [stream] [level=DIRECTORY]"
         sys.exit(1)
 
     if len(sys.argv) < 5:
         print "Usage: sudo -u mytardis _datasetdatafiles " + \
-            "mytardis_install_dir auth_provider exp_id dataset_id"
+            "mytardis_install_dir auth_provider exp_id " + \
+            "dataset_id[,dataset_id...]|all [stream] [level=DIRECTORY]"
         sys.exit(1)
 
     _mytardis_install_dir = sys.argv[1].strip('"')
     _auth_provider = sys.argv[2]
 
-    sys.path.append(_mytardis_install_dir)
-    for egg in os.listdir(os.path.join(_mytardis_install_dir, "eggs")):
-        sys.path.append(os.path.join(_mytardis_install_dir, "eggs", egg))
-    from django.core.management import setup_environ
-    from tardis import settings
-    setup_environ(settings)
+    try:
+        _experiment_id = int(sys.argv[3])
+        _dataset_ids = None
+        if sys.argv[4] != "all":
+            _dataset_ids = [int(dataset_id) for dataset_id
+                            in sys.argv[4].split(',') if dataset_id != ""]
+    except ValueError:
+        print "Usage: sudo -u mytardis _datasetdatafiles " + \
+            "mytardis_install_dir auth_provider exp_id " + \
+            "dataset_id[,dataset_id...]|all [stream] [level=DIRECTORY]"
+        sys.exit(1)
+    _batch = sys.argv[4] == "all" or "," in sys.argv[4]
+    _stream = _batch or "stream" in sys.argv[5:]
+    _level = None
+    for arg in sys.argv[5:]:
+        if arg.startswith("level="):
+            _level = arg[len("level="):].strip('/')
+
+    bootstrap.setup_django(_mytardis_install_dir, timer)
 
     from tardis.tardis_portal.models import Dataset, Dataset_File, Experiment
     from tardis.tardis_portal.models import UserAuthentication
     from django.core.exceptions import ObjectDoesNotExist
 
-    _experiment_id = int(sys.argv[3])
-    _dataset_id = int(sys.argv[4])
-
     found_user = False
     mytardis_user = None
     exp_public = False
@@ -66,6 +161,11 @@ def run():
         found_user = True
         staff_or_superuser = mytardis_user.is_staff or \
             mytardis_user.is_superuser
+        if _dataset_ids is None:
+            _dataset_ids = list(Dataset.objects
+                                .filter(experiments__id=_experiment_id)
+                                .order_by('id')
+                                .values_list('id', flat=True))
         if not staff_or_superuser:
             exp = Experiment.objects.get(id=_experiment_id)
             exp_public = Experiment \
@@ -74,30 +174,43 @@ def run():
                 .owned_and_shared(mytardis_user)
             exp_owned_or_shared = exps_owned_and_shared \
                 .filter(id=_experiment_id).exists()
-            for dataset in exp.datasets.all():
-                if dataset.id == _dataset_id:
-                    found_dataset_in_experiment = True
-                    break
+            exp_dataset_ids = set(dataset.id
+                                  for dataset in exp.datasets.all())
+            found_dataset_in_experiment = \
+                len(_dataset_ids) > 0 and \
+                exp_dataset_ids.issuperset(_dataset_ids)
         if staff_or_superuser or (found_dataset_in_experiment and
                                   (exp_public or exp_owned_or_shared)):
-            dfs = Dataset_File.objects.filter(dataset__id=_dataset_id)
             df_list = []
-            for df in dfs:
-                df_fields = dict(id=df.id, directory=df.directory,
-                                 created_time=str(df.created_time),
-                                 modification_time=str(df.modification_time),
-                                 filename=df.filename, size=df.size)
-                df_list.append(df_fields)
-            print str(df_list)
+            for dataset_id in _dataset_ids:
+                for record in dataset_records(Dataset_File, dataset_id,
+                                              _level):
+                    if _batch:
+                        record['dataset_id'] = dataset_id
+                    if _stream:
+                        print str(record)
+                        # STDOUT is a pipe, so it would otherwise be
+                        # block-buffered, and records would arrive in bursts.
+                        sys.stdout.flush()
+                    else:
+                        df_list.append(record)
+                if _batch:
+                    print str(dict(dataset_id=dataset_id, done=True))
+                    sys.stdout.flush()
+            if not _stream:
+                print str(df_list)
         elif not found_dataset_in_experiment:
             print "Data set (ID %s) does not belong to experiment (ID %s)." % \
-                (str(_dataset_id), str(_experiment_id))
+                (sys.argv[4], str(_experiment_id))
         else:
             print "Access to data set %s denied for user %s." % \
-                (str(_dataset_id), os.environ['SUDO_USER'])
+                (sys.argv[4], os.environ['SUDO_USER'])
     except ObjectDoesNotExist:
         print traceback.format_exc()
         # print "User " + os.environ['SUDO_USER'] + " \
         #    was not found in MyTardis."
     except:
         print traceback.format_exc()
+
+    timer.mark("query")
+    timer.report()
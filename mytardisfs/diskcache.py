@@ -0,0 +1,156 @@
+# Bounded on-disk cache of datafile content for mytardisfs.
+
+# Some MyTardis replicas live on slow network or archive storage, so
+# datafile content read from them can be kept in a cache directory on
+# local disk (e.g. an SSD), and later reads of the same bytes are served
+# from there.
+
+# Content is cached in fixed-size blocks, one file per block, named by
+# a hash of the datafile's ID, size and modification time (so a datafile
+# which changes gets new cache entries) and the block index.  Each block
+# is written to a temporary file, which is renamed into place once it
+# is complete, so a crash can only leave temporary files behind, and
+# these are removed when the cache is opened.  Blocks are evicted in
+# least recently used order (by file modification time, which is
+# updated on each hit, so the order survives restarts).
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+TEMPORARY_FILE_SUFFIX = ".tmp"
+
+
+class DiskCache():
+    def __init__(self, cache_dir, max_bytes, block_size):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        # Block file names, least recently used first, with their sizes:
+        self.blocks = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, 0700)
+        os.chmod(self.cache_dir, 0700)
+        blocks = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(TEMPORARY_FILE_SUFFIX):
+                # Left behind by a crash while writing a block.
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            blocks.append((st.st_mtime, name, st.st_size))
+        blocks.sort()
+        for mtime, name, size in blocks:
+            self.blocks[name] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+            metrics.set_gauge("disk_cache.bytes", self.total_bytes)
+
+    def block_name(self, cache_key, block_index):
+        return hashlib.sha1(repr(cache_key)).hexdigest() + \
+            "-" + str(block_index)
+
+    def get(self, name):
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            if name not in self.blocks:
+                self.misses = self.misses + 1
+                metrics.increment("disk_cache.misses")
+                self._update_hit_ratio()
+                return None
+            self.blocks[name] = self.blocks.pop(name)
+        try:
+            with open(path, 'rb') as block_file:
+                data = block_file.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self.lock:
+                self.total_bytes -= self.blocks.pop(name, 0)
+                self.misses = self.misses + 1
+            metrics.increment("disk_cache.misses")
+            return None
+        with self.lock:
+            self.hits = self.hits + 1
+            self._update_hit_ratio()
+        metrics.increment("disk_cache.hits")
+        metrics.increment("disk_cache.bytes_saved", len(data))
+        return data
+
+    def put(self, name, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if name in self.blocks:
+                return
+        try:
+            fd, temporary_path = \
+                tempfile.mkstemp(suffix=TEMPORARY_FILE_SUFFIX,
+                                 dir=self.cache_dir)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(temporary_path, os.path.join(self.cache_dir, name))
+        except (IOError, OSError):
+            # e.g. the cache's file system is full.
+            metrics.increment("disk_cache.write_errors")
+            return
+        with self.lock:
+            if name not in self.blocks:
+                self.blocks[name] = len(data)
+                self.total_bytes += len(data)
+            self._evict()
+            metrics.set_gauge("disk_cache.bytes", self.total_bytes)
+
+    def read(self, cache_key, datafile_size, offset, length, read_block,
+             cacheable=None):
+        # Returns length bytes starting at offset, using read_block(offset,
+        # length) to read any blocks which aren't already in the cache.
+        # Blocks read with read_block are only stored if cacheable()
+        # returns True, e.g. if the datafile is on a slow storage tier.
+        end = min(offset + length, datafile_size)
+        chunks = []
+        block_index = offset // self.block_size
+        while block_index * self.block_size < end:
+            block_offset = block_index * self.block_size
+            name = self.block_name(cache_key, block_index)
+            data = self.get(name)
+            if data is None:
+                data = read_block(block_offset, self.block_size)
+                if data is None:
+                    return None
+                if cacheable is None or cacheable():
+                    self.put(name, data)
+            start_in_block = max(offset - block_offset, 0)
+            chunks.append(data[start_in_block:end - block_offset])
+            if len(data) < self.block_size:
+                break
+            block_index = block_index + 1
+        return "".join(chunks)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.blocks:
+            name, size = self.blocks.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            metrics.increment("disk_cache.evictions")
+
+    def _update_hit_ratio(self):
+        metrics.set_gauge("disk_cache.hit_ratio",
+                          float(self.hits) / (self.hits + self.misses))
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# Displays the total size in bytes and the number of datafiles of each
+# dataset in each experiment which the user has access to, e.g.
+#   {exp_id: {dataset_id: (total_bytes, file_count), ...}, ...}
+# using one query over Dataset_File, so that mytardisfs can report
+# recursive sizes of experiment and dataset directories without listing
+# every dataset.
+
+# A client process, running as a regular POSIX username (matching a
+# MyTardis username) runs this script, which runs as user "mytardis",
+# via "sudo -u mytardis", thanks to a rule within /etc/sudoers.
+
+# This script can determine the username which the client script is
+# running as, thanks to the SUDO_USER environment variable, so it will
+# only provide access to experiment IDs available to that MyTardis
+# username.  Currently the username is matched using the auth_provider
+# authentication scheme in the MyTardis deployment in mytardis_install_dir
+# (defined in [mytardis_install_dir]/tardis/settings.py)
+
+import os
+import sys
+import getpass
+import traceback
+
+import bootstrap
+from phases import PhaseTimer
+
+
+def run():
+    timer = PhaseTimer()
+
+    if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
+        print "Usage: sudo -u mytardis _expdatasetsizes " + \
+            "mytardis_install_dir auth_provider"
+        sys.exit(1)
+
+    if len(sys.argv) < 3:
+        print "Usage: sudo -u mytardis _expdatasetsizes " + \
+            "mytardis_install_dir auth_provider"
+        sys.exit(1)
+
+    _mytardis_install_dir = sys.argv[1].strip('"')
+    _auth_provider = sys.argv[2]
+
+    bootstrap.setup_django(_mytardis_install_dir, timer)
+
+    from tardis.tardis_portal.models import Dataset_File, Experiment
+    from tardis.tardis_portal.models import UserAuthentication
+    from django.core.exceptions import ObjectDoesNotExist
+
+    try:
+        userAuth = UserAuthentication.objects \
+            .get(username=os.environ['SUDO_USER'],
+                 authenticationMethod=_auth_provider)
+        mytardis_user = userAuth.userProfile.user
+        staff_or_superuser = mytardis_user.is_staff or \
+            mytardis_user.is_superuser
+
+        dfs = Dataset_File.objects.all()
+        accessible_exp_ids = None
+        if not staff_or_superuser:
+            exps_owned_and_shared = Experiment.safe \
+                .owned_and_shared(mytardis_user)
+            public_exp_ids = [
+                exp_id for exp_id, public_access in
+                Experiment.objects.values_list('id', 'public_access')
+                if Experiment.public_access_implies_distribution(
+                    public_access)]
+            accessible_exp_ids = \
+                set(exps_owned_and_shared.values_list('id', flat=True)) | \
+                set(public_exp_ids)
+            dfs = dfs.filter(dataset__experiments__id__in=accessible_exp_ids)
+
+        # Dataset_File.size is a CharField, so it is summed here rather
+        # than with an SQL aggregate.
+        exp_dict = dict()
+        for exp_id, dataset_id, size in dfs \
+                .values_list('dataset__experiments__id', 'dataset__id',
+                             'size').iterator():
+            if accessible_exp_ids is not None and \
+                    exp_id not in accessible_exp_ids:
+                continue
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = 0
+            datasets = exp_dict.setdefault(exp_id, dict())
+            total_bytes, file_count = datasets.get(dataset_id, (0, 0))
+            datasets[dataset_id] = (total_bytes + size, file_count + 1)
+        print str(exp_dict)
+    except ObjectDoesNotExist:
+        print traceback.format_exc()
+    except:
+        print traceback.format_exc()
+
+    timer.mark("query")
+    timer.report()
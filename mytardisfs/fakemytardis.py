@@ -0,0 +1,239 @@
+# A stand-in for the parts of MyTardis's RESTful API which mytardisfs
+# uses, serving a synthetic hierarchy of experiments, datasets and
+# datafiles, so that mytardisfs can be load tested (see loadtest.py) on
+# a plain Linux box, without MyTardis, Django or sudo:
+#
+#   mytardisfs-fake-server --port=8123 --experiments=20 \
+#       --datasets-per-experiment=10 --datafiles-per-dataset=50
+#
+# mytardisfs then needs a config like the one for transfer nodes (see
+# README.md), e.g. in a file named by the MYTARDISFS_CNF environment
+# variable:
+#
+#   [mytardisfs]
+#   mytardis_url = http://localhost:8123
+#   api_key_file = /tmp/fake-apikey   (containing "ApiKey user:key")
+#   use_api_for_dataset_datafiles = True
+#   content_backend = http
+#   recent_views =
+#   by_date_view = False
+#
+# Listings support If-None-Match (with an ETag of the body), and
+# downloads support Range requests.  Datafile content is a repeating
+# byte pattern, offset by the datafile ID, so reads can be verified
+# without storing anything.
+
+import re
+import sys
+import json
+import time
+import getopt
+import hashlib
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+PATTERN = "".join(chr(i) for i in range(251))
+CREATED_TIME = "2014-05-01T10:00:00"
+
+
+def datafile_content(datafile_id, offset, length):
+    start = (offset + datafile_id) % len(PATTERN)
+    repeats = (start + length) // len(PATTERN) + 1
+    return (PATTERN * repeats)[start:start + length]
+
+
+class FakeMyTardis():
+    def __init__(self, experiments, datasets_per_experiment,
+                 datafiles_per_dataset, small_file_size, large_file_size,
+                 large_file_fraction):
+        self.experiments = []
+        self.datasets = dict()
+        self.datafiles = dict()
+        self.datafile_sizes = dict()
+        dataset_id = 0
+        datafile_id = 0
+        large_file_interval = 0
+        if large_file_fraction > 0:
+            large_file_interval = int(round(1 / large_file_fraction))
+        for experiment_id in range(1, experiments + 1):
+            self.experiments.append(dict(id=experiment_id,
+                                         title="Experiment %d" %
+                                         experiment_id,
+                                         created_time=CREATED_TIME))
+            self.datasets[experiment_id] = []
+            for i in range(datasets_per_experiment):
+                dataset_id = dataset_id + 1
+                self.datasets[experiment_id].append(
+                    dict(id=dataset_id,
+                         description="Dataset %d" % dataset_id))
+                self.datafiles[dataset_id] = []
+                for j in range(datafiles_per_dataset):
+                    datafile_id = datafile_id + 1
+                    size = small_file_size
+                    if large_file_interval > 0 and \
+                            datafile_id % large_file_interval == 0:
+                        size = large_file_size
+                    directory = ""
+                    if j % 10 == 9:
+                        directory = "raw"
+                    self.datafile_sizes[datafile_id] = size
+                    self.datafiles[dataset_id].append(
+                        dict(id=datafile_id, directory=directory,
+                             filename="datafile%d.dat" % datafile_id,
+                             size=str(size), created_time=CREATED_TIME,
+                             modification_time=CREATED_TIME))
+
+    def listing(self, path, query):
+        # Returns a list of objects for an API listing URL, or None.
+        if path == "/api/v1/experiment/":
+            return self.experiments
+        if path == "/api/v1/dataset/":
+            return self.datasets.get(int(query['experiments__id'][0]), [])
+        if path == "/api/v1/dataset_file/":
+            return self.datafiles.get(int(query['dataset__id'][0]), [])
+        return None
+
+
+class FakeMyTardisHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    download_path = re.compile(r"^/api/v1/dataset_file/(\d+)/download/$")
+    range_header = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+    def do_GET(self):
+        if self.server.latency_seconds > 0:
+            time.sleep(self.server.latency_seconds)
+        if 'Authorization' not in self.headers:
+            self.send_body(401, "")
+            return
+        url = urlparse.urlparse(self.path)
+        match = self.download_path.match(url.path)
+        if match:
+            self.download(int(match.group(1)))
+            return
+        objects = self.server.fake.listing(url.path,
+                                           urlparse.parse_qs(url.query))
+        if objects is None:
+            self.send_body(404, "")
+            return
+        body = json.dumps(dict(meta=dict(total_count=len(objects)),
+                               objects=objects))
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, "", {'ETag': etag})
+            return
+        self.send_body(200, body, {'ETag': etag,
+                                   'Content-Type': "application/json"})
+
+    def download(self, datafile_id):
+        if datafile_id not in self.server.fake.datafile_sizes:
+            self.send_body(404, "")
+            return
+        size = self.server.fake.datafile_sizes[datafile_id]
+        start = 0
+        end = size - 1
+        status = 200
+        headers = dict()
+        match = self.range_header.match(self.headers.get('Range', ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2) != "":
+                end = min(int(match.group(2)), size - 1)
+            status = 206
+            headers['Content-Range'] = "bytes %d-%d/%d" % (start, end, size)
+        self.send_body(status,
+                       datafile_content(datafile_id, start,
+                                        max(0, end - start + 1)), headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        if headers is not None:
+            for name, value in headers.iteritems():
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler \
+                .log_message(self, format, *args)
+
+
+class FakeMyTardisServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fake, latency_seconds=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           FakeMyTardisHandler)
+        self.fake = fake
+        self.latency_seconds = latency_seconds
+        self.verbose = verbose
+
+
+def usage():
+    print "Usage: mytardisfs-fake-server [--port=PORT] " + \
+        "[--experiments=N] [--datasets-per-experiment=N]"
+    print "           [--datafiles-per-dataset=N] " + \
+        "[--small-file-size=BYTES] [--large-file-size=BYTES]"
+    print "           [--large-file-fraction=FRACTION] " + \
+        "[--latency-ms=MS] [--verbose]"
+
+
+def run():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hv",
+                                   ["help", "verbose", "port=",
+                                    "experiments=",
+                                    "datasets-per-experiment=",
+                                    "datafiles-per-dataset=",
+                                    "small-file-size=", "large-file-size=",
+                                    "large-file-fraction=", "latency-ms="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    port = 8123
+    experiments = 20
+    datasets_per_experiment = 10
+    datafiles_per_dataset = 50
+    small_file_size = 64 * 1024
+    large_file_size = 256 * 1024 * 1024
+    large_file_fraction = 0.02
+    latency_ms = 0
+    verbose = False
+    for opt, arg in opts:
+        if opt == '-h' or opt == '--help':
+            usage()
+            sys.exit()
+        if opt == '-v' or opt == '--verbose':
+            verbose = True
+        if opt == '--port':
+            port = int(arg)
+        if opt == '--experiments':
+            experiments = int(arg)
+        if opt == '--datasets-per-experiment':
+            datasets_per_experiment = int(arg)
+        if opt == '--datafiles-per-dataset':
+            datafiles_per_dataset = int(arg)
+        if opt == '--small-file-size':
+            small_file_size = int(arg)
+        if opt == '--large-file-size':
+            large_file_size = int(arg)
+        if opt == '--large-file-fraction':
+            large_file_fraction = float(arg)
+        if opt == '--latency-ms':
+            latency_ms = int(arg)
+
+    fake = FakeMyTardis(experiments, datasets_per_experiment,
+                        datafiles_per_dataset, small_file_size,
+                        large_file_size, large_file_fraction)
+    server = FakeMyTardisServer(('', port), fake, latency_ms / 1000.0,
+                                verbose)
+    print "Fake MyTardis listening on port %d" % port
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,118 @@
+# HTTP range reads of datafile content for mytardisfs.
+
+# By default, mytardisfs reads datafiles through file descriptors passed
+# to it by "_datafiledescriptord", which only works on the MyTardis
+# server itself.  With content_backend = http, datafile content is read
+# instead with ranged HTTP GET requests to MyTardis's datafile download
+# endpoint, so mytardisfs (and the SFTP server in front of it) can run on
+# separate transfer nodes.
+
+# Requests share one pooled requests.Session, and a large read is split
+# into ranges of range_fetch_bytes, fetched in parallel (up to
+# parallel_fetches at once).
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import optrace
+
+
+class HttpContentError(Exception):
+    pass
+
+
+class HttpRangeReader():
+    def __init__(self, download_url_format, headers, range_fetch_bytes,
+                 parallel_fetches, slot_function=None):
+        # download_url_format % datafile_id gives the download URL, and
+        # slot_function(), if given, returns a context manager to hold
+        # while each request is running (e.g. a BackendScheduler slot).
+        self.download_url_format = download_url_format
+        self.range_fetch_bytes = range_fetch_bytes
+        self.parallel_fetches = max(1, parallel_fetches)
+        self.slot_function = slot_function
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.parallel_fetches * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def read(self, datafile_id, datafile_size, offset, length):
+        # Returns up to length bytes starting at offset, or None if
+        # MyTardis refused access to the datafile.
+        end = min(offset + length, datafile_size)
+        if end <= offset:
+            return ""
+        ranges = []
+        range_start = offset
+        while range_start < end:
+            range_end = min(range_start + self.range_fetch_bytes, end)
+            ranges.append((range_start, range_end))
+            range_start = range_end
+        if len(ranges) == 1:
+            return self.fetch_range(datafile_id, offset, end)
+
+        results = [None] * len(ranges)
+        errors = []
+        next_range = [0]
+        lock = threading.Lock()
+
+        def fetch_ranges():
+            while True:
+                with lock:
+                    if next_range[0] >= len(ranges) or errors:
+                        return
+                    i = next_range[0]
+                    next_range[0] = i + 1
+                try:
+                    results[i] = self.fetch_range(datafile_id, *ranges[i])
+                except Exception, e:
+                    with lock:
+                        errors.append(e)
+                    return
+
+        threads = []
+        for i in range(min(self.parallel_fetches, len(ranges))):
+            thread = threading.Thread(target=fetch_ranges)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if None in results:
+            return None
+        metrics.increment("http_content.parallel_reads")
+        return "".join(results)
+
+    def fetch_range(self, datafile_id, start, end):
+        url = self.download_url_format % datafile_id
+        headers = {'Range': "bytes=%d-%d" % (start, end - 1)}
+        with optrace.span("backend", "http_range", datafile_id=datafile_id,
+                          off=start, len=end - start) as trace_span:
+            if self.slot_function is not None:
+                with self.slot_function():
+                    response = self.session.get(url, headers=headers)
+            else:
+                response = self.session.get(url, headers=headers)
+            trace_span.fields['r'] = response.status_code
+        metrics.increment("http_content.requests")
+        if response.status_code in (401, 403, 404):
+            return None
+        if response.status_code == 206:
+            data = response.content
+        elif response.status_code == 200:
+            # The server ignored the Range header and sent the whole file.
+            metrics.increment("http_content.full_responses")
+            data = response.content[start:end]
+        else:
+            raise HttpContentError("GET %s (%s) returned status %d" %
+                                   (url, headers['Range'],
+                                    response.status_code))
+        metrics.increment("http_content.bytes", len(data))
+        return data
@@ -0,0 +1,231 @@
+# Push-based cache invalidation for mytardisfs mounts.
+
+# Each mount (if control_socket_dir is set in /etc/mytardisfs.cnf)
+# listens on a Unix socket, [control_socket_dir]/[user]-[pid].sock, for
+# events saying that an experiment, dataset or datafile has changed, e.g.
+#   {"kind": "dataset", "id": 34, "experiment_id": 12}
+# and expires the affected listings straight away, so new data appears
+# at the next directory listing, however long the cache times are.
+
+# Events are published to every mount on the host by the
+# mytardisfs-invalidate command, e.g. from a MyTardis ingestion hook:
+#
+#   mytardisfs-invalidate experiment EXP_ID
+#   mytardisfs-invalidate dataset DATASET_ID [EXP_ID]
+#   mytardisfs-invalidate datafile DATAFILE_ID DATASET_ID [EXP_ID]
+#
+# or by calling publish() from Python, as root or mytardis.
+
+# control_socket_dir must be created by the administrator, owned by root
+# or mytardis, with the sticky bit set and without read access for other
+# users (e.g. mode 1733), so that users can create their mounts' sockets
+# in it, but can't replace the directory or list the other sockets.
+# Mounts refuse to listen in any other directory.  Each connection's
+# sender is checked with SO_PEERCRED, and only events from root,
+# mytardis or the mount's own user are accepted.  Events which arrive
+# within COALESCE_SECONDS of each other are handled together, once
+# each, so a burst of events only expires each listing once.
+
+import os
+import pwd
+import sys
+import json
+import stat
+import time
+import errno
+import socket
+import struct
+import getopt
+import threading
+import traceback
+
+import metrics
+
+DEFAULT_SOCKET_DIR = "/var/lib/mytardisfs/control"
+KINDS = ["experiment", "dataset", "datafile"]
+MAX_EVENT_BYTES = 4096
+COALESCE_SECONDS = 1.0
+SEND_TIMEOUT_SECONDS = 1.0
+# (The socket module doesn't define SO_PEERCRED in Python 2.)
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+
+def mytardis_uid():
+    try:
+        return pwd.getpwnam("mytardis").pw_uid
+    except KeyError:
+        return None
+
+
+def socket_paths(socket_dir):
+    try:
+        filenames = os.listdir(socket_dir)
+    except OSError:
+        return []
+    return [os.path.join(socket_dir, filename) for filename in filenames
+            if filename.endswith(".sock")]
+
+
+def publish(event, socket_dir=DEFAULT_SOCKET_DIR):
+    # Sends event (a dictionary) to every mount listening in socket_dir,
+    # and returns how many received it.  Sockets left behind by mounts
+    # which have exited are removed.
+    message = json.dumps(event)
+    sent = 0
+    for socket_path in socket_paths(socket_dir):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(SEND_TIMEOUT_SECONDS)
+        try:
+            sock.connect(socket_path)
+            sock.sendall(message)
+            sent = sent + 1
+        except socket.error, e:
+            if e.errno == errno.ECONNREFUSED:
+                try:
+                    os.remove(socket_path)
+                except OSError:
+                    pass
+        finally:
+            sock.close()
+    return sent
+
+
+def check_socket_dir(socket_dir):
+    # Raises an exception unless socket_dir is safe to listen in.
+    dir_stat = os.lstat(socket_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or \
+            dir_stat.st_uid not in (0, mytardis_uid()) or \
+            not dir_stat.st_mode & stat.S_ISVTX or \
+            dir_stat.st_mode & stat.S_IROTH:
+        raise Exception(socket_dir + " must be a directory owned by root "
+                        "or mytardis, with mode 1733")
+
+
+def peer_uid(connection):
+    credentials = connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                        struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
+
+
+def receive_event(connection):
+    connection.settimeout(SEND_TIMEOUT_SECONDS)
+    message = ""
+    while len(message) < MAX_EVENT_BYTES:
+        data = connection.recv(MAX_EVENT_BYTES - len(message))
+        if data == "":
+            break
+        message = message + data
+    return message
+
+
+def listen(socket_dir, user, handler, logger):
+    # Starts threads which call handler(events) for each burst of events
+    # received, where events is a list of distinct events, and returns
+    # the socket's path.
+    check_socket_dir(socket_dir)
+    allowed_uids = set([0, os.getuid(), mytardis_uid()])
+    socket_path = os.path.join(socket_dir, "%s-%d.sock" % (user, os.getpid()))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    os.chmod(socket_path, 0666)
+    sock.listen(16)
+
+    condition = threading.Condition()
+    pending = []
+
+    def receive_events():
+        while True:
+            connection, _ = sock.accept()
+            try:
+                uid = peer_uid(connection)
+                if uid not in allowed_uids:
+                    metrics.increment("invalidations.rejected")
+                    logger.info("Ignoring invalidation event from uid %d"
+                                % uid)
+                    continue
+                message = receive_event(connection)
+                event = json.loads(message)
+                if not isinstance(event, dict) or \
+                        event.get('kind') not in KINDS:
+                    logger.info("Ignoring invalidation event: " + message)
+                    continue
+                metrics.increment("invalidations." + event['kind'])
+                with condition:
+                    if event not in pending:
+                        pending.append(event)
+                    else:
+                        metrics.increment("invalidations.coalesced")
+                    condition.notify()
+            except:
+                logger.error(traceback.format_exc())
+            finally:
+                connection.close()
+
+    def handle_events():
+        while True:
+            with condition:
+                while len(pending) == 0:
+                    condition.wait()
+            # Let the rest of a burst arrive.
+            time.sleep(COALESCE_SECONDS)
+            with condition:
+                events = list(pending)
+                del pending[:]
+            try:
+                handler(events)
+            except:
+                logger.error(traceback.format_exc())
+
+    for target in (receive_events, handle_events):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    return socket_path
+
+
+def usage():
+    print "Usage: mytardisfs-invalidate [--socket-dir=DIR] " + \
+        "experiment EXP_ID"
+    print "       mytardisfs-invalidate [--socket-dir=DIR] " + \
+        "dataset DATASET_ID [EXP_ID]"
+    print "       mytardisfs-invalidate [--socket-dir=DIR] " + \
+        "datafile DATAFILE_ID DATASET_ID [EXP_ID]"
+
+
+def run():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h",
+                                       ["help", "socket-dir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    socket_dir = DEFAULT_SOCKET_DIR
+    for opt, arg in opts:
+        if opt == '-h' or opt == '--help':
+            usage()
+            sys.exit()
+        if opt == '--socket-dir':
+            socket_dir = arg
+    if len(args) < 2 or args[0] not in KINDS:
+        usage()
+        sys.exit(1)
+    try:
+        ids = [int(arg) for arg in args[1:]]
+    except ValueError:
+        usage()
+        sys.exit(1)
+    kind = args[0]
+    event = dict(kind=kind, id=ids[0])
+    if kind == "experiment" and len(ids) == 1:
+        pass
+    elif kind == "dataset" and len(ids) <= 2:
+        if len(ids) > 1:
+            event['experiment_id'] = ids[1]
+    elif kind == "datafile" and 2 <= len(ids) <= 3:
+        event['dataset_id'] = ids[1]
+        if len(ids) > 2:
+            event['experiment_id'] = ids[2]
+    else:
+        usage()
+        sys.exit(1)
+    print "Sent to %d mount(s)." % publish(event, socket_dir)
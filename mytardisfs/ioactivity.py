@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+# Records that the user running mytardisfs is reading from storage, and
+# reports how many users are doing so, along with the host-wide I/O
+# budget, so that mytardisfs can share the budget fairly (see
+# throttle.py), e.g.
+#   {'active_users': 3, 'host_io_throttle_mb_per_s': 300,
+#    'host_io_throttle_iops': 0}
+
+# A client process, running as a regular user, runs this script as user
+# "mytardis", via "sudo -u mytardis", thanks to a rule within
+# /etc/sudoers.  Each user's activity is recorded by touching
+# ~mytardis/.mytardisfs/io/io-[uid], using the uid from sudo's SUDO_UID
+# environment variable, so users can't add or change records, and the
+# budget is only read from the system config files.  Records which
+# haven't been touched within throttle.ACTIVE_SECONDS, or which aren't
+# regular files owned by mytardis, aren't counted.
+
+import os
+import sys
+import stat
+import time
+import getpass
+
+import bootstrap
+from phases import PhaseTimer
+from throttle import ACTIVE_SECONDS
+
+
+def run():
+    timer = PhaseTimer()
+
+    if getpass.getuser() != "mytardis" or "SUDO_UID" not in os.environ:
+        print "Usage: sudo -u mytardis _ioactivity"
+        sys.exit(1)
+
+    io_dir = os.path.join(bootstrap.mytardisfs_dir(), "io")
+    if not os.path.exists(io_dir):
+        os.makedirs(io_dir, 0700)
+
+    now = time.time()
+    user_path = os.path.join(io_dir, "io-%d" % int(os.environ['SUDO_UID']))
+    with open(user_path, 'a'):
+        pass
+    os.utime(user_path, (now, now))
+    timer.mark("record")
+
+    active_users = 0
+    for filename in os.listdir(io_dir):
+        if not filename.startswith("io-") or not filename[3:].isdigit():
+            continue
+        try:
+            file_stat = os.lstat(os.path.join(io_dir, filename))
+        except OSError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode) or \
+                file_stat.st_uid != os.getuid():
+            continue
+        if now - file_stat.st_mtime < ACTIVE_SECONDS:
+            active_users = active_users + 1
+    timer.mark("count")
+
+    print str(dict(active_users=max(1, active_users),
+                   host_io_throttle_mb_per_s=bootstrap.system_config_int(
+                       "host_io_throttle_mb_per_s", 0),
+                   host_io_throttle_iops=bootstrap.system_config_int(
+                       "host_io_throttle_iops", 0)))
+    timer.report()
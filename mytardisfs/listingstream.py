@@ -0,0 +1,48 @@
+# Directory listings which can be read while they are still being built.
+
+# A ListingStream holds the entries of one directory listing, in the
+# order they were found.  One thread adds entries as listing data
+# arrives from the backend (e.g. line by line from "_datasetdatafiles"),
+# while readdir calls read entries from a given position, waiting for
+# more until the listing is finished.  Because the entries' positions
+# never change, they can be used as readdir offsets: when the kernel's
+# buffer fills up, it calls readdir again with the offset of the last
+# entry it received, and the listing resumes from there, even if the
+# first readdir call's generator has been abandoned.
+
+import threading
+
+
+class ListingStream():
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.entries = []
+        self.names = set()
+        self.done = False
+
+    def add(self, name, entry):
+        with self.condition:
+            if name in self.names:
+                return
+            self.names.add(name)
+            self.entries.append((name, entry))
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def entries_from(self, position):
+        # Yields (position, name, entry) for each entry from position
+        # onwards, as they are added, until the listing is finished.
+        while True:
+            with self.condition:
+                while position >= len(self.entries) and not self.done:
+                    self.condition.wait()
+                if position >= len(self.entries):
+                    return
+                entries = self.entries[position:]
+            for name, entry in entries:
+                yield position, name, entry
+                position = position + 1
@@ -0,0 +1,320 @@
+# Load generator for mytardisfs, simulating many concurrent clients
+# (e.g. 50-200 SFTP sessions) against a mount:
+#
+#   mytardisfs-loadtest ~/MyTardis --clients=100 --duration=60 \
+#       --mix=listing:2,stat:5,small:2,large:1 --pid=`pgrep -n mytardisfs`
+#
+# Each client repeatedly picks an operation from the weighted mix:
+#   listing: list a random directory
+#   stat:    lstat a random file or directory
+#   small:   read the whole of a random file of up to --small-file-size
+#   large:   read --large-read-mb of a random larger file, sequentially
+#            in --chunk-size-kb chunks, or with --random-reads, from
+#            random offsets
+# Clients run as threads, spread across --processes processes.  The
+# report gives the throughput and p50/p99/p99.9 latencies of each
+# operation type, and, if --pid is given, the mytardisfs process's RSS,
+# thread count and open file descriptor count, sampled every
+# --sample-interval seconds.
+#
+# To run on a plain Linux box, point the mount at a fake MyTardis (see
+# fakemytardis.py).
+
+import os
+import sys
+import time
+import random
+import getopt
+import threading
+import multiprocessing
+
+import metrics
+
+OPERATIONS = ["listing", "stat", "small", "large"]
+
+
+def walk_mount(mount_dir, max_entries):
+    # Returns the directories and files (with sizes) found in the mount,
+    # stopping after max_entries.
+    directories = []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(mount_dir):
+        # Skip the virtual views (/.recent, /.by-date), which only
+        # contain links.
+        dirnames[:] = [name for name in dirnames
+                       if not name.startswith('.')]
+        directories.append(dirpath)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                files.append((path, os.lstat(path).st_size))
+            except OSError:
+                pass
+        if len(directories) + len(files) >= max_entries:
+            break
+    return directories, files
+
+
+def parse_mix(mix):
+    # e.g. "listing:2,stat:5,small:2,large:1"
+    weights = []
+    for item in mix.split(','):
+        op, weight = item.split(':')
+        if op not in OPERATIONS:
+            raise ValueError("Unknown operation in mix: " + op)
+        weights.append((op, float(weight)))
+    return weights
+
+
+def choose(weights):
+    total = sum(weight for op, weight in weights)
+    point = random.uniform(0, total)
+    for op, weight in weights:
+        point = point - weight
+        if point <= 0:
+            return op
+    return weights[-1][0]
+
+
+class Client(threading.Thread):
+    def __init__(self, options, directories, small_files, large_files,
+                 end_time, results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.options = options
+        self.directories = directories
+        self.small_files = small_files
+        self.large_files = large_files
+        self.end_time = end_time
+        # results is a list of (op, latency_seconds, bytes, error)
+        self.results = results
+
+    def run(self):
+        while time.time() < self.end_time:
+            op = choose(self.options['mix'])
+            start_time = time.time()
+            error = None
+            num_bytes = 0
+            try:
+                num_bytes = getattr(self, "do_" + op)()
+            except (IOError, OSError), e:
+                error = e.errno
+            if num_bytes is None:
+                # Nothing to do this operation on.
+                continue
+            self.results.append((op, time.time() - start_time, num_bytes,
+                                 error))
+
+    def do_listing(self):
+        if not self.directories:
+            return None
+        os.listdir(random.choice(self.directories))
+        return 0
+
+    def do_stat(self):
+        if random.random() < 0.5 and self.directories:
+            os.lstat(random.choice(self.directories))
+        elif self.small_files or self.large_files:
+            os.lstat(random.choice(self.small_files + self.large_files)[0])
+        else:
+            return None
+        return 0
+
+    def do_small(self):
+        if not self.small_files:
+            return None
+        with open(random.choice(self.small_files)[0], 'rb') as f:
+            return len(f.read())
+
+    def do_large(self):
+        if not self.large_files:
+            return None
+        path, size = random.choice(self.large_files)
+        chunk_size = self.options['chunk_size_kb'] * 1024
+        read_bytes = min(size, self.options['large_read_mb'] * 1024 * 1024)
+        total = 0
+        with open(path, 'rb') as f:
+            if self.options['random_reads']:
+                for i in range(max(1, read_bytes // chunk_size)):
+                    f.seek(random.randint(0, max(0, size - chunk_size)))
+                    total = total + len(f.read(chunk_size))
+            else:
+                while total < read_bytes:
+                    data = f.read(min(chunk_size, read_bytes - total))
+                    if data == "":
+                        break
+                    total = total + len(data)
+        return total
+
+
+def run_clients(options, num_clients, directories, files, end_time,
+                result_queue=None):
+    small_files = [f for f in files
+                   if f[1] <= options['small_file_size']]
+    large_files = [f for f in files
+                   if f[1] > options['small_file_size']]
+    results = []
+    clients = []
+    for i in range(num_clients):
+        client = Client(options, directories, small_files, large_files,
+                        end_time, results)
+        client.start()
+        clients.append(client)
+    for client in clients:
+        client.join()
+    if result_queue is not None:
+        result_queue.put(results)
+    return results
+
+
+def process_stats(pid):
+    # Returns (rss_kb, threads, fds) for a process, from /proc.
+    rss_kb = 0
+    threads = 0
+    with open("/proc/%d/status" % pid, 'r') as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+            if line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    fds = len(os.listdir("/proc/%d/fd" % pid))
+    return rss_kb, threads, fds
+
+
+def sample_process(pid, interval, end_time, samples):
+    start_time = time.time()
+    while time.time() < end_time:
+        try:
+            samples.append((time.time() - start_time,) + process_stats(pid))
+        except (IOError, OSError):
+            # e.g. mytardisfs has exited, or belongs to another user.
+            return
+        time.sleep(interval)
+
+
+def report(results, elapsed, samples):
+    print "%d operations in %.1f seconds (%.1f ops/s)" % \
+        (len(results), elapsed, len(results) / elapsed)
+    print ""
+    print "%-8s %8s %8s %10s %10s %10s %10s %10s" % \
+        ("op", "count", "errors", "ops/s", "MB/s", "p50 ms", "p99 ms",
+         "p99.9 ms")
+    for op in OPERATIONS:
+        op_results = [r for r in results if r[0] == op]
+        if len(op_results) == 0:
+            continue
+        latencies = sorted(r[1] for r in op_results)
+        errors = len([r for r in op_results if r[3] is not None])
+        num_bytes = sum(r[2] for r in op_results)
+        print "%-8s %8d %8d %10.1f %10.2f %10.2f %10.2f %10.2f" % \
+            (op, len(op_results), errors, len(op_results) / elapsed,
+             num_bytes / elapsed / 1024 / 1024,
+             metrics.percentile(latencies, 0.5) * 1000,
+             metrics.percentile(latencies, 0.99) * 1000,
+             metrics.percentile(latencies, 0.999) * 1000)
+    if samples:
+        print ""
+        print "%8s %12s %8s %8s" % ("seconds", "RSS KB", "threads", "fds")
+        for seconds, rss_kb, threads, fds in samples:
+            print "%8.1f %12d %8d %8d" % (seconds, rss_kb, threads, fds)
+
+
+def usage():
+    print "Usage: mytardisfs-loadtest mount_dir [--clients=N] " + \
+        "[--processes=N] [--duration=SECONDS]"
+    print "           [--mix=listing:W,stat:W,small:W,large:W] " + \
+        "[--small-file-size=BYTES]"
+    print "           [--large-read-mb=MB] [--chunk-size-kb=KB] " + \
+        "[--random-reads] [--max-entries=N]"
+    print "           [--pid=MYTARDISFS_PID] [--sample-interval=SECONDS]"
+
+
+def run():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h",
+                                   ["help", "clients=", "processes=",
+                                    "duration=", "mix=", "small-file-size=",
+                                    "large-read-mb=", "chunk-size-kb=",
+                                    "random-reads", "max-entries=", "pid=",
+                                    "sample-interval="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+    mount_dir = os.path.expanduser(args[0])
+    num_clients = 50
+    num_processes = 1
+    duration = 60.0
+    max_entries = 100000
+    pid = None
+    sample_interval = 5.0
+    options = dict(mix=parse_mix("listing:2,stat:5,small:2,large:1"),
+                   small_file_size=1024 * 1024, large_read_mb=64,
+                   chunk_size_kb=256, random_reads=False)
+    for opt, arg in opts:
+        if opt == '-h' or opt == '--help':
+            usage()
+            sys.exit()
+        if opt == '--clients':
+            num_clients = int(arg)
+        if opt == '--processes':
+            num_processes = int(arg)
+        if opt == '--duration':
+            duration = float(arg)
+        if opt == '--mix':
+            options['mix'] = parse_mix(arg)
+        if opt == '--small-file-size':
+            options['small_file_size'] = int(arg)
+        if opt == '--large-read-mb':
+            options['large_read_mb'] = int(arg)
+        if opt == '--chunk-size-kb':
+            options['chunk_size_kb'] = int(arg)
+        if opt == '--random-reads':
+            options['random_reads'] = True
+        if opt == '--max-entries':
+            max_entries = int(arg)
+        if opt == '--pid':
+            pid = int(arg)
+        if opt == '--sample-interval':
+            sample_interval = float(arg)
+
+    print "Walking %s ..." % mount_dir
+    directories, files = walk_mount(mount_dir, max_entries)
+    print "Found %d directories and %d files" % (len(directories),
+                                                 len(files))
+    sys.stdout.flush()
+
+    start_time = time.time()
+    end_time = start_time + duration
+    samples = []
+    if pid is not None:
+        sampler = threading.Thread(target=sample_process,
+                                   args=[pid, sample_interval, end_time,
+                                         samples])
+        sampler.daemon = True
+        sampler.start()
+
+    if num_processes <= 1:
+        results = run_clients(options, num_clients, directories, files,
+                              end_time)
+    else:
+        result_queue = multiprocessing.Queue()
+        processes = []
+        for i in range(num_processes):
+            process_clients = num_clients // num_processes
+            if i < num_clients % num_processes:
+                process_clients = process_clients + 1
+            process = multiprocessing.Process(target=run_clients,
+                                              args=[options, process_clients,
+                                                    directories, files,
+                                                    end_time, result_queue])
+            process.start()
+            processes.append(process)
+        results = []
+        for process in processes:
+            results.extend(result_queue.get())
+        for process in processes:
+            process.join()
+    report(results, time.time() - start_time, samples)
@@ -0,0 +1,90 @@
+# Lightweight in-process counters, gauges and timings for mytardisfs.
+
+# Like the FILES dictionary in mytardisfs.py, metrics are kept in
+# module-level dictionaries, so that any part of mytardisfs can
+# update them without having to pass objects around.  They can be
+# written to the mytardisfs log periodically by calling start_logging()
+# (see metrics_log_interval_seconds in /etc/mytardisfs.cnf).
+
+import math
+import threading
+
+_lock = threading.Lock()
+
+COUNTERS = dict()
+GAUGES = dict()
+# TIMINGS[name] = [count, total_seconds, max_seconds]
+TIMINGS = dict()
+
+
+def increment(name, amount=1):
+    with _lock:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+
+def set_gauge(name, value):
+    with _lock:
+        GAUGES[name] = value
+
+
+def add_to_gauge(name, amount):
+    with _lock:
+        GAUGES[name] = GAUGES.get(name, 0) + amount
+
+
+def record_time(name, seconds):
+    with _lock:
+        if name not in TIMINGS:
+            TIMINGS[name] = [0, 0.0, 0.0]
+        timing = TIMINGS[name]
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+
+def percentile(sorted_values, fraction):
+    # e.g. percentile(sorted(latencies), 0.99), using the nearest rank.
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def snapshot():
+    with _lock:
+        return dict(counters=dict(COUNTERS), gauges=dict(GAUGES),
+                    timings=dict((name, list(timing))
+                                 for name, timing in TIMINGS.iteritems()))
+
+
+def format_snapshot():
+    metrics = snapshot()
+    lines = []
+    for name in sorted(metrics['counters'].keys()):
+        lines.append("%s %s" % (name, metrics['counters'][name]))
+    for name in sorted(metrics['gauges'].keys()):
+        lines.append("%s %s" % (name, metrics['gauges'][name]))
+    for name in sorted(metrics['timings'].keys()):
+        count, total, maximum = metrics['timings'][name]
+        mean = 0.0
+        if count > 0:
+            mean = total / count
+        lines.append("%s count=%d mean=%.6f max=%.6f" %
+                     (name, count, mean, maximum))
+    return "\n".join(lines)
+
+
+def start_logging(logger, interval_seconds):
+    if interval_seconds <= 0:
+        return
+
+    def log_metrics():
+        logger.info("Metrics:\n" + format_snapshot())
+        timer = threading.Timer(interval_seconds, log_metrics)
+        timer.daemon = True
+        timer.start()
+
+    timer = threading.Timer(interval_seconds, log_metrics)
+    timer.daemon = True
+    timer.start()
@@ -8,6 +8,9 @@ import sys
 import os
 import getpass
 
+import bootstrap
+from phases import PhaseTimer
+
 
 def run():
     # This script should be run as user 'mytardis' via sudo.
@@ -15,6 +18,7 @@ def run():
     # thanks to this line in /etc/sudoers:
     # ALL     ALL=(ALL) NOPASSWD: /usr/local/bin/_myapikey,
     #    /usr/local/bin/_datafiledescriptord, /usr/local/bin/_datasetdatafiles
+    timer = PhaseTimer()
 
     if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
         print "Usage: sudo -u mytardis _myapikey " + \
@@ -29,12 +33,7 @@ def run():
     _mytardis_install_dir = sys.argv[1].strip('"')
     _auth_provider = sys.argv[2]
 
-    sys.path.append(_mytardis_install_dir)
-    for egg in os.listdir(os.path.join(_mytardis_install_dir, "eggs")):
-        sys.path.append(os.path.join(_mytardis_install_dir, "eggs", egg))
-    from django.core.management import setup_environ
-    from tardis import settings
-    setup_environ(settings)
+    bootstrap.setup_django(_mytardis_install_dir, timer)
 
     from tardis.tardis_portal.models import UserAuthentication
     from tastypie.models import ApiKey
@@ -46,3 +45,6 @@ def run():
 
     key = ApiKey.objects.get(user__username=myTardisUser.username)
     print "ApiKey " + myTardisUser.username + ":" + str(key.key)
+
+    timer.mark("query")
+    timer.report()
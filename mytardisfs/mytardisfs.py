@@ -12,7 +12,8 @@
 
 # Usage:
 #          mkdir ~/MyTardis
-#   Mount: mytardisfs ~/MyTardis -f -o direct_io 1>stdout.log 2>stderr.log &
+#   Mount: mytardisfs ~/MyTardis -f -o direct_io,use_ino \
+#              1>stdout.log 2>stderr.log &
 #      or: mytardisftpd
 # Unmount: fusermount -uz ~/MyTardis
 
@@ -58,9 +59,36 @@ import traceback
 import threading
 import ast
 import errno
+import fcntl
+import hashlib
+import itertools
 from datafiledescriptor import MyTardisDatafileDescriptor
+from datafiledescriptor import open_in_directory
+import metrics
+import optrace
+import phases
+import sessions
+import transfers
+import invalidation
+from scheduler import BackendScheduler
+from scheduler import PRIORITY_INTERACTIVE
+from scheduler import PRIORITY_BACKGROUND
+from scheduler import PRIORITY_VARIABLE
+from singleflight import SingleFlight
+from adaptivettl import AdaptiveTtls
+from throttle import IoThrottle
+from listingstream import ListingStream
+from blockcache import BlockCache
+from readahead import SequentialReader
+from httpcontent import HttpRangeReader
+from diskcache import DiskCache
+from namespaceindex import NamespaceIndex
+from namespaceindex import MAGIC as NAMESPACE_INDEX_MAGIC
+from namespaceindex import KIND_EXPERIMENT, KIND_DATASET, KIND_DATAFILE
 import dateutil.parser
 from datetime import datetime
+from datetime import timedelta
+from collections import OrderedDict
 import getopt
 import ConfigParser
 from __init__ import __version__
@@ -82,9 +110,23 @@ if len(sys.argv) < 2:
     print "See `mytardisfs -h' for usage"
     sys.exit(1)
 
+# mytardisftpd passes the write end of a pipe in MYTARDISFS_READY_FD, which
+# is written to and closed in fsinit.  Helpers started before then mustn't
+# inherit it, or mytardisftpd wouldn't see end-of-file if we crashed.
+if 'MYTARDISFS_READY_FD' in os.environ:
+    try:
+        _ready_fd = int(os.environ['MYTARDISFS_READY_FD'])
+        fcntl.fcntl(_ready_fd, fcntl.F_SETFD,
+                    fcntl.fcntl(_ready_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    except (ValueError, IOError):
+        logger.error(traceback.format_exc())
+
 MYTARDISFS_CNF_FILES = ['/etc/mytardisfs.cnf', '/usr/local/etc/mytardisfs.cnf',
                         os.path.join(os.path.expanduser('~'),
                                      '.mytardisfs.cnf')]
+# e.g. a config for testing against a fake MyTardis (fakemytardis.py):
+if 'MYTARDISFS_CNF' in os.environ:
+    MYTARDISFS_CNF_FILES.append(os.environ['MYTARDISFS_CNF'])
 
 logger.info("Looking for MyTardisFS config settings in:\n  " +
             str(MYTARDISFS_CNF_FILES))
@@ -107,6 +149,50 @@ _experiment_datasets_cache_time_seconds = 30
 _dataset_datafiles_cache_time_seconds = 30
 _default_directory_size = 4096
 _use_api_for_dataset_datafiles = False
+_replica_location_priority = ""
+_metrics_log_interval_seconds = 0
+_session_check_interval_seconds = 10
+_recent_views = "24h,7d"
+_by_date_view = True
+_views_cache_time_seconds = 60
+_max_concurrent_helpers = 4
+_max_concurrent_api_requests = 4
+_host_max_concurrent_api_requests = 0
+_host_lock_dir = ""
+_host_slot_wait_seconds = 5
+_block_cache_size_mb = 0
+_block_cache_block_size_kb = 128
+_read_ahead_max_kb = 0
+_recursive_directory_sizes = False
+_directory_sizes_cache_time_seconds = 300
+_content_backend = "fd"
+_http_range_fetch_size_kb = 1024
+_http_parallel_range_fetches = 4
+_api_key_file = ""
+_disk_cache_dir = ""
+_disk_cache_size_mb = 0
+_disk_cache_block_size_kb = 1024
+_disk_cache_locations = "*"
+_namespace_index = False
+_namespace_index_cache_time_seconds = 600
+_trace_file = ""
+_transfer_log_file = ""
+_transfer_idle_seconds = 30
+_dataset_directory_descriptors = False
+_speculative_open = False
+_speculative_open_max_concurrent = 2
+_speculative_open_expiry_seconds = 10
+_adaptive_cache_times = False
+_adaptive_cache_time_max_seconds = 14400
+_adaptive_cache_time_age_fraction = 0.1
+_io_throttle_mb_per_s = 0
+_io_throttle_iops = 0
+_host_io_throttle_mb_per_s = 0
+_host_io_throttle_iops = 0
+_io_throttle_interactive_kb = 256
+_control_socket_dir = ""
+_lazy_subdirectories = False
+_batch_dataset_listings = False
 
 if mytardisfs_config.has_section(_default_config_file_section):
     for key, val in mytardisfs_config.items(_default_config_file_section):
@@ -126,6 +212,94 @@ if mytardisfs_config.has_section(_default_config_file_section):
             _default_directory_size = int(val)
         if key == 'use_api_for_dataset_datafiles':
             _use_api_for_dataset_datafiles = (val == 'True')
+        if key == 'replica_location_priority':
+            _replica_location_priority = val.replace(' ', '')
+        if key == 'metrics_log_interval_seconds':
+            _metrics_log_interval_seconds = int(val)
+        if key == 'session_check_interval_seconds':
+            _session_check_interval_seconds = int(val)
+        if key == 'recent_views':
+            _recent_views = val.replace(' ', '')
+        if key == 'by_date_view':
+            _by_date_view = (val == 'True')
+        if key == 'views_cache_time_seconds':
+            _views_cache_time_seconds = int(val)
+        if key == 'max_concurrent_helpers':
+            _max_concurrent_helpers = int(val)
+        if key == 'max_concurrent_api_requests':
+            _max_concurrent_api_requests = int(val)
+        if key == 'host_max_concurrent_api_requests':
+            _host_max_concurrent_api_requests = int(val)
+        if key == 'host_lock_dir':
+            _host_lock_dir = val
+        if key == 'host_slot_wait_seconds':
+            _host_slot_wait_seconds = int(val)
+        if key == 'block_cache_size_mb':
+            _block_cache_size_mb = int(val)
+        if key == 'block_cache_block_size_kb':
+            _block_cache_block_size_kb = int(val)
+        if key == 'read_ahead_max_kb':
+            _read_ahead_max_kb = int(val)
+        if key == 'recursive_directory_sizes':
+            _recursive_directory_sizes = (val == 'True')
+        if key == 'directory_sizes_cache_time_seconds':
+            _directory_sizes_cache_time_seconds = int(val)
+        if key == 'content_backend':
+            _content_backend = val
+        if key == 'http_range_fetch_size_kb':
+            _http_range_fetch_size_kb = int(val)
+        if key == 'http_parallel_range_fetches':
+            _http_parallel_range_fetches = int(val)
+        if key == 'api_key_file':
+            _api_key_file = val
+        if key == 'disk_cache_dir':
+            _disk_cache_dir = val
+        if key == 'disk_cache_size_mb':
+            _disk_cache_size_mb = int(val)
+        if key == 'disk_cache_block_size_kb':
+            _disk_cache_block_size_kb = int(val)
+        if key == 'disk_cache_locations':
+            _disk_cache_locations = val.replace(' ', '')
+        if key == 'namespace_index':
+            _namespace_index = (val == 'True')
+        if key == 'namespace_index_cache_time_seconds':
+            _namespace_index_cache_time_seconds = int(val)
+        if key == 'trace_file':
+            _trace_file = val
+        if key == 'transfer_log_file':
+            _transfer_log_file = val
+        if key == 'transfer_idle_seconds':
+            _transfer_idle_seconds = int(val)
+        if key == 'dataset_directory_descriptors':
+            _dataset_directory_descriptors = (val == 'True')
+        if key == 'speculative_open':
+            _speculative_open = (val == 'True')
+        if key == 'speculative_open_max_concurrent':
+            _speculative_open_max_concurrent = int(val)
+        if key == 'speculative_open_expiry_seconds':
+            _speculative_open_expiry_seconds = int(val)
+        if key == 'adaptive_cache_times':
+            _adaptive_cache_times = (val == 'True')
+        if key == 'adaptive_cache_time_max_seconds':
+            _adaptive_cache_time_max_seconds = int(val)
+        if key == 'adaptive_cache_time_age_fraction':
+            _adaptive_cache_time_age_fraction = float(val)
+        if key == 'io_throttle_mb_per_s':
+            _io_throttle_mb_per_s = int(val)
+        if key == 'io_throttle_iops':
+            _io_throttle_iops = int(val)
+        if key == 'host_io_throttle_mb_per_s':
+            _host_io_throttle_mb_per_s = int(val)
+        if key == 'host_io_throttle_iops':
+            _host_io_throttle_iops = int(val)
+        if key == 'io_throttle_interactive_kb':
+            _io_throttle_interactive_kb = int(val)
+        if key == 'control_socket_dir':
+            _control_socket_dir = val
+        if key == 'lazy_subdirectories':
+            _lazy_subdirectories = (val == 'True')
+        if key == 'batch_dataset_listings':
+            _batch_dataset_listings = (val == 'True')
 
 logger.info("mytardis_install_dir: " + _mytardis_install_dir)
 logger.info("mytardis_url: " + _mytardis_url)
@@ -140,6 +314,65 @@ logger.info("default_directory_size: " +
             str(_default_directory_size))
 logger.info("use_api_for_dataset_datafiles: " +
             str(_use_api_for_dataset_datafiles))
+logger.info("replica_location_priority: " + _replica_location_priority)
+logger.info("metrics_log_interval_seconds: " +
+            str(_metrics_log_interval_seconds))
+logger.info("session_check_interval_seconds: " +
+            str(_session_check_interval_seconds))
+logger.info("recent_views: " + _recent_views)
+logger.info("by_date_view: " + str(_by_date_view))
+logger.info("views_cache_time_seconds: " + str(_views_cache_time_seconds))
+logger.info("max_concurrent_helpers: " + str(_max_concurrent_helpers))
+logger.info("max_concurrent_api_requests: " +
+            str(_max_concurrent_api_requests))
+logger.info("host_max_concurrent_api_requests: " +
+            str(_host_max_concurrent_api_requests))
+logger.info("host_lock_dir: " + _host_lock_dir)
+logger.info("host_slot_wait_seconds: " + str(_host_slot_wait_seconds))
+logger.info("block_cache_size_mb: " + str(_block_cache_size_mb))
+logger.info("block_cache_block_size_kb: " + str(_block_cache_block_size_kb))
+logger.info("read_ahead_max_kb: " + str(_read_ahead_max_kb))
+logger.info("recursive_directory_sizes: " + str(_recursive_directory_sizes))
+logger.info("directory_sizes_cache_time_seconds: " +
+            str(_directory_sizes_cache_time_seconds))
+logger.info("content_backend: " + _content_backend)
+logger.info("http_range_fetch_size_kb: " + str(_http_range_fetch_size_kb))
+logger.info("http_parallel_range_fetches: " +
+            str(_http_parallel_range_fetches))
+logger.info("api_key_file: " + _api_key_file)
+logger.info("disk_cache_dir: " + _disk_cache_dir)
+logger.info("disk_cache_size_mb: " + str(_disk_cache_size_mb))
+logger.info("disk_cache_block_size_kb: " + str(_disk_cache_block_size_kb))
+logger.info("disk_cache_locations: " + _disk_cache_locations)
+logger.info("namespace_index: " + str(_namespace_index))
+logger.info("namespace_index_cache_time_seconds: " +
+            str(_namespace_index_cache_time_seconds))
+logger.info("trace_file: " + _trace_file)
+logger.info("transfer_log_file: " + _transfer_log_file)
+logger.info("transfer_idle_seconds: " + str(_transfer_idle_seconds))
+logger.info("dataset_directory_descriptors: " +
+            str(_dataset_directory_descriptors))
+logger.info("speculative_open: " + str(_speculative_open))
+logger.info("speculative_open_max_concurrent: " +
+            str(_speculative_open_max_concurrent))
+logger.info("speculative_open_expiry_seconds: " +
+            str(_speculative_open_expiry_seconds))
+logger.info("adaptive_cache_times: " + str(_adaptive_cache_times))
+logger.info("adaptive_cache_time_max_seconds: " +
+            str(_adaptive_cache_time_max_seconds))
+logger.info("adaptive_cache_time_age_fraction: " +
+            str(_adaptive_cache_time_age_fraction))
+logger.info("io_throttle_mb_per_s: " + str(_io_throttle_mb_per_s))
+logger.info("io_throttle_iops: " + str(_io_throttle_iops))
+logger.info("host_io_throttle_mb_per_s: " + str(_host_io_throttle_mb_per_s))
+logger.info("host_io_throttle_iops: " + str(_host_io_throttle_iops))
+logger.info("io_throttle_interactive_kb: " + str(_io_throttle_interactive_kb))
+logger.info("control_socket_dir: " + _control_socket_dir)
+logger.info("lazy_subdirectories: " + str(_lazy_subdirectories))
+logger.info("batch_dataset_listings: " + str(_batch_dataset_listings))
+
+if _trace_file != "":
+    optrace.start_recording(_trace_file)
 
 if sys.argv[1].startswith("-"):
     argv = sys.argv[1:]
@@ -157,7 +390,7 @@ for opt, arg in opts:
     if opt == '-h' or opt == '--help':
         print ""
         print "Usage: mytardisfs mountpoint [options]"
-        print "  e.g. mytardisfs ~/MyTardis -f -o direct_io"
+        print "  e.g. mytardisfs ~/MyTardis -f -o direct_io,use_ino"
         print """
 General options:
     -h   --help            print help
@@ -264,11 +497,26 @@ if not os.path.exists(fuse_mount_dir):
     os.makedirs(fuse_mount_dir)
 
 mytardis_username = getpass.getuser()
-proc = subprocess.Popen(["sudo", "-n", "-u", "mytardis", "_myapikey",
-                         _mytardis_install_dir, _auth_provider],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-stdout, stderr = proc.communicate()
-if proc.returncode != 0:
+if _api_key_file != "":
+    # Off the MyTardis server (e.g. on a transfer node using
+    # content_backend = http), the API key can be read from a file
+    # containing "ApiKey username:apikey", as output by _myapikey.
+    try:
+        with open(os.path.expanduser(_api_key_file), 'r') as api_key_file:
+            stdout = api_key_file.read()
+        stderr = ""
+        returncode = 0
+    except IOError, e:
+        stdout = ""
+        stderr = str(e)
+        returncode = 1
+else:
+    proc = subprocess.Popen(["sudo", "-n", "-u", "mytardis", "_myapikey",
+                             _mytardis_install_dir, _auth_provider],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    returncode = proc.returncode
+if returncode != 0:
     message = "Attempting to retrieve your MyTardis API key " + \
         "as the 'mytardis' user failed.\n\n" + \
         "Please ensure that you have read the instructions " + \
@@ -297,15 +545,190 @@ _gid = proc.stdout.read().strip()
 _headers = {'Authorization': 'ApiKey ' + mytardis_username + ":" +
             mytardis_apikey}
 
+# Limits on concurrent sudo helper processes and API requests for this
+# mount, and (cooperatively) on API requests from all mounts on this
+# host.  The host-wide limit on helpers is taken by the helpers
+# themselves (see bootstrap.py):
+HELPER_SCHEDULER = BackendScheduler("helpers", _max_concurrent_helpers)
+API_SCHEDULER = BackendScheduler("api", _max_concurrent_api_requests,
+                                 _host_max_concurrent_api_requests,
+                                 _host_lock_dir, _host_slot_wait_seconds)
+
+
+# Each backend call gets a correlation ID, which is passed to the sudo
+# helpers (see phases.py) and recorded with its trace span:
+CORRELATION_IDS = itertools.count(1)
+
+
+def new_correlation_id():
+    return "%x-%x" % (os.getpid(), next(CORRELATION_IDS))
+
+
+def record_phases(name, phase_times, total_seconds, trace_span=None):
+    # Records the phases reported by a helper in the metrics (and trace),
+    # counting any time not accounted for by them as "spawn" (sudo and
+    # Python start-up).
+    spawn_seconds = total_seconds - sum(seconds for _, seconds in phase_times)
+    phase_times = [("spawn", max(0.0, spawn_seconds))] + phase_times
+    for phase, seconds in phase_times:
+        metrics.record_time("%s.%s" % (name, phase), seconds)
+    if trace_span is not None:
+        trace_span.fields['phases'] = dict(phase_times)
+
+
+def helper_env(correlation_id, priority):
+    env = dict(os.environ)
+    env[phases.CORRELATION_ID_VARIABLE] = correlation_id
+    env[PRIORITY_VARIABLE] = str(priority)
+    return env
+
+
+def run_helper(cmd, priority=PRIORITY_INTERACTIVE):
+    with HELPER_SCHEDULER.slot(priority):
+        # cmd is ['sudo', '-n', '-u', 'mytardis', helper, args...]
+        helper = os.path.basename(cmd[4])
+        correlation_id = new_correlation_id()
+        with optrace.span("backend", "helper", helper=helper, args=cmd[7:],
+                          id=correlation_id) as trace_span:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    env=helper_env(correlation_id,
+                                                   priority))
+            stdout, stderr = proc.communicate()
+            trace_span.fields['r'] = proc.returncode
+            phase_times, stderr = phases.parse_phases(stderr)
+            record_phases("helper." + helper, phase_times,
+                          time.time() - trace_span.start_time, trace_span)
+        return stdout, stderr
+
+
+def stream_helper(cmd, priority=PRIORITY_INTERACTIVE):
+    # Like run_helper, but yields the helper's STDOUT line by line, as it
+    # is produced.  STDERR is logged once the helper has finished.
+    with HELPER_SCHEDULER.slot(priority):
+        helper = os.path.basename(cmd[4])
+        correlation_id = new_correlation_id()
+        with optrace.span("backend", "helper", helper=helper, args=cmd[7:],
+                          id=correlation_id) as trace_span:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    env=helper_env(correlation_id,
+                                                   priority))
+            completed = False
+            try:
+                # (Iterating over proc.stdout directly would read ahead.)
+                for line in iter(proc.stdout.readline, ""):
+                    yield line
+                completed = True
+            finally:
+                if not completed:
+                    proc.kill()
+                stderr = proc.stderr.read()
+                trace_span.fields['r'] = proc.wait()
+                phase_times, stderr = phases.parse_phases(stderr)
+                record_phases("helper." + helper, phase_times,
+                              time.time() - trace_span.start_time,
+                              trace_span)
+                if stderr != "":
+                    logger.info(stderr)
+
+
+# One pooled HTTP session for all API requests:
+API_SESSION = requests.Session()
+API_SESSION.headers.update(_headers)
+
+
+def api_get(url, priority=PRIORITY_INTERACTIVE, headers=None):
+    with API_SCHEDULER.slot(priority):
+        correlation_id = new_correlation_id()
+        headers = dict(headers or dict())
+        headers['X-Correlation-ID'] = correlation_id
+        with optrace.span("backend", "api", url=url,
+                          id=correlation_id) as trace_span:
+            response = API_SESSION.get(url=url, headers=headers)
+            trace_span.fields['r'] = response.status_code
+        return response
+
+# Validators (ETag, Last-Modified and a hash of the content) from the
+# last successful response for each listing URL, or for each helper
+# listing, so that unchanged listings don't need to be rebuilt:
+LISTING_VALIDATORS = dict()
+
+
+def listing_changed(key, content, content_hash=None):
+    # Returns False if content is the same as last time, for listings
+    # which don't support conditional requests.  (content_hash can be
+    # given instead, for listings which are hashed as they arrive.)
+    if content_hash is None:
+        content_hash = hashlib.sha1(content).hexdigest()
+    validators = LISTING_VALIDATORS.setdefault(key, dict())
+    if validators.get('content_hash') == content_hash:
+        metrics.increment("listings.unchanged")
+        return False
+    validators['content_hash'] = content_hash
+    return True
+
+
+def api_get_listing(url, priority=PRIORITY_INTERACTIVE):
+    # Returns the response for an API listing, or None if the listing
+    # hasn't changed since the last time it was requested, either
+    # because the server responded with 304 Not Modified, or because
+    # the response body is identical.
+    validators = LISTING_VALIDATORS.get(url, dict())
+    headers = dict()
+    if validators.get('etag') is not None:
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified') is not None:
+        headers['If-Modified-Since'] = validators['last_modified']
+    response = api_get(url, priority, headers)
+    if response.status_code == 304:
+        metrics.increment("listings.not_modified")
+        return None
+    if response.status_code < 200 or response.status_code >= 300:
+        return response
+    # Store the new validators even if the body hasn't changed, in case
+    # the server has changed them, so later requests can still get 304s.
+    validators = LISTING_VALIDATORS.setdefault(url, dict())
+    validators['etag'] = response.headers.get('ETag')
+    validators['last_modified'] = response.headers.get('Last-Modified')
+    if not listing_changed(url, response.content):
+        return None
+    return response
+
 LAST_QUERY_TIME = dict()
 LAST_QUERY_TIME['experiments'] = datetime.fromtimestamp(0)
 
+# Per-listing cache times, if adaptive_cache_times is enabled:
+ADAPTIVE_TTLS = None
+if _adaptive_cache_times:
+    ADAPTIVE_TTLS = AdaptiveTtls(_adaptive_cache_time_max_seconds,
+                                 _adaptive_cache_time_age_fraction)
+
+
+def listing_cache_time(key):
+    # The configured cache time for a LAST_QUERY_TIME key.
+    if key == 'experiments':
+        return _experiments_list_cache_time_seconds
+    if key.endswith('_datasets'):
+        return _experiment_datasets_cache_time_seconds
+    return _dataset_datafiles_cache_time_seconds
+
+
+def listing_refreshed(key, changed, modified=None):
+    # Records that the listing for key has just been queried, and
+    # whether it had changed since the last query.
+    LAST_QUERY_TIME[key] = datetime.now()
+    LIVE_LISTINGS.add(key)
+    if ADAPTIVE_TTLS is not None:
+        ADAPTIVE_TTLS.record_refresh(key, key.split('_')[-1], changed,
+                                     listing_cache_time(key), modified)
+
 fuse.fuse_python_api = (0, 2)
 
 # Timestamps obtained from MyTardis queries will be used
-# if available.
-# Start-up time of this FUSE process is the default
-# timestamp for everything:
+# if available (see dataset_timestamp).
+# Start-up time of this FUSE process is the last resort
+# default timestamp:
 _file_default_timestamp = int(time.time())
 
 
@@ -314,7 +737,7 @@ class DirEntry():
                  accessed=_file_default_timestamp,
                  modified=_file_default_timestamp,
                  created=_file_default_timestamp,
-                 nlink=0):
+                 nlink=0, link_target=None, inode=0):
         self.file_path = file_path
         self.size_in_bytes = size_in_bytes
         self.is_directory = is_directory
@@ -322,6 +745,8 @@ class DirEntry():
         self.modified = modified
         self.created = created
         self.nlink = nlink
+        self.link_target = link_target
+        self.inode = inode
 
         if self.nlink == 0:
             if self.is_directory:
@@ -350,18 +775,66 @@ class DirEntry():
     def get_nlink(self):
         return self.nlink
 
+    def get_link_target(self):
+        return self.link_target
+
+    def get_inode(self):
+        return self.inode
+
+    def get_file_type(self):
+        if self.is_directory:
+            return stat.S_IFDIR
+        if self.link_target is not None:
+            return stat.S_IFLNK
+        return stat.S_IFREG
+
 # FILES[file_path] = \
 #     DirEntry(file_path, size_in_bytes, is_directory,
-#              accessed, modified, created, nlink)
+#              accessed, modified, created, nlink, link_target, inode)
 FILES = dict()
+# Memory-mapped index of the user's whole hierarchy (namespace_index),
+# see load_namespace_index:
+NAMESPACE_INDEX = None
+# LAST_QUERY_TIME keys of the listings which have been queried from
+# MyTardis, rather than only read from the namespace index:
+LIVE_LISTINGS = set()
+# When NAMESPACE_INDEX was last reloaded (or a reload was attempted):
+NAMESPACE_INDEX_RELOAD_TIME = time.time()
 DATAFILE_IDS = dict()
 DATAFILE_SIZES = dict()
 DATAFILE_FILE_OBJECTS = dict()
 DATAFILE_CLOSE_TIMERS = dict()
+# Latest modification time of any datafile seen in each dataset:
+DATASET_TIMESTAMPS = dict()
+
+# Inode numbers are derived from MyTardis IDs (or from paths, for
+# subdirectories and virtual views), so that they are the same each
+# time the filesystem is mounted.  The top 8 bits give the entry type.
+# Mount with "-o use_ino" for the kernel to use them.
+ROOT_INODE = 1
+
+
+def experiment_inode(experiment_id):
+    return (1 << 56) | int(experiment_id)
+
+
+def dataset_inode(experiment_id, dataset_id):
+    # A dataset can belong to more than one experiment.
+    return (2 << 56) | ((int(experiment_id) & 0xffffff) << 32) | \
+        (int(dataset_id) & 0xffffffff)
+
+
+def datafile_inode(experiment_id, datafile_id):
+    return (3 << 56) | ((int(experiment_id) & 0xfffff) << 36) | \
+        (int(datafile_id) & 0xfffffffff)
+
+
+def path_inode(key):
+    return (4 << 56) | int(hashlib.md5(key).hexdigest()[:14], 16)
 
 url = _mytardis_url + "/api/v1/experiment/?format=json&limit=0"
 logger.info(url)
-response = requests.get(url=url, headers=_headers)
+response = api_get_listing(url)
 if response.status_code < 200 or response.status_code >= 300:
     logger.info("Response status_code = " + str(response.status_code))
 exp_records_json = response.json()
@@ -375,9 +848,7 @@ cmd = ['sudo', '-n', '-u', 'mytardis',
        '/usr/local/bin/_countexpdatasets',
        _mytardis_install_dir, _auth_provider]
 logger.info(str(cmd))
-proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-stdout, stderr = proc.communicate()
+stdout, stderr = run_helper(cmd)
 if stderr is not None and stderr != "":
     logger.info(stderr)
 try:
@@ -407,7 +878,8 @@ for exp_record_json in exp_records_json['objects']:
                  accessed=exp_created_timestamp,
                  modified=exp_created_timestamp,
                  created=exp_created_timestamp,
-                 nlink=nlink)
+                 nlink=nlink,
+                 inode=experiment_inode(exp_record_json['id']))
     FILES[exp_dir_entry.get_file_path()] = exp_dir_entry
 
 max_exp_created_timestamp = \
@@ -419,11 +891,42 @@ root_dir_entry = \
              accessed=max_exp_created_timestamp,
              modified=max_exp_created_timestamp,
              created=max_exp_created_timestamp,
-             nlink=int(num_exp_records_found)+2)
+             nlink=int(num_exp_records_found)+2,
+             inode=ROOT_INODE)
 FILES[root_dir_entry.get_file_path()] = root_dir_entry
 # logger.info("FILES['/'] = " + str(FILES['/']))
 
-LAST_QUERY_TIME['experiments'] = datetime.now()
+# Virtual views of recently added data, e.g. /.recent/24h/ and
+# /.by-date/2014-05/, containing symbolic links to datafiles within the
+# usual /experiment/dataset/ hierarchy.
+RECENT_VIEWS_DIR = '/.recent'
+BY_DATE_VIEW_DIR = '/.by-date'
+if _recent_views != "":
+    FILES[RECENT_VIEWS_DIR] = \
+        DirEntry(file_path=RECENT_VIEWS_DIR,
+                 size_in_bytes=_default_directory_size, is_directory=True,
+                 accessed=max_exp_created_timestamp,
+                 modified=max_exp_created_timestamp,
+                 created=max_exp_created_timestamp,
+                 inode=path_inode(RECENT_VIEWS_DIR))
+    for recent_view in _recent_views.split(','):
+        FILES[RECENT_VIEWS_DIR + '/' + recent_view] = \
+            DirEntry(file_path=RECENT_VIEWS_DIR + '/' + recent_view,
+                     size_in_bytes=_default_directory_size, is_directory=True,
+                     accessed=max_exp_created_timestamp,
+                     modified=max_exp_created_timestamp,
+                     created=max_exp_created_timestamp,
+                     inode=path_inode(RECENT_VIEWS_DIR + '/' + recent_view))
+if _by_date_view:
+    FILES[BY_DATE_VIEW_DIR] = \
+        DirEntry(file_path=BY_DATE_VIEW_DIR,
+                 size_in_bytes=_default_directory_size, is_directory=True,
+                 accessed=max_exp_created_timestamp,
+                 modified=max_exp_created_timestamp,
+                 created=max_exp_created_timestamp,
+                 inode=path_inode(BY_DATE_VIEW_DIR))
+
+listing_refreshed('experiments', True)
 
 
 def file_array_to_list(files):
@@ -438,10 +941,1419 @@ def file_array_to_list(files):
     return l
 
 
+def parse_timestamp(time_string):
+    # Returns None if time_string can't be parsed.
+    try:
+        return int(time.mktime(dateutil.parser.parse(time_string)
+                               .timetuple()))
+    except:
+        logger.debug(traceback.format_exc())
+        return None
+
+
+def dataset_timestamp(exp_dir_name, dataset_id):
+    # MyTardis datasets don't have timestamps of their own, so we use the
+    # latest datafile modification time seen in the dataset, or else the
+    # experiment's creation time, which (unlike the start-up time of this
+    # process) stays the same from one mount to the next.
+    if dataset_id in DATASET_TIMESTAMPS:
+        return DATASET_TIMESTAMPS[dataset_id]
+    if '/' + exp_dir_name in FILES:
+        return FILES['/' + exp_dir_name].get_modified()
+    return _file_default_timestamp
+
+
+def new_dataset_dir_entry(exp_dir_name, dataset_dir_name):
+    experiment_id = exp_dir_name.split("-")[0]
+    dataset_id = dataset_dir_name.split("-")[0]
+    timestamp = dataset_timestamp(exp_dir_name, dataset_id)
+    return DirEntry(file_path='/' + exp_dir_name + '/' + dataset_dir_name,
+                    size_in_bytes=_default_directory_size,
+                    is_directory=True,
+                    accessed=timestamp,
+                    modified=timestamp,
+                    created=timestamp,
+                    inode=dataset_inode(experiment_id, dataset_id))
+
+
+def add_datafile_entries(exp_dir_name, dataset_dir_name, dataset_id, df):
+    # Adds a datafile record (from _datasetdatafiles or from the API)
+    # to FILES, along with any intermediate subdirectories, and records
+    # its ID and size for use by MyFS.read.  Returns the datafile's path.
+    experiment_id = exp_dir_name.split("-")[0]
+    datafile_id = df['id']
+    df_directory = df['directory']
+    if df_directory is None:
+        df_directory = ""
+    else:
+        df_directory = df_directory.encode('ascii', 'ignore').strip('/')
+    df_filename = df['filename'].encode('ascii', 'ignore')
+    df_size = int(df['size'].encode('ascii', 'ignore'))
+
+    df_modification_time = parse_timestamp(df['modification_time'])
+    df_created_time = parse_timestamp(df['created_time'])
+    if df_modification_time is None:
+        df_modification_time = df_created_time
+    if df_modification_time is None:
+        df_modification_time = dataset_timestamp(exp_dir_name, dataset_id)
+    else:
+        DATASET_TIMESTAMPS[dataset_id] = \
+            max(DATASET_TIMESTAMPS.get(dataset_id, 0), df_modification_time)
+    if df_created_time is None:
+        df_created_time = df_modification_time
+
+    df_accessed_time = df_modification_time
+
+    dataset_path = '/' + exp_dir_name + '/' + dataset_dir_name
+    if dataset_path in FILES:
+        dataset_dir_entry = FILES[dataset_path]
+        if dataset_dir_entry.get_modified() < df_modification_time:
+            dataset_dir_entry.accessed = df_modification_time
+            dataset_dir_entry.modified = df_modification_time
+            dataset_dir_entry.created = df_modification_time
+
+    if df_directory != "":
+        # Intermediate subdirectories, with the latest modification
+        # time of anything they contain
+        subdirectories = df_directory.split('/')
+        for i in range(1, len(subdirectories) + 1):
+            subdirectory = '/'.join(subdirectories[:i])
+            subdir_path = dataset_path + '/' + subdirectory
+            subdir_time = df_accessed_time
+            if subdir_path in FILES and \
+                    FILES[subdir_path].get_modified() > subdir_time:
+                subdir_time = FILES[subdir_path].get_modified()
+            subdir_entry = \
+                DirEntry(file_path=subdir_path,
+                         size_in_bytes=_default_directory_size,
+                         is_directory=True,
+                         accessed=subdir_time,
+                         modified=subdir_time,
+                         created=subdir_time,
+                         inode=path_inode(str(experiment_id) + '/' +
+                                          str(dataset_id) + '/' +
+                                          subdirectory))
+            FILES[subdir_entry.get_file_path()] = subdir_entry
+        datafile_path = dataset_path + '/' + df_directory + '/' + df_filename
+    else:
+        datafile_path = dataset_path + '/' + df_filename
+
+    datafile_entry = \
+        DirEntry(file_path=datafile_path,
+                 size_in_bytes=df_size,
+                 is_directory=False,
+                 accessed=df_accessed_time,
+                 modified=df_modification_time,
+                 created=df_created_time,
+                 inode=datafile_inode(experiment_id, datafile_id))
+    FILES[datafile_entry.get_file_path()] = datafile_entry
+
+    register_datafile(dataset_id, df_directory, df_filename, datafile_id,
+                      df_size)
+
+    return datafile_path
+
+
+def register_datafile(dataset_id, df_directory, df_filename, datafile_id,
+                      df_size):
+    # Records a datafile's ID and size for use by MyFS.read.
+    DATAFILE_IDS.setdefault(dataset_id, dict()) \
+        .setdefault(df_directory, dict())[df_filename] = datafile_id
+    DATAFILE_SIZES.setdefault(dataset_id, dict()) \
+        .setdefault(df_directory, dict())[df_filename] = df_size
+    dfodict = DATAFILE_FILE_OBJECTS.setdefault(dataset_id, dict()) \
+        .setdefault(df_directory, dict())
+    if df_filename not in dfodict:
+        dfodict[df_filename] = None
+    dctdict = DATAFILE_CLOSE_TIMERS.setdefault(dataset_id, dict()) \
+        .setdefault(df_directory, dict())
+    if df_filename not in dctdict:
+        dctdict[df_filename] = None
+
+
 def file_from_key(key):
     return key.rsplit(os.sep)[-1]
 
 
+def expire_listing(key):
+    LAST_QUERY_TIME[key] = datetime.fromtimestamp(0)
+    if ADAPTIVE_TTLS is not None:
+        ADAPTIVE_TTLS.reset(key)
+
+
+def expire_dataset_listings(dataset_id):
+    # Including the listings of the dataset's subdirectories (see
+    # lazy_subdirectories).
+    expire_listing(dataset_id + '_datafiles')
+    for key in LAST_QUERY_TIME.keys():
+        if key.startswith(dataset_id + ':'):
+            expire_listing(key)
+
+
+def handle_invalidation(events):
+    # Expires the listings affected by a burst of events from the control
+    # socket (see invalidation.py), so that they are queried again the
+    # next time they are needed.
+    logger.info("Invalidation events: " + str(events))
+    for event in events:
+        if event['kind'] == 'experiment':
+            expire_listing('experiments')
+            expire_listing(str(event['id']) + '_datasets')
+        if event['kind'] == 'dataset':
+            expire_dataset_listings(str(event['id']))
+        if event['kind'] == 'datafile':
+            expire_dataset_listings(str(event['dataset_id']))
+        if event['kind'] != 'experiment' and 'experiment_id' in event:
+            expire_listing(str(event['experiment_id']) + '_datasets')
+    # The recent views and directory sizes may have changed too.
+    for key in LAST_QUERY_TIME.keys():
+        if key.endswith('_view'):
+            LAST_QUERY_TIME[key] = datetime.fromtimestamp(0)
+    LAST_QUERY_TIME.pop('directory_sizes', None)
+
+
+def listing_expired(key, cache_time_seconds):
+    if ADAPTIVE_TTLS is not None:
+        cache_time_seconds = ADAPTIVE_TTLS.ttl(key, cache_time_seconds)
+    if key not in LAST_QUERY_TIME:
+        # Listings which haven't been queried since the namespace index
+        # was built are as fresh as the index.
+        return NAMESPACE_INDEX is None or \
+            time.time() - NAMESPACE_INDEX.build_time > \
+            _namespace_index_cache_time_seconds
+    return datetime.now() - LAST_QUERY_TIME[key] > \
+        timedelta(seconds=cache_time_seconds)
+
+
+def refresh_directory(path, priority=PRIORITY_INTERACTIVE, on_datafile=None):
+    # Queries MyTardis for the contents of path (the experiments list,
+    # an experiment's datasets or a dataset's datafiles), unless the
+    # cached listing in FILES is still fresh.  For a dataset, if
+    # on_datafile is given, the datafiles are streamed from the helper,
+    # and on_datafile(datafile_path) is called as each one is added.
+    pathComponents = path.split(os.sep, 3)
+    if pathComponents == ['', '']:
+        pathComponents = ['']
+    if len(pathComponents) > 1 and pathComponents[1] != '':
+        exp_dir_name = pathComponents[1]
+        experiment_id = exp_dir_name.split("-")[0]
+    if len(pathComponents) > 2 and pathComponents[2] != '':
+        dataset_dir_name = pathComponents[2]
+        dataset_id = dataset_dir_name.split("-")[0]
+
+    if len(pathComponents) == 1:
+        refresh_experiments(priority)
+
+    if len(pathComponents) == 2 and pathComponents[1] != '':
+        refresh_experiment_datasets(exp_dir_name, experiment_id, priority)
+        if _batch_dataset_listings and not _use_api_for_dataset_datafiles:
+            start_batch_listing(exp_dir_name, experiment_id)
+
+    if len(pathComponents) == 3 and pathComponents[1] != '':
+        refresh_dataset_datafiles(exp_dir_name, experiment_id,
+                                  dataset_dir_name, dataset_id, priority,
+                                  on_datafile)
+
+    if len(pathComponents) == 4 and lazy_subdirectories():
+        refresh_dataset_datafiles(exp_dir_name, experiment_id,
+                                  dataset_dir_name, dataset_id, priority,
+                                  on_datafile, pathComponents[3])
+
+
+def refresh_experiments(priority=PRIORITY_INTERACTIVE):
+    if not listing_expired('experiments',
+                           _experiments_list_cache_time_seconds):
+        return
+    url = _mytardis_url + "/api/v1/experiment/?format=json&limit=0"
+    logger.info(url)
+    response = api_get_listing(url, priority)
+    if response is None:
+        # The experiments list hasn't changed.
+        listing_refreshed('experiments', False)
+        return
+    if response.status_code < 200 or response.status_code >= 300:
+        logger.info("Response status_code = " +
+                    str(response.status_code))
+    exp_records_json = response.json()
+    if response.status_code < 200 or response.status_code >= 300:
+        logger.info(exp_records_json)
+    num_exp_records_found = exp_records_json['meta']['total_count']
+    logger.info(str(num_exp_records_found) +
+                " experiment record(s) found for user " +
+                mytardis_username)
+
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_countexpdatasets',
+           _mytardis_install_dir, _auth_provider]
+    logger.info(str(cmd))
+    stdout, stderr = run_helper(cmd, priority)
+    if stderr is not None and stderr != "":
+        logger.info(stderr)
+    try:
+        expdatasetcounts = ast.literal_eval(stdout.strip())
+    except:
+        expdatasetcounts = dict()
+
+    # Doesn't check for deleted experiments,
+    # only adds to FILES dictionary.
+    max_exp_created_time = datetime.fromtimestamp(0)
+    for exp_record_json in exp_records_json['objects']:
+        exp_dir_name = str(exp_record_json['id']) + "-" + \
+            (exp_record_json['title'].encode('ascii', 'ignore')
+                .replace(" ", "_"))
+        exp_created_time = \
+            dateutil.parser.parse(exp_record_json['created_time'])
+        if exp_created_time > max_exp_created_time:
+            max_exp_created_time = exp_created_time
+        exp_created_timestamp = \
+            int(time.mktime(exp_created_time.timetuple()))
+
+        nlink = 2
+        if exp_record_json['id'] in expdatasetcounts.keys():
+            num_datasets = expdatasetcounts[exp_record_json['id']]
+            nlink = num_datasets + 2
+
+        exp_dir_entry = \
+            DirEntry(file_path='/'+exp_dir_name,
+                     size_in_bytes=_default_directory_size,
+                     is_directory=True,
+                     accessed=exp_created_timestamp,
+                     modified=exp_created_timestamp,
+                     created=exp_created_timestamp,
+                     nlink=nlink,
+                     inode=experiment_inode(exp_record_json['id']))
+        FILES[exp_dir_entry.get_file_path()] = exp_dir_entry
+    max_exp_created_timestamp = \
+        int(time.mktime(max_exp_created_time.timetuple()))
+    root_dir_entry = \
+        DirEntry(file_path='/',
+                 size_in_bytes=_default_directory_size,
+                 is_directory=True,
+                 accessed=max_exp_created_timestamp,
+                 modified=max_exp_created_timestamp,
+                 created=max_exp_created_timestamp,
+                 nlink=int(num_exp_records_found)+2,
+                 inode=ROOT_INODE)
+    FILES[root_dir_entry.get_file_path()] = root_dir_entry
+    listing_refreshed('experiments', True)
+
+
+def refresh_experiment_datasets(exp_dir_name, experiment_id,
+                                priority=PRIORITY_INTERACTIVE):
+    if not listing_expired(experiment_id + '_datasets',
+                           _experiment_datasets_cache_time_seconds):
+        return
+    url = _mytardis_url + \
+        "/api/v1/dataset/?format=json&limit=0&experiments__id=" + \
+        experiment_id
+    logger.info(url)
+    response = api_get_listing(url, priority)
+    if response is None:
+        # This experiment's datasets haven't changed.
+        listing_refreshed(experiment_id + '_datasets', False)
+        return
+    if response.status_code < 200 or response.status_code >= 300:
+        logger.info("Response status_code = " +
+                    str(response.status_code))
+    dataset_records_json = response.json()
+    if response.status_code < 200 or response.status_code >= 300:
+        logger.info(dataset_records_json)
+    num_dataset_records_found = \
+        dataset_records_json['meta']['total_count']
+    logger.info(str(num_dataset_records_found) +
+                " dataset record(s) found for exp ID " +
+                experiment_id)
+
+    for dataset_json in dataset_records_json['objects']:
+        dataset_dir_name = str(dataset_json['id']) + "-" + \
+            (dataset_json['description'].encode('ascii', 'ignore')
+                .replace(" ", "_"))
+        dataset_dir_entry = \
+            new_dataset_dir_entry(exp_dir_name, dataset_dir_name)
+        FILES[dataset_dir_entry.get_file_path()] = dataset_dir_entry
+    if '/' + exp_dir_name in FILES:
+        FILES['/' + exp_dir_name].nlink = int(num_dataset_records_found) + 2
+
+    listing_refreshed(experiment_id + '_datasets', True)
+
+
+def lazy_subdirectories():
+    # Subdirectories can only be listed one at a time by the helper.
+    return _lazy_subdirectories and not _use_api_for_dataset_datafiles
+
+
+def dataset_listing_key(dataset_id, level=None):
+    # The LAST_QUERY_TIME key for a dataset's listing, or for one of its
+    # subdirectories' listings (see lazy_subdirectories).
+    if level is None or level == "":
+        return dataset_id + '_datafiles'
+    return dataset_id + ':' + level + '_datafiles'
+
+
+def refresh_dataset_datafiles(exp_dir_name, experiment_id, dataset_dir_name,
+                              dataset_id, priority=PRIORITY_INTERACTIVE,
+                              on_datafile=None, level=None):
+    # If lazy_subdirectories is enabled, only the datafiles and
+    # subdirectories directly within level (a subdirectory of the
+    # dataset, or "" for the dataset itself) are listed.
+    if lazy_subdirectories() and level is None:
+        level = ""
+    listing_key = dataset_listing_key(dataset_id, level)
+    batch_listed = BATCH_PENDING.get(dataset_id)
+    if batch_listed is not None and (level is None or level == ""):
+        # This dataset is being listed by start_batch_listing.
+        batch_listed.wait()
+    if not listing_expired(listing_key,
+                           _dataset_datafiles_cache_time_seconds):
+        return
+
+    if _use_api_for_dataset_datafiles:
+        url = _mytardis_url + \
+            "/api/v1/dataset_file/?format=json&limit=0&" + \
+            "dataset__id=" + str(dataset_id)
+        logger.info(url)
+        response = api_get_listing(url, priority)
+        if response is None:
+            # This dataset's datafiles haven't changed.
+            listing_refreshed(dataset_id + '_datafiles', False,
+                              DATASET_TIMESTAMPS.get(dataset_id))
+            return
+        datafile_records_json = response.json()
+        num_datafile_records_found = \
+            datafile_records_json['meta']['total_count']
+        datafile_dicts = datafile_records_json['objects']
+    elif on_datafile is not None:
+        stream_dataset_datafiles(exp_dir_name, experiment_id,
+                                 dataset_dir_name, dataset_id, on_datafile,
+                                 priority, level)
+        return
+    else:
+        cmd = ['sudo', '-n', '-u', 'mytardis',
+               '/usr/local/bin/_datasetdatafiles',
+               _mytardis_install_dir, _auth_provider,
+               experiment_id, dataset_id]
+        if level is not None:
+            cmd.append("level=" + level)
+        logger.info(str(cmd))
+        stdout, stderr = run_helper(cmd, priority)
+        if stderr is not None and stderr != "":
+            logger.info(stderr)
+
+        datafile_dicts_string = stdout.strip()
+        # logger.info("datafile_dicts_string: " +
+        #     datafile_dicts_string)
+        if not listing_changed('_datasetdatafiles ' + listing_key,
+                               datafile_dicts_string):
+            listing_refreshed(listing_key, False,
+                              DATASET_TIMESTAMPS.get(dataset_id))
+            return
+        datafile_dicts = ast.literal_eval(datafile_dicts_string)
+        num_datafile_records_found = len(datafile_dicts)
+
+    logger.info(str(num_datafile_records_found) +
+                " datafile record(s) found for dataset ID " +
+                str(dataset_id))
+
+    if level is None or level == "":
+        dataset_dir_entry = \
+            new_dataset_dir_entry(exp_dir_name, dataset_dir_name)
+        FILES[dataset_dir_entry.get_file_path()] = dataset_dir_entry
+    if level is None:
+        DATAFILE_IDS[dataset_id] = dict()
+        DATAFILE_SIZES[dataset_id] = dict()
+        DATAFILE_FILE_OBJECTS[dataset_id] = dict()
+        DATAFILE_CLOSE_TIMERS[dataset_id] = dict()
+
+    for df in datafile_dicts:
+        add_listing_record(exp_dir_name, dataset_dir_name, dataset_id, df)
+    listing_refreshed(listing_key, True,
+                      DATASET_TIMESTAMPS.get(dataset_id))
+
+
+def add_listing_record(exp_dir_name, dataset_dir_name, dataset_id, record):
+    # Adds a record from _datasetdatafiles, which is either a datafile,
+    # or (when listing one level at a time) a subdirectory, and returns
+    # its path.
+    if 'subdirectory' not in record:
+        return add_datafile_entries(exp_dir_name, dataset_dir_name,
+                                    dataset_id, record)
+    experiment_id = exp_dir_name.split("-")[0]
+    subdirectory = record['subdirectory'].encode('ascii', 'ignore')
+    subdir_path = '/' + exp_dir_name + '/' + dataset_dir_name + '/' + \
+        subdirectory
+    subdir_time = parse_timestamp(record['modification_time'])
+    if subdir_time is None:
+        subdir_time = dataset_timestamp(exp_dir_name, dataset_id)
+    subdir_entry = \
+        DirEntry(file_path=subdir_path,
+                 size_in_bytes=_default_directory_size,
+                 is_directory=True,
+                 accessed=subdir_time,
+                 modified=subdir_time,
+                 created=subdir_time,
+                 nlink=record['nlink'],
+                 inode=path_inode(str(experiment_id) + '/' +
+                                  str(dataset_id) + '/' + subdirectory))
+    FILES[subdir_path] = subdir_entry
+    return subdir_path
+
+
+# Datasets which are being listed by start_batch_listing, with an Event
+# which is set once all of the dataset's records have arrived:
+BATCH_PENDING = dict()
+BATCH_PENDING_LOCK = threading.Lock()
+
+
+def start_batch_listing(exp_dir_name, experiment_id):
+    # Lists the datafiles of all of an experiment's datasets whose
+    # listings have expired, with one "_datasetdatafiles" call in the
+    # background (if batch_dataset_listings is enabled), so that
+    # recursive traversals (e.g. rsync or find) don't need a separate
+    # call for each dataset.  Each dataset's listing is ready as soon as
+    # its records have arrived.
+    level = None
+    if lazy_subdirectories():
+        level = ""
+    dataset_dir_names = dict()
+    for name, dir_entry in directory_entries('/' + exp_dir_name):
+        dataset_id = name.split("-")[0]
+        if listing_expired(dataset_listing_key(dataset_id, level),
+                           _dataset_datafiles_cache_time_seconds):
+            dataset_dir_names[dataset_id] = name
+    with BATCH_PENDING_LOCK:
+        for dataset_id in dataset_dir_names.keys():
+            if dataset_id in BATCH_PENDING:
+                del dataset_dir_names[dataset_id]
+        if len(dataset_dir_names) == 0:
+            return
+        events = dict((dataset_id, threading.Event())
+                      for dataset_id in dataset_dir_names)
+        BATCH_PENDING.update(events)
+
+    def list_datasets():
+        try:
+            batch_list_datasets(exp_dir_name, experiment_id,
+                                dataset_dir_names, events, level)
+        except:
+            logger.error(traceback.format_exc())
+
+    thread = threading.Thread(target=list_datasets)
+    thread.daemon = True
+    thread.start()
+
+
+def batch_list_datasets(exp_dir_name, experiment_id, dataset_dir_names,
+                        events, level):
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_datasetdatafiles',
+           _mytardis_install_dir, _auth_provider, experiment_id,
+           ",".join(sorted(dataset_dir_names.keys(), key=int)), "stream"]
+    if level is not None:
+        cmd.append("level=" + level)
+    logger.info(str(cmd))
+    metrics.increment("batch_listings")
+    metrics.increment("batch_listings.datasets", len(dataset_dir_names))
+
+    def finish(dataset_id):
+        with BATCH_PENDING_LOCK:
+            if BATCH_PENDING.get(dataset_id) is events[dataset_id]:
+                del BATCH_PENDING[dataset_id]
+        events[dataset_id].set()
+
+    num_records_found = dict()
+    content_hashes = dict()
+    try:
+        for line in stream_helper(cmd, PRIORITY_BACKGROUND):
+            try:
+                record = ast.literal_eval(line.strip())
+            except:
+                record = None
+            if not isinstance(record, dict) or 'dataset_id' not in record:
+                # e.g. access denied, or a traceback
+                logger.info(line.rstrip())
+                continue
+            dataset_id = str(record.pop('dataset_id'))
+            if dataset_id not in dataset_dir_names:
+                continue
+            if record.get('done'):
+                logger.info(str(num_records_found.get(dataset_id, 0)) +
+                            " datafile record(s) found for dataset ID " +
+                            dataset_id)
+                listing_key = dataset_listing_key(dataset_id, level)
+                content_hash = content_hashes.get(dataset_id, hashlib.sha1())
+                changed = listing_changed('_datasetdatafiles batch ' +
+                                          listing_key, None,
+                                          content_hash.hexdigest())
+                listing_refreshed(listing_key, changed,
+                                  DATASET_TIMESTAMPS.get(dataset_id))
+                finish(dataset_id)
+                continue
+            content_hashes.setdefault(dataset_id, hashlib.sha1()) \
+                .update(line)
+            add_listing_record(exp_dir_name, dataset_dir_names[dataset_id],
+                               dataset_id, record)
+            num_records_found[dataset_id] = \
+                num_records_found.get(dataset_id, 0) + 1
+    finally:
+        # Datasets which weren't listed (e.g. because of an error) will be
+        # listed one at a time instead.
+        for dataset_id in dataset_dir_names:
+            if not events[dataset_id].is_set():
+                finish(dataset_id)
+
+
+def stream_dataset_datafiles(exp_dir_name, experiment_id, dataset_dir_name,
+                             dataset_id, on_datafile,
+                             priority=PRIORITY_INTERACTIVE, level=None):
+    # Adds datafile entries as "_datasetdatafiles ... stream" prints
+    # them, one record per line.  Entries for datafiles which are
+    # already known are updated in place, so reads of them can continue
+    # while the dataset is being listed.
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_datasetdatafiles',
+           _mytardis_install_dir, _auth_provider,
+           experiment_id, dataset_id, "stream"]
+    if level is not None:
+        cmd.append("level=" + level)
+    logger.info(str(cmd))
+    listing_key = dataset_listing_key(dataset_id, level)
+
+    if level is None or level == "":
+        dataset_dir_entry = \
+            new_dataset_dir_entry(exp_dir_name, dataset_dir_name)
+        FILES[dataset_dir_entry.get_file_path()] = dataset_dir_entry
+
+    num_datafile_records_found = 0
+    content_hash = hashlib.sha1()
+    for line in stream_helper(cmd, priority):
+        content_hash.update(line)
+        try:
+            df = ast.literal_eval(line.strip())
+        except:
+            df = None
+        if not isinstance(df, dict):
+            # e.g. access denied, or a traceback
+            logger.info(line.rstrip())
+            continue
+        datafile_path = add_listing_record(exp_dir_name, dataset_dir_name,
+                                           dataset_id, df)
+        num_datafile_records_found = num_datafile_records_found + 1
+        on_datafile(datafile_path)
+
+    logger.info(str(num_datafile_records_found) +
+                " datafile record(s) found for dataset ID " +
+                str(dataset_id))
+    changed = listing_changed('_datasetdatafiles stream ' + listing_key,
+                              None, content_hash.hexdigest())
+    listing_refreshed(listing_key, changed,
+                      DATASET_TIMESTAMPS.get(dataset_id))
+
+
+def is_virtual_view_path(path):
+    for view_dir in (RECENT_VIEWS_DIR, BY_DATE_VIEW_DIR):
+        if path == view_dir or path.startswith(view_dir + '/'):
+            return True
+    return False
+
+
+def recent_view_start_time(recent_view):
+    # e.g. "24h" or "7d"
+    try:
+        if recent_view.endswith('h'):
+            return datetime.now() - timedelta(hours=int(recent_view[:-1]))
+        if recent_view.endswith('d'):
+            return datetime.now() - timedelta(days=int(recent_view[:-1]))
+    except ValueError:
+        pass
+    return None
+
+
+def run_recentdatafiles(args, priority=PRIORITY_INTERACTIVE):
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_recentdatafiles',
+           _mytardis_install_dir, _auth_provider] + args
+    logger.info(str(cmd))
+    stdout, stderr = run_helper(cmd, priority)
+    if stderr is not None and stderr != "":
+        logger.info(stderr)
+    try:
+        return ast.literal_eval(stdout.strip())
+    except:
+        logger.error(stdout)
+        return None
+
+
+def add_directory_entries(path, timestamp):
+    # Adds path and any missing parent directories to FILES.
+    while path != '/' and path not in FILES:
+        FILES[path] = DirEntry(file_path=path,
+                               size_in_bytes=_default_directory_size,
+                               is_directory=True,
+                               accessed=timestamp, modified=timestamp,
+                               created=timestamp,
+                               inode=path_inode(path))
+        path = path.rsplit('/', 1)[0]
+        if path == '':
+            path = '/'
+
+
+def refresh_view_datafiles(view_path, start_time, end_time,
+                           priority=PRIORITY_INTERACTIVE):
+    # Lists datafiles created or modified between start_time and
+    # end_time with one _recentdatafiles query, and replaces the
+    # contents of view_path with symbolic links to them.
+    time_format = "%Y-%m-%dT%H:%M:%S"
+    datafile_dicts = run_recentdatafiles([start_time.strftime(time_format),
+                                          end_time.strftime(time_format)],
+                                         priority)
+    if datafile_dicts is None:
+        return
+    logger.info(str(len(datafile_dicts)) +
+                " datafile record(s) found for " + view_path)
+
+    for key in FILES.keys():
+        if key.startswith(view_path + '/'):
+            FILES.pop(key, None)
+
+    for df in datafile_dicts:
+        exp_dir_name = str(df['experiment_id']) + "-" + \
+            df['experiment_title'].encode('ascii', 'ignore').replace(" ", "_")
+        dataset_dir_name = str(df['dataset_id']) + "-" + \
+            (df['dataset_description'].encode('ascii', 'ignore')
+                .replace(" ", "_"))
+        # Register the datafile at its usual location, so that the
+        # link can be followed without listing the dataset first.
+        if '/' + exp_dir_name not in FILES:
+            continue
+        if '/' + exp_dir_name + '/' + dataset_dir_name not in FILES:
+            dataset_dir_entry = \
+                new_dataset_dir_entry(exp_dir_name, dataset_dir_name)
+            FILES[dataset_dir_entry.get_file_path()] = dataset_dir_entry
+        datafile_path = add_datafile_entries(exp_dir_name, dataset_dir_name,
+                                             str(df['dataset_id']), df)
+        datafile_entry = FILES[datafile_path]
+
+        link_path = view_path + datafile_path
+        add_directory_entries(link_path.rsplit('/', 1)[0],
+                              datafile_entry.get_modified())
+        link_target = os.path.relpath(datafile_path,
+                                      link_path.rsplit('/', 1)[0])
+        FILES[link_path] = \
+            DirEntry(file_path=link_path,
+                     size_in_bytes=len(link_target),
+                     is_directory=False,
+                     accessed=datafile_entry.get_accessed(),
+                     modified=datafile_entry.get_modified(),
+                     created=datafile_entry.get_created(),
+                     link_target=link_target,
+                     inode=path_inode(link_path))
+
+
+def refresh_virtual_view(path, priority=PRIORITY_INTERACTIVE):
+    if path not in FILES:
+        return
+    path_components = path.split('/')
+    if len(path_components) == 2 and path == BY_DATE_VIEW_DIR:
+        view_path = path
+    elif len(path_components) == 3:
+        view_path = path
+    else:
+        # Deeper levels are populated along with the view's top level.
+        return
+
+    if view_path + '_view' not in LAST_QUERY_TIME:
+        LAST_QUERY_TIME[view_path + '_view'] = datetime.fromtimestamp(0)
+    time_since_last_view_query = datetime.now() - \
+        LAST_QUERY_TIME[view_path + '_view']
+    if time_since_last_view_query < \
+            timedelta(seconds=_views_cache_time_seconds):
+        return
+
+    if view_path == BY_DATE_VIEW_DIR:
+        months = run_recentdatafiles(['months'], priority)
+        if months is None:
+            return
+        for month in months:
+            month_path = BY_DATE_VIEW_DIR + '/' + month
+            month_start = datetime.strptime(month + "-01", "%Y-%m-%d")
+            month_timestamp = int(time.mktime(month_start.timetuple()))
+            add_directory_entries(month_path, month_timestamp)
+    elif path_components[1] == RECENT_VIEWS_DIR.strip('/'):
+        start_time = recent_view_start_time(path_components[2])
+        if start_time is None:
+            return
+        # Allow for files with modification times slightly in the future:
+        end_time = datetime.now() + timedelta(days=1)
+        refresh_view_datafiles(view_path, start_time, end_time, priority)
+    else:
+        month_start = datetime.strptime(path_components[2] + "-01",
+                                        "%Y-%m-%d")
+        if month_start.month == 12:
+            month_end = month_start.replace(year=month_start.year + 1,
+                                            month=1)
+        else:
+            month_end = month_start.replace(month=month_start.month + 1)
+        refresh_view_datafiles(view_path, month_start, month_end, priority)
+
+    LAST_QUERY_TIME[view_path + '_view'] = datetime.now()
+
+
+def directory_entries(path):
+    path_depth = path.count('/')
+    prefix = path + '/'
+    if path == "/":
+        path_depth = 0
+        prefix = path
+    # FIXME: Iterating through the entire FILES dictionary is inefficient
+    # (FILES.keys() is a copy, so other threads can update FILES meanwhile.)
+    for key in FILES.keys():
+        if key == "/":
+            continue
+
+        key_depth = key.count('/')
+
+        if key.startswith(prefix) and key_depth == path_depth + 1:
+            dir_entry = FILES.get(key)
+            if dir_entry is not None:
+                yield file_from_key(key), dir_entry
+
+    # Entries in the namespace index which haven't been added to FILES,
+    # until the directory has been queried from MyTardis:
+    namespace_index = current_namespace_index()
+    if namespace_index is not None and not is_virtual_view_path(path) and \
+            path_listing_key(path) not in LIVE_LISTINGS:
+        for entry in namespace_index.children(path):
+            if entry.path not in FILES:
+                yield file_from_key(entry.path), index_dir_entry(entry)
+
+
+def path_listing_key(path):
+    # Returns the LAST_QUERY_TIME key of the listing which includes the
+    # contents of path (a directory).
+    if path == "/":
+        return 'experiments'
+    path_components = path.strip('/').split('/')
+    if len(path_components) == 1:
+        return path_components[0].split('-')[0] + '_datasets'
+    dataset_id = path_components[1].split('-')[0]
+    if len(path_components) == 2 or not lazy_subdirectories():
+        return dataset_listing_key(dataset_id)
+    return dataset_listing_key(dataset_id, '/'.join(path_components[2:]))
+
+
+def current_namespace_index():
+    # Returns NAMESPACE_INDEX, and starts reloading it in the background
+    # once it is older than namespace_index_cache_time_seconds (at most
+    # once per namespace_index_cache_time_seconds, if reloading fails).
+    global NAMESPACE_INDEX_RELOAD_TIME
+    now = time.time()
+    if NAMESPACE_INDEX is not None and \
+            now - NAMESPACE_INDEX.build_time > \
+            _namespace_index_cache_time_seconds and \
+            now - NAMESPACE_INDEX_RELOAD_TIME > \
+            _namespace_index_cache_time_seconds:
+        NAMESPACE_INDEX_RELOAD_TIME = now
+        thread = threading.Thread(target=LISTING_REQUESTS.do,
+                                  args=("namespace_index",
+                                        reload_namespace_index))
+        thread.daemon = True
+        thread.start()
+    return NAMESPACE_INDEX
+
+
+def reload_namespace_index():
+    global NAMESPACE_INDEX
+    try:
+        namespace_index = load_namespace_index(PRIORITY_BACKGROUND)
+    except:
+        logger.error(traceback.format_exc())
+        return
+    if namespace_index is None:
+        return
+    NAMESPACE_INDEX = namespace_index
+    # Forget entries which were only known from the old index, and which
+    # are no longer in the new one (e.g. deleted datasets, or experiments
+    # which are no longer shared with the user).
+    for key in FILES.keys():
+        if key == "/" or is_virtual_view_path(key):
+            continue
+        parent_path = key.rsplit('/', 1)[0] or "/"
+        if path_listing_key(parent_path) not in LIVE_LISTINGS and \
+                namespace_index.find(key) is None:
+            FILES.pop(key, None)
+    metrics.increment("namespace_index.reloads")
+
+
+def load_namespace_index(priority=PRIORITY_INTERACTIVE):
+    # Returns a NamespaceIndex of everything the user can access,
+    # exported by _namespaceindex into ~/.mytardisfs/namespace.idx, or
+    # reused from there if it is less than
+    # namespace_index_cache_time_seconds old.
+    index_path = os.path.join(os.path.expanduser("~"), ".mytardisfs",
+                              "namespace.idx")
+    if os.path.exists(index_path) and \
+            time.time() - os.path.getmtime(index_path) <= \
+            _namespace_index_cache_time_seconds:
+        try:
+            return NamespaceIndex(index_path)
+        except:
+            logger.info(traceback.format_exc())
+
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_namespaceindex',
+           _mytardis_install_dir, _auth_provider]
+    logger.info(str(cmd))
+    stdout, stderr = run_helper(cmd, priority)
+    if stderr is not None and stderr != "":
+        logger.info(stderr)
+    if not stdout.startswith(NAMESPACE_INDEX_MAGIC):
+        logger.info(stdout)
+        return None
+    if not os.path.exists(os.path.dirname(index_path)):
+        os.makedirs(os.path.dirname(index_path), 0700)
+    with open(index_path + ".tmp", 'wb') as index_file:
+        index_file.write(stdout)
+    os.rename(index_path + ".tmp", index_path)
+    return NamespaceIndex(index_path)
+
+
+def index_dir_entry(entry):
+    experiment_id = entry.experiment_id
+    if entry.kind == KIND_EXPERIMENT:
+        inode = experiment_inode(experiment_id)
+    elif entry.kind == KIND_DATASET:
+        inode = dataset_inode(experiment_id, entry.dataset_id)
+    elif entry.kind == KIND_DATAFILE:
+        inode = datafile_inode(experiment_id, entry.id)
+    else:
+        inode = path_inode(str(experiment_id) + '/' +
+                           str(entry.dataset_id) + '/' +
+                           entry.path.split('/', 3)[3])
+    if entry.kind == KIND_DATAFILE:
+        size_in_bytes = entry.size
+    else:
+        size_in_bytes = _default_directory_size
+    return DirEntry(file_path=entry.path,
+                    size_in_bytes=size_in_bytes,
+                    is_directory=(entry.kind != KIND_DATAFILE),
+                    accessed=entry.modified,
+                    modified=entry.modified,
+                    created=entry.created,
+                    nlink=entry.nlink,
+                    inode=inode)
+
+
+def lookup_file(path):
+    # Returns the DirEntry for path from FILES, or else from the
+    # namespace index, or None.
+    dir_entry = FILES.get(path)
+    if dir_entry is None and lazy_subdirectories() and \
+            path.count('/') > 3 and not is_virtual_view_path(path):
+        # The parent subdirectory may not have been listed yet.
+        parent_path = path.rsplit('/', 1)[0]
+        LISTING_REQUESTS.do(parent_path, refresh_directory, parent_path)
+        dir_entry = FILES.get(path)
+    namespace_index = current_namespace_index()
+    if dir_entry is not None or namespace_index is None or \
+            is_virtual_view_path(path):
+        return dir_entry
+    entry = namespace_index.find(path)
+    if entry is None:
+        return None
+    if entry.kind == KIND_DATAFILE:
+        df_path = entry.path.split('/', 3)[3]
+        if '/' in df_path:
+            df_directory, df_filename = df_path.rsplit('/', 1)
+        else:
+            df_directory, df_filename = "", df_path
+        register_datafile(str(entry.dataset_id), df_directory, df_filename,
+                          entry.id, entry.size)
+    return FILES.setdefault(path, index_dir_entry(entry))
+
+
+# Concurrent requests for the same listing or the same datafile's file
+# descriptor share one backend call:
+LISTING_REQUESTS = SingleFlight("listing_requests")
+FILE_DESCRIPTOR_REQUESTS = SingleFlight("file_descriptor_requests")
+
+# Listings which are still being built, keyed by path, so that a
+# directory opened while it is being listed shares the same listing.
+# Once a listing has been given to a DirectoryHandle, it stays with that
+# handle until the directory is rewound (offset 0) or closed, so its
+# readdir offsets stay valid however many other processes list the same
+# directory (see listingstream.py):
+DIRECTORY_LISTINGS = dict()
+DIRECTORY_LISTINGS_LOCK = threading.Lock()
+
+
+class DirectoryHandle():
+    # Returned by opendir, and passed to readdir and releasedir.
+    def __init__(self, path):
+        self.path = path
+        self.listing = None
+
+
+def start_listing(path):
+    # Returns a ListingStream for path, which is filled in by a
+    # background thread, so that it keeps going if the readdir call
+    # which started it stops reading (e.g. because the kernel's buffer
+    # is full).
+    listing = ListingStream()
+
+    def on_datafile(datafile_path):
+        name = datafile_path[len(path) + 1:].split('/')[0]
+        dir_entry = FILES.get(path + '/' + name)
+        if dir_entry is not None:
+            listing.add(name, dir_entry)
+
+    def build_listing():
+        try:
+            if is_virtual_view_path(path):
+                LISTING_REQUESTS.do(path, refresh_virtual_view, path)
+            else:
+                LISTING_REQUESTS.do(path, refresh_directory, path,
+                                    PRIORITY_INTERACTIVE, on_datafile)
+            for name, dir_entry in directory_entries(path):
+                listing.add(name, dir_entry)
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            listing.finish()
+            with DIRECTORY_LISTINGS_LOCK:
+                if DIRECTORY_LISTINGS.get(path) is listing:
+                    del DIRECTORY_LISTINGS[path]
+
+    thread = threading.Thread(target=build_listing)
+    thread.daemon = True
+    thread.start()
+    return listing
+
+
+def get_listing(directory_handle, offset):
+    # A readdir call at offset 0 starts a new listing for the handle,
+    # unless one is still in progress for its path, and later calls
+    # resume the handle's listing.
+    if directory_handle.listing is not None and offset > 0:
+        metrics.increment("readdir.resumed")
+        return directory_handle.listing
+    path = directory_handle.path
+    with DIRECTORY_LISTINGS_LOCK:
+        listing = DIRECTORY_LISTINGS.get(path)
+        if listing is None:
+            listing = start_listing(path)
+            DIRECTORY_LISTINGS[path] = listing
+    directory_handle.listing = listing
+    return listing
+
+# Optional cache of recently read datafile blocks (block_cache_size_mb):
+BLOCK_CACHE = None
+if _block_cache_size_mb > 0:
+    BLOCK_CACHE = BlockCache(_block_cache_size_mb * 1024 * 1024,
+                             _block_cache_block_size_kb * 1024)
+
+# Ranged HTTP reads of datafile content (content_backend = http):
+HTTP_CONTENT = None
+if _content_backend == "http":
+    HTTP_CONTENT = \
+        HttpRangeReader(_mytardis_url + "/api/v1/dataset_file/%s/download/",
+                        _headers, _http_range_fetch_size_kb * 1024,
+                        _http_parallel_range_fetches,
+                        lambda: API_SCHEDULER.slot(PRIORITY_INTERACTIVE))
+
+# Optional on-disk cache of datafile content (disk_cache_dir), in a
+# subdirectory only readable by this user:
+DISK_CACHE = None
+if _disk_cache_dir != "" and _disk_cache_size_mb > 0:
+    try:
+        DISK_CACHE = \
+            DiskCache(os.path.join(os.path.expanduser(_disk_cache_dir),
+                                   getpass.getuser()),
+                      _disk_cache_size_mb * 1024 * 1024,
+                      _disk_cache_block_size_kb * 1024)
+    except (IOError, OSError):
+        logger.error(traceback.format_exc())
+
+# Storage location names of the replicas which datafiles were opened
+# from, for deciding whether to cache their content on disk:
+DATAFILE_LOCATIONS = dict()
+
+
+def disk_cache_enabled_for(datafile_id):
+    if _disk_cache_locations == "*":
+        return True
+    return DATAFILE_LOCATIONS.get(datafile_id) in \
+        _disk_cache_locations.split(",")
+
+if _namespace_index:
+    try:
+        NAMESPACE_INDEX = load_namespace_index()
+    except:
+        logger.error(traceback.format_exc())
+
+def split_datafile_path(path):
+    # Returns (experiment_id, dataset_id, subdirectory, filename) for
+    # the path of a datafile, e.g. "/12-Exp/34-Dataset/sub/file.dat".
+    filename = path.rsplit(os.sep)[-1]
+    pathComponents = path.split(os.sep, 3)
+    experiment_id = pathComponents[1].split("-")[0]
+    dataset_id = pathComponents[2].split("-")[0]
+    if os.sep in pathComponents[3]:
+        subdirectory = pathComponents[3].rsplit(os.sep, 1)[0]
+    else:
+        subdirectory = ""
+    return experiment_id, dataset_id, subdirectory, filename
+
+
+def report_io_activity():
+    # Records that this user is reading, and returns the number of
+    # active users and the host-wide I/O budget (see ioactivity.py).
+    try:
+        stdout, stderr = run_helper(["sudo", "-n", "-u", "mytardis",
+                                     "/usr/local/bin/_ioactivity"],
+                                    PRIORITY_BACKGROUND)
+        return ast.literal_eval(stdout.strip())
+    except:
+        logger.error(traceback.format_exc())
+        return None
+
+# Bandwidth and IOPS budgets for reads from storage (io_throttle_*), and
+# a fair share of the host-wide budget (host_io_throttle_*, which
+# _ioactivity reads from the system config files) between the host's
+# users:
+if _host_io_throttle_mb_per_s > 0 or _host_io_throttle_iops > 0:
+    IO_THROTTLE = IoThrottle(_io_throttle_mb_per_s * 1024 * 1024,
+                             _io_throttle_iops, report_io_activity,
+                             _io_throttle_interactive_kb * 1024)
+else:
+    IO_THROTTLE = IoThrottle(_io_throttle_mb_per_s * 1024 * 1024,
+                             _io_throttle_iops, None,
+                             _io_throttle_interactive_kb * 1024)
+
+# A file object can be shared by several FUSE threads, so each
+# seek and read needs to be done while holding the datafile's lock:
+DATAFILE_LOCKS = dict()
+
+
+def read_file_object(datafile_id, file_object, offset, length):
+    with DATAFILE_LOCKS.setdefault(datafile_id, threading.Lock()):
+        start_time = time.time()
+        file_object.seek(offset)
+        data = file_object.read(length)
+        metrics.record_time("storage.read", time.time() - start_time)
+        return data
+
+# SEQUENTIAL_READERS[datafile_id] = [SequentialReader(...), ...], one
+# for each sequential stream of reads from an open datafile (e.g. two
+# clients downloading the same file), most recently used last, if
+# read-ahead is enabled (read_ahead_max_kb).  They are removed when the
+# datafile is closed, or when the last handle open on it is released:
+SEQUENTIAL_READERS = dict()
+SEQUENTIAL_READERS_LOCK = threading.Lock()
+MAX_SEQUENTIAL_READERS_PER_FILE = 4
+# The number of handles open on each datafile path:
+OPEN_FILE_COUNTS = dict()
+
+
+def sequential_reader(datafile_id, offset, new_reader):
+    # Returns the SequentialReader whose stream continues at offset, or
+    # else a new one from new_reader(), replacing the least recently used
+    # if there are already MAX_SEQUENTIAL_READERS_PER_FILE.
+    with SEQUENTIAL_READERS_LOCK:
+        readers = SEQUENTIAL_READERS.setdefault(datafile_id, [])
+        for reader in readers:
+            if reader.next_offset == offset:
+                readers.remove(reader)
+                break
+        else:
+            reader = new_reader()
+            if len(readers) >= MAX_SEQUENTIAL_READERS_PER_FILE:
+                readers.pop(0)
+        readers.append(reader)
+        return reader
+
+
+def schedule_file_close(dataset_id, subdirectory, filename, file_object,
+                        datafile_id, delay=30.0):
+    # Schedule file to be closed in 30 seconds, unless it is used
+    # before then, in which case the timer will be reset.
+    def closeFile(fileObj, dictObj, key):
+        SEQUENTIAL_READERS.pop(datafile_id, None)
+        if datafile_id in SPECULATIVE_OPENS:
+            SPECULATIVE_OPENS.discard(datafile_id)
+            metrics.increment("speculative_opens.expired")
+        fileObj.close()
+        dictObj[key] = None
+
+    dctdict = DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory]
+    if dctdict.get(filename) is not None:
+        dctdict[filename].cancel()
+    dfodict = DATAFILE_FILE_OBJECTS[dataset_id][subdirectory]
+    dctdict[filename] = \
+        threading.Timer(delay, closeFile, [file_object, dfodict, filename])
+    dctdict[filename].start()
+
+
+# Descriptors for datasets' directories in storage, from
+# _datafiledescriptord (if dataset_directory_descriptors is enabled),
+# keyed by dataset ID, as (descriptor, location name).  None means the
+# daemon couldn't provide one, or it can't be used to open the dataset's
+# files, so they are requested from the daemon one at a time.
+DATASET_DIR_DESCRIPTORS = OrderedDict()
+DATASET_DIR_DESCRIPTORS_LOCK = threading.Lock()
+MAX_DATASET_DIR_DESCRIPTORS = 64
+
+
+def store_dataset_dir_descriptor(dataset_id, value):
+    with DATASET_DIR_DESCRIPTORS_LOCK:
+        old_value = DATASET_DIR_DESCRIPTORS.pop(dataset_id, None)
+        if old_value is not None:
+            os.close(old_value[0])
+        DATASET_DIR_DESCRIPTORS[dataset_id] = value
+        while len(DATASET_DIR_DESCRIPTORS) > MAX_DATASET_DIR_DESCRIPTORS:
+            evicted_value = DATASET_DIR_DESCRIPTORS.popitem(last=False)[1]
+            if evicted_value is not None:
+                os.close(evicted_value[0])
+
+
+def open_in_dataset_directory(dataset_id, subdirectory, filename,
+                              datafile_id):
+    # Returns a file object for the datafile, opened relative to its
+    # dataset's directory descriptor, or None.  subdirectory and
+    # filename come from the dataset's listing, so only datafiles which
+    # belong to the dataset are opened this way.
+    with DATASET_DIR_DESCRIPTORS_LOCK:
+        value = DATASET_DIR_DESCRIPTORS.get(dataset_id)
+        if value is None:
+            return None
+        # (A duplicate, so the descriptor can't be closed and its number
+        # reused while we're opening the file.)
+        directory_fd = os.dup(value[0])
+        location = value[1]
+    relative_path = filename
+    if subdirectory != "":
+        relative_path = subdirectory + '/' + filename
+    try:
+        file_object = open_in_directory(directory_fd, relative_path)
+    except OSError, e:
+        logger.info("Couldn't open %s in dataset %s's directory: %s" %
+                    (relative_path, dataset_id, str(e)))
+        metrics.increment("dataset_dir_open_failures")
+        if e.errno in (errno.EACCES, errno.EPERM):
+            # The storage's permissions only allow the mytardis user to
+            # read the dataset's files.
+            store_dataset_dir_descriptor(dataset_id, None)
+        return None
+    finally:
+        os.close(directory_fd)
+    metrics.increment("dataset_dir_opens")
+    DATAFILE_LOCATIONS[datafile_id] = location
+    return file_object
+
+
+def acquire_file_object(experiment_id, dataset_id, subdirectory, filename,
+                        datafile_id, speculative=False):
+    # Another thread may have opened the file while we were waiting.
+    file_object = DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename]
+    if file_object is not None:
+        return file_object
+
+    priority = PRIORITY_INTERACTIVE
+    close_delay = 30.0
+    if speculative:
+        # Until it's read (see open_speculatively):
+        priority = PRIORITY_BACKGROUND
+        close_delay = _speculative_open_expiry_seconds
+        SPECULATIVE_OPENS.add(datafile_id)
+
+    if _dataset_directory_descriptors:
+        file_object = open_in_dataset_directory(dataset_id, subdirectory,
+                                                filename, datafile_id)
+        if file_object is not None:
+            DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename] = \
+                file_object
+            schedule_file_close(dataset_id, subdirectory, filename,
+                                file_object, datafile_id, close_delay)
+            return file_object
+    request_dataset_directory = _dataset_directory_descriptors and \
+        dataset_id not in DATASET_DIR_DESCRIPTORS
+
+    with HELPER_SCHEDULER.slot(priority):
+        correlation_id = new_correlation_id()
+        with optrace.span("backend", "helper",
+                          helper="_datafiledescriptord",
+                          args=[experiment_id, datafile_id],
+                          id=correlation_id) as trace_span:
+            mytardis_datafile_descriptor = MyTardisDatafileDescriptor. \
+                get_file_descriptor(_mytardis_install_dir, _auth_provider,
+                                    experiment_id, datafile_id,
+                                    _replica_location_priority,
+                                    correlation_id,
+                                    request_dataset_directory, priority)
+            # socket_wait already covers starting the helper.
+            trace_span.fields['phases'] = \
+                dict(mytardis_datafile_descriptor.phases)
+            for phase, seconds in mytardis_datafile_descriptor.phases:
+                metrics.record_time("helper._datafiledescriptord." + phase,
+                                    seconds)
+    logger.debug("Message: " + mytardis_datafile_descriptor.message)
+    if request_dataset_directory:
+        if mytardis_datafile_descriptor.dataset_dir_descriptor is not None:
+            store_dataset_dir_descriptor(
+                dataset_id,
+                (mytardis_datafile_descriptor.dataset_dir_descriptor,
+                 mytardis_datafile_descriptor.location))
+        elif mytardis_datafile_descriptor.file_descriptor is not None:
+            store_dataset_dir_descriptor(dataset_id, None)
+    if mytardis_datafile_descriptor.file_descriptor is None:
+        logger.info("mytardis_datafile_descriptor.file_descriptor "
+                    "is None.")
+        return None
+    metrics.increment("replica_opens." +
+                      str(mytardis_datafile_descriptor.location))
+    DATAFILE_LOCATIONS[datafile_id] = mytardis_datafile_descriptor.location
+    if mytardis_datafile_descriptor.fallbacks > 0:
+        metrics.increment("replica_fallbacks",
+                          mytardis_datafile_descriptor.fallbacks)
+
+    file_object = os.fdopen(mytardis_datafile_descriptor.file_descriptor)
+    DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename] = file_object
+    schedule_file_close(dataset_id, subdirectory, filename, file_object,
+                        datafile_id, close_delay)
+    return file_object
+
+
+def get_file_object(experiment_id, dataset_id, subdirectory, filename,
+                    datafile_id):
+    # Returns an open file object for the datafile, reusing one opened
+    # earlier if possible, or None if access was denied.
+    file_object = DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename]
+    if file_object is not None:
+        # Found a file object to reuse,
+        # so let's reset the timer for closing the file:
+        schedule_file_close(dataset_id, subdirectory, filename, file_object,
+                            datafile_id)
+        if datafile_id in SPECULATIVE_OPENS:
+            SPECULATIVE_OPENS.discard(datafile_id)
+            metrics.increment("speculative_opens.used")
+        return file_object
+    file_object = FILE_DESCRIPTOR_REQUESTS.do(datafile_id,
+                                              acquire_file_object,
+                                              experiment_id, dataset_id,
+                                              subdirectory, filename,
+                                              datafile_id)
+    if datafile_id in SPECULATIVE_OPENS:
+        # We joined a speculative request.
+        SPECULATIVE_OPENS.discard(datafile_id)
+        if file_object is not None:
+            metrics.increment("speculative_opens.used")
+            schedule_file_close(dataset_id, subdirectory, filename,
+                                file_object, datafile_id)
+    return file_object
+
+
+# Datafiles opened by speculative_open which haven't been read yet:
+SPECULATIVE_OPENS = set()
+SPECULATIVE_OPEN_SLOTS = \
+    threading.BoundedSemaphore(max(1, _speculative_open_max_concurrent))
+
+
+def open_speculatively(path):
+    # SFTP servers and rsync stat a file just before they open and read
+    # it, so (if speculative_open is enabled) getattr calls this to start
+    # acquiring the file's descriptor in the background.  If the read
+    # arrives first, it joins the same request.  If all of the slots are
+    # in use (e.g. during "ls -l" of a large dataset), nothing is done,
+    # and files which aren't read within speculative_open_expiry_seconds
+    # are closed again.
+    if HTTP_CONTENT is not None or path.count(os.sep) < 3:
+        return
+    experiment_id, dataset_id, subdirectory, filename = \
+        split_datafile_path(path)
+    try:
+        if DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename] \
+                is not None:
+            return
+        datafile_id = DATAFILE_IDS[dataset_id][subdirectory][filename]
+    except KeyError:
+        return
+    if not SPECULATIVE_OPEN_SLOTS.acquire(False):
+        metrics.increment("speculative_opens.skipped")
+        return
+    metrics.increment("speculative_opens.started")
+
+    def acquire():
+        try:
+            file_object = FILE_DESCRIPTOR_REQUESTS.do(
+                datafile_id, acquire_file_object, experiment_id, dataset_id,
+                subdirectory, filename, datafile_id, True)
+            if file_object is None:
+                SPECULATIVE_OPENS.discard(datafile_id)
+        except:
+            SPECULATIVE_OPENS.discard(datafile_id)
+            logger.error(traceback.format_exc())
+        finally:
+            SPECULATIVE_OPEN_SLOTS.release()
+
+    thread = threading.Thread(target=acquire)
+    thread.daemon = True
+    thread.start()
+
+
+# Total bytes and file counts of experiments and datasets, from one
+# _expdatasetsizes query, keyed by (experiment_id,) or
+# (experiment_id, dataset_id):
+DIRECTORY_SIZES = dict()
+XATTR_TOTAL_BYTES = "user.mytardis.total_bytes"
+XATTR_FILE_COUNT = "user.mytardis.file_count"
+
+
+def refresh_directory_sizes(priority=PRIORITY_INTERACTIVE):
+    if 'directory_sizes' in LAST_QUERY_TIME and \
+            datetime.now() - LAST_QUERY_TIME['directory_sizes'] < \
+            timedelta(seconds=_directory_sizes_cache_time_seconds):
+        return
+    cmd = ['sudo', '-n', '-u', 'mytardis',
+           '/usr/local/bin/_expdatasetsizes',
+           _mytardis_install_dir, _auth_provider]
+    logger.info(str(cmd))
+    stdout, stderr = run_helper(cmd, priority)
+    if stderr is not None and stderr != "":
+        logger.info(stderr)
+    try:
+        exp_dict = ast.literal_eval(stdout.strip())
+    except:
+        logger.error(stdout)
+        return
+    for experiment_id, datasets in exp_dict.iteritems():
+        exp_total_bytes = 0
+        exp_file_count = 0
+        for dataset_id, (total_bytes, file_count) in datasets.iteritems():
+            DIRECTORY_SIZES[(str(experiment_id), str(dataset_id))] = \
+                (total_bytes, file_count)
+            exp_total_bytes = exp_total_bytes + total_bytes
+            exp_file_count = exp_file_count + file_count
+        DIRECTORY_SIZES[(str(experiment_id),)] = \
+            (exp_total_bytes, exp_file_count)
+    LAST_QUERY_TIME['directory_sizes'] = datetime.now()
+
+
+def get_directory_size(path):
+    # Returns (total_bytes, file_count) for an experiment or dataset
+    # directory, or None for any other path.
+    if is_virtual_view_path(path):
+        return None
+    path_components = path.split('/')
+    if len(path_components) == 2 and path != '/':
+        key = (path_components[1].split("-")[0],)
+    elif len(path_components) == 3:
+        key = (path_components[1].split("-")[0],
+               path_components[2].split("-")[0])
+    else:
+        return None
+    LISTING_REQUESTS.do('directory_sizes', refresh_directory_sizes)
+    return DIRECTORY_SIZES.get(key, (0, 0))
+
+
 class MyStat(fuse.Stat):
     """
     Convenient class for Stat objects.
@@ -459,421 +2371,278 @@ class MyStat(fuse.Stat):
                 # still has "." and ".."
                 self.st_nlink = 2
             self.st_size = dir_entry.get_size_in_bytes()
+        elif dir_entry.get_link_target() is not None:
+            self.st_mode = stat.S_IFLNK | stat.S_IRWXU
+            self.st_nlink = 1
+            self.st_size = len(dir_entry.get_link_target())
         else:
             self.st_mode = stat.S_IFREG | stat.S_IRUSR
             self.st_nlink = 1
             self.st_size = dir_entry.get_size_in_bytes()
+            # Allow du to report datafile sizes:
+            self.st_blocks = (self.st_size + 511) // 512
         self.st_atime = dir_entry.get_accessed()
         self.st_mtime = dir_entry.get_modified()
         self.st_ctime = dir_entry.get_created()
 
+        if dir_entry.get_inode() != 0:
+            self.st_ino = dir_entry.get_inode()
+
         self.st_uid = int(_uid)
         self.st_gid = int(_gid)
 
 
+def start_session_watcher():
+    # When started by mytardisftpd, the mount is shared by all of the
+    # user's sessions, and is unmounted after the last one has ended.
+    def check_sessions():
+        with sessions.SessionsLock():
+            count = sessions.live_session_count()
+            metrics.set_gauge("sessions", count)
+            if count == 0:
+                logger.info("All sessions have ended. Unmounting " +
+                            fuse_mount_dir)
+                subprocess.call(["fusermount", "-uz", fuse_mount_dir])
+                return
+        timer = threading.Timer(_session_check_interval_seconds,
+                                check_sessions)
+        timer.daemon = True
+        timer.start()
+
+    timer = threading.Timer(_session_check_interval_seconds, check_sessions)
+    timer.daemon = True
+    timer.start()
+
+
 class MyFS(fuse.Fuse):
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
 
+    def fsinit(self):
+        # Called by fuse-python once the filesystem has been mounted,
+        # (and after daemonizing, unless running with -f).
+        metrics.start_logging(logger, _metrics_log_interval_seconds)
+        transfers.start(mytardis_username, _transfer_log_file,
+                        _transfer_idle_seconds)
+        if _control_socket_dir != "":
+            try:
+                control_socket_path = \
+                    invalidation.listen(_control_socket_dir,
+                                        getpass.getuser(),
+                                        handle_invalidation, logger)
+                logger.info("Listening for invalidation events on " +
+                            control_socket_path)
+            except:
+                logger.error(traceback.format_exc())
+
+        # mytardisftpd waits for us to report that we are ready on an
+        # inherited pipe, rather than polling the mount point.
+        if 'MYTARDISFS_READY_FD' in os.environ:
+            ready_fd = int(os.environ['MYTARDISFS_READY_FD'])
+            try:
+                os.write(ready_fd, "ready\n")
+                os.close(ready_fd)
+            except OSError:
+                logger.error(traceback.format_exc())
+            del os.environ['MYTARDISFS_READY_FD']
+
+        if os.environ.get('MYTARDISFS_SESSIONS') == "True":
+            start_session_watcher()
+
+    @optrace.traced("getattr", ["path"])
     def getattr(self, path):
         path = path.rstrip("*")
         if path != "/":
             path = path.rstrip("/")
         logger.debug("^ getattr: path = " + path)
 
-        try:
-            return MyStat(FILES[path])
-        except KeyError:
+        dir_entry = lookup_file(path)
+        if dir_entry is None:
             logger.debug("KeyError in getattr for path: " + str(path))
             return -errno.ENOENT
+        st = MyStat(dir_entry)
+        if _speculative_open and \
+                dir_entry.get_file_type() == stat.S_IFREG:
+            open_speculatively(path)
+        if _recursive_directory_sizes and dir_entry.get_is_directory():
+            directory_size = get_directory_size(path)
+            if directory_size is not None:
+                st.st_size = directory_size[0]
+        return st
+
+    @optrace.traced("listxattr", ["path", "size"])
+    def listxattr(self, path, size):
+        if lookup_file(path) is None or get_directory_size(path) is None:
+            names = []
+        else:
+            names = [XATTR_TOTAL_BYTES, XATTR_FILE_COUNT]
+        if size == 0:
+            # Size of the list, including null separators
+            return len("".join(names)) + len(names)
+        return names
+
+    @optrace.traced("getxattr", ["path", "name", "size"])
+    def getxattr(self, path, name, size):
+        if lookup_file(path) is None or \
+                name not in (XATTR_TOTAL_BYTES, XATTR_FILE_COUNT):
+            return -errno.ENODATA
+        directory_size = get_directory_size(path)
+        if directory_size is None:
+            return -errno.ENODATA
+        if name == XATTR_TOTAL_BYTES:
+            value = str(directory_size[0])
+        else:
+            value = str(directory_size[1])
+        if size == 0:
+            return len(value)
+        return value
 
     def getdir(self, path):
         logger.debug('getdir called:', path)
         return file_array_to_list(FILES)
 
-    def readdir(self, path, offset):
-        logger.debug("^ readdir: path = \"" + path + "\"")
-
-        for e in '.', '..':
-            yield fuse.Direntry(e)
-
-        pathComponents = path.split(os.sep, 3)
-        if pathComponents == ['', '']:
-            pathComponents = ['']
-        if len(pathComponents) > 1 and pathComponents[1] != '':
-            exp_dir_name = pathComponents[1]
-            experiment_id = exp_dir_name.split("-")[0]
-        if len(pathComponents) > 2 and pathComponents[2] != '':
-            dataset_dir_name = pathComponents[2]
-            dataset_id = dataset_dir_name.split("-")[0]
-        # subdirectory is not used in "def readdir". Should it be?
-        if len(pathComponents) > 3 and pathComponents[3] != '':
-            subdirectory = pathComponents[3]
-
-        if len(pathComponents) == 1:
-            time_since_last_experiments_query = datetime.now() - \
-                LAST_QUERY_TIME['experiments']
-            if time_since_last_experiments_query.seconds > \
-                    _experiments_list_cache_time_seconds:
-                url = _mytardis_url + "/api/v1/experiment/?format=json&limit=0"
-                logger.info(url)
-                response = requests.get(url=url, headers=_headers)
-                if response.status_code < 200 or response.status_code >= 300:
-                    logger.info("Response status_code = " +
-                                str(response.status_code))
-                exp_records_json = response.json()
-		if response.status_code < 200 or response.status_code >= 300:
-		    logger.info(exp_records_json)
-                num_exp_records_found = exp_records_json['meta']['total_count']
-                logger.info(str(num_exp_records_found) +
-                            " experiment record(s) found for user " +
-                            mytardis_username)
-
-                cmd = ['sudo', '-n', '-u', 'mytardis',
-                       '/usr/local/bin/_countexpdatasets',
-                       _mytardis_install_dir, _auth_provider]
-                logger.info(str(cmd))
-                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-                if stderr is not None and stderr != "":
-                    logger.info(stderr)
-                try:
-                    expdatasetcounts = ast.literal_eval(stdout.strip())
-                except:
-                    expdatasetcounts = []
-
-                # Doesn't check for deleted experiments,
-                # only adds to FILES dictionary.
-                max_exp_created_time = datetime.fromtimestamp(0)
-                for exp_record_json in exp_records_json['objects']:
-                    exp_dir_name = str(exp_record_json['id']) + "-" + \
-                        (exp_record_json['title'].encode('ascii', 'ignore')
-                            .replace(" ", "_"))
-                    exp_created_time = \
-                        dateutil.parser.parse(exp_record_json['created_time'])
-                    if exp_created_time > max_exp_created_time:
-                        max_exp_created_time = exp_created_time
-                    exp_created_timestamp = \
-                        int(time.mktime(exp_created_time.timetuple()))
-
-                    nlink = 2
-                    if exp_record_json['id'] in expdatasetcounts.keys():
-                        num_datasets = expdatasetcounts[exp_record_json['id']]
-                        nlink = num_datasets + 2
-
-                    exp_dir_entry = \
-                        DirEntry(file_path='/'+exp_dir_name,
-                                 size_in_bytes=_default_directory_size,
-                                 is_directory=True,
-                                 accessed=exp_created_timestamp,
-                                 modified=exp_created_timestamp,
-                                 created=exp_created_timestamp,
-                                 nlink=nlink)
-                    FILES[exp_dir_entry.get_file_path()] = exp_dir_entry
-                max_exp_created_timestamp = \
-                    int(time.mktime(max_exp_created_time.timetuple()))
-                root_dir_entry = \
-                    DirEntry(file_path='/',
-                             size_in_bytes=_default_directory_size,
-                             is_directory=True,
-                             accessed=max_exp_created_timestamp,
-                             modified=max_exp_created_timestamp,
-                             created=max_exp_created_timestamp,
-                             nlink=int(num_exp_records_found)+2)
-                FILES[root_dir_entry.get_file_path()] = root_dir_entry
-                LAST_QUERY_TIME['experiments'] = datetime.now()
-
-        if len(pathComponents) == 2 and pathComponents[1] != '':
-            if experiment_id+'_datasets' not in LAST_QUERY_TIME:
-                LAST_QUERY_TIME[experiment_id+'_datasets'] = \
-                    datetime.fromtimestamp(0)
-            time_since_last_experiment_datasets_query = datetime.now() - \
-                LAST_QUERY_TIME[experiment_id+'_datasets']
-            if time_since_last_experiment_datasets_query.seconds > \
-                    _experiment_datasets_cache_time_seconds:
-                url = _mytardis_url + \
-                    "/api/v1/dataset/?format=json&limit=0&experiments__id=" + \
-                    experiment_id
-                logger.info(url)
-                response = requests.get(url=url, headers=_headers)
-                if response.status_code < 200 or response.status_code >= 300:
-                    logger.info("Response status_code = " +
-                                str(response.status_code))
-                dataset_records_json = response.json()
-                if response.status_code < 200 or response.status_code >= 300:
-                    logger.info(dataset_records_json)
-                num_dataset_records_found = \
-                    dataset_records_json['meta']['total_count']
-                logger.info(str(num_dataset_records_found) +
-                            " dataset record(s) found for exp ID " +
-                            experiment_id)
-
-                for dataset_json in dataset_records_json['objects']:
-                    dataset_dir_name = str(dataset_json['id']) + "-" + \
-                        (dataset_json['description'].encode('ascii', 'ignore')
-                            .replace(" ", "_"))
-                    dataset_dir_entry = \
-                        DirEntry(file_path='/' + exp_dir_name + '/' +
-                                 dataset_dir_name,
-                                 size_in_bytes=_default_directory_size,
-                                 is_directory=True)
-                    FILES[dataset_dir_entry.get_file_path()] = \
-                        dataset_dir_entry
-
-            LAST_QUERY_TIME[experiment_id+'_datasets'] = datetime.now()
-
-        if len(pathComponents) == 3 and pathComponents[1] != '':
-            if dataset_id+'_datafiles' not in LAST_QUERY_TIME:
-                LAST_QUERY_TIME[dataset_id+'_datafiles'] = \
-                    datetime.fromtimestamp(0)
-            time_since_last_dataset_datafiles_query = datetime.now() - \
-                LAST_QUERY_TIME[dataset_id+'_datafiles']
-            if time_since_last_dataset_datafiles_query.seconds > \
-                    _dataset_datafiles_cache_time_seconds:
-                dataset_dir_entry = \
-                    DirEntry(file_path='/'+exp_dir_name+'/'+dataset_dir_name,
-                             size_in_bytes=_default_directory_size,
-                             is_directory=True)
-                FILES[dataset_dir_entry.get_file_path()] = dataset_dir_entry
-                DATAFILE_IDS[dataset_id] = dict()
-                DATAFILE_SIZES[dataset_id] = dict()
-                DATAFILE_FILE_OBJECTS[dataset_id] = dict()
-                DATAFILE_CLOSE_TIMERS[dataset_id] = dict()
-
-                _use_api_for_dataset_datafiles = False
-
-                if _use_api_for_dataset_datafiles:
-                    url = _mytardis_url + \
-                        "/api/v1/dataset_file/?format=json&limit=0&" + \
-                        "dataset__id=" + str(dataset_id)
-                    logger.info(url)
-                    response = requests.get(url=url, headers=_headers)
-                    datafile_records_json = response.json()
-                    num_datafile_records_found = \
-                        datafile_records_json['meta']['total_count']
-                else:
-                    cmd = ['sudo', '-n', '-u', 'mytardis',
-                           '/usr/local/bin/_datasetdatafiles',
-                           _mytardis_install_dir, _auth_provider,
-                           experiment_id, dataset_id]
-                    logger.info(str(cmd))
-                    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE)
-                    stdout, stderr = proc.communicate()
-                    if stderr is not None and stderr != "":
-                        logger.info(stderr)
-
-                    datafile_dicts_string = stdout.strip()
-                    # logger.info("datafile_dicts_string: " +
-                    #     datafile_dicts_string)
-                    datafile_dicts = ast.literal_eval(datafile_dicts_string)
-                    num_datafile_records_found = len(datafile_dicts)
-
-                logger.info(str(num_datafile_records_found) +
-                            " datafile record(s) found for dataset ID " +
-                            str(dataset_id))
-
-                if _use_api_for_dataset_datafiles:
-                    datafile_dicts = datafile_records_json['objects']
-
-                for df in datafile_dicts:
-                    # logger.debug("df = " + str(df))
-                    datafile_id = df['id']
-                    if _use_api_for_dataset_datafiles:
-                        df_directory = df['directory'] \
-                            .encode('ascii', 'ignore').strip('/')
-                    else:
-                        df_directory = df['directory']
-                        if df_directory is None:
-                            df_directory = ""
-                        else:
-                            df_directory = df_directory \
-                                .encode('ascii', 'ignore').strip('/')
-                    df_filename = df['filename'] \
-                        .encode('ascii', 'ignore')
-                    df_size = int(df['size'].encode('ascii', 'ignore'))
-                    try:
-                        df_created_time_datetime = \
-                            dateutil.parser.parse(df['created_time'])
-                        df_created_timetuple = \
-                            df_created_time_datetime.timetuple()
-                        df_created_time = \
-                            int(time.mktime(df_created_timetuple))
-                    except:
-                        logger.debug(traceback.format_exc())
-                        df_created_time = _file_default_timestamp
-                    try:
-                        df_modification_time_datetime = \
-                            dateutil.parser.parse(df['modification_time'])
-                        df_modification_timetuple = \
-                            df_modification_time_datetime.timetuple()
-                        df_modification_time = \
-                            int(time.mktime(df_modification_timetuple))
-                    except:
-                        logger.debug(traceback.format_exc())
-                        df_modification_time = _file_default_timestamp
-
-                    df_accessed_time = df_modification_time
-
-                    if df_directory != "":
-                        # Intermediate subdirectories
-                        for i in reversed(range(1,
-                                          len(df_directory.split('/')))):
-                            intermediate_subdirectory = \
-                                df_directory.rsplit('/', i)[0]
-                            intermediate_subdir_entry = \
-                                DirEntry(file_path='/' + exp_dir_name + '/' +
-                                         dataset_dir_name + '/' +
-                                         intermediate_subdirectory,
-                                         size_in_bytes=_default_directory_size,
-                                         is_directory=True,
-                                         accessed=df_accessed_time,
-                                         modified=df_accessed_time,
-                                         created=df_accessed_time)
-                            FILES[intermediate_subdir_entry.get_file_path()] = \
-                                intermediate_subdir_entry
-
-                        datafile_dir_entry = \
-                            DirEntry(file_path='/' + exp_dir_name + '/' +
-                                     dataset_dir_name + '/' +
-                                     df_directory,
-                                     size_in_bytes=_default_directory_size,
-                                     is_directory=True,
-                                     accessed=df_accessed_time,
-                                     modified=df_accessed_time,
-                                     created=df_accessed_time)
-                        FILES[datafile_dir_entry.get_file_path()] = \
-                            datafile_dir_entry
-
-                        datafile_entry = \
-                            DirEntry(file_path='/' + exp_dir_name + '/' +
-                                     dataset_dir_name + '/' +
-                                     df_directory + '/' +
-                                     df_filename,
-                                     size_in_bytes=df_size,
-                                     is_directory=False,
-                                     accessed=df_accessed_time,
-                                     modified=df_accessed_time,
-                                     created=df_accessed_time)
-                        FILES[datafile_entry.get_file_path()] = datafile_entry
-                    else:
-                        datafile_entry = \
-                            DirEntry(file_path='/' + exp_dir_name + '/' +
-                                     dataset_dir_name + '/' +
-                                     df_filename,
-                                     size_in_bytes=df_size,
-                                     is_directory=False,
-                                     accessed=df_accessed_time,
-                                     modified=df_accessed_time,
-                                     created=df_accessed_time)
-                        FILES[datafile_entry.get_file_path()] = datafile_entry
-                    if df_directory not in DATAFILE_IDS[dataset_id]:
-                        DATAFILE_IDS[dataset_id][df_directory] = dict()
-                    DATAFILE_IDS[dataset_id][df_directory][df_filename] \
-                        = datafile_id
-                    if df_directory not in DATAFILE_SIZES[dataset_id]:
-                        DATAFILE_SIZES[dataset_id][df_directory] = dict()
-                    dsdict = DATAFILE_SIZES[dataset_id][df_directory]
-                    dsdict[df_filename] = df_size
-                    if df_directory not in DATAFILE_FILE_OBJECTS[dataset_id]:
-                        DATAFILE_FILE_OBJECTS[dataset_id][df_directory] \
-                            = dict()
-                    dfodict = DATAFILE_FILE_OBJECTS[dataset_id][df_directory]
-                    dfodict[df_filename] = None
-                    if df_directory not in DATAFILE_CLOSE_TIMERS[dataset_id]:
-                        DATAFILE_CLOSE_TIMERS[dataset_id][df_directory] \
-                            = dict()
-                    dctdict = DATAFILE_CLOSE_TIMERS[dataset_id][df_directory]
-                    dctdict[df_filename] = None
-            LAST_QUERY_TIME[dataset_id+'_datafiles'] = datetime.now()
-
-        path_depth = path.count('/')
-        # FIXME: Iterating through the entire FILES dictionary is inefficient
-        for key, val in FILES.iteritems():
-            if key == "/":
-                continue
+    @optrace.traced("opendir", ["path"])
+    def opendir(self, path):
+        logger.debug("^ opendir: path = \"" + path + "\"")
+        return DirectoryHandle(path)
 
-            key_depth = key.count('/')
+    @optrace.traced("releasedir", ["path"])
+    def releasedir(self, path, directory_handle=None):
+        if directory_handle is not None:
+            directory_handle.listing = None
 
-            if path == "/":
-                path_depth = 0
+    @optrace.traced("readdir", ["path", "off"])
+    def readdir(self, path, offset, directory_handle=None):
+        logger.debug("^ readdir: path = \"" + path + "\"")
 
-            if key.startswith(path) and key_depth == path_depth + 1:
-                yield(fuse.Direntry(file_from_key(key)))
+        # Each entry's offset is the offset of the entry after it, which
+        # the kernel passes back to us if it needs more than one call to
+        # read the whole directory: '.' and '..' are followed by offsets
+        # 1 and 2, and the listing's entry n by offset n + 3.
+        if offset < 1:
+            yield fuse.Direntry('.', type=stat.S_IFDIR >> 12, offset=1)
+        if offset < 2:
+            yield fuse.Direntry('..', type=stat.S_IFDIR >> 12, offset=2)
+
+        # Entries are produced as the listing arrives, so clients see
+        # the start of a very large dataset straight away.
+        if directory_handle is None:
+            directory_handle = DirectoryHandle(path)
+        listing = get_listing(directory_handle, offset)
+
+        # Filling in d_type and d_ino saves clients like find and rsync
+        # from having to call getattr just to tell files from directories.
+        for position, name, dir_entry in \
+                listing.entries_from(max(0, offset - 2)):
+            yield fuse.Direntry(name, type=dir_entry.get_file_type() >> 12,
+                                ino=dir_entry.get_inode(),
+                                offset=position + 3)
+
+    @optrace.traced("readlink", ["path"])
+    def readlink(self, path):
+        logger.debug("^ readlink: path = " + path)
+        try:
+            return FILES[path].get_link_target()
+        except KeyError:
+            return -errno.ENOENT
 
+    @optrace.traced("open", ["path"])
+    def open(self, path, flags):
+        if lookup_file(path) is None:
+            return -errno.ENOENT
+        with SEQUENTIAL_READERS_LOCK:
+            OPEN_FILE_COUNTS[path] = OPEN_FILE_COUNTS.get(path, 0) + 1
+        return 0
+
+    @optrace.traced("release", ["path"])
+    def release(self, path, flags):
+        with SEQUENTIAL_READERS_LOCK:
+            count = OPEN_FILE_COUNTS.get(path, 1) - 1
+            if count > 0:
+                OPEN_FILE_COUNTS[path] = count
+                return 0
+            OPEN_FILE_COUNTS.pop(path, None)
+            try:
+                experiment_id, dataset_id, subdirectory, filename = \
+                    split_datafile_path(path)
+                datafile_id = DATAFILE_IDS[dataset_id][subdirectory][filename]
+            except (IndexError, KeyError):
+                return 0
+            SEQUENTIAL_READERS.pop(datafile_id, None)
+        return 0
+
+    @optrace.traced("read", ["path", "len", "off"])
     def read(self, path, leng, offset):
 
         logger.debug("read(...) path = " + path)
 
-        filename = path.rsplit(os.sep)[-1]
-        pathComponents = path.split(os.sep, 3)
-        if pathComponents == ['', '']:
-            pathComponents = ['']
-        experiment_id = pathComponents[1].split("-")[0]
-        dataset_id = pathComponents[2].split("-")[0]
-        if os.sep in pathComponents[3]:
-            subdirectory = pathComponents[3].rsplit(os.sep, 1)[0]
-        else:
-            subdirectory = ""
+        experiment_id, dataset_id, subdirectory, filename = \
+            split_datafile_path(path)
         logger.debug("read request for %s with length %d and offset %d" %
                      (filename, leng, offset))
 
+        if lookup_file(path) is None:
+            return -errno.ENOENT
         datafile_id = DATAFILE_IDS[dataset_id][subdirectory][filename]
 
         datafile_size = DATAFILE_SIZES[dataset_id][subdirectory][filename]
         logger.debug("datafile_size is " + str(datafile_size))
 
-        if DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename] \
-                is not None:
-            # Found a file object to reuse,
-            # so let's reset the timer for closing the file:
-            file_object = \
-                DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename]
-            DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory][filename].cancel()
-
-            def closeFile(fileObj, dictObj, key):
-                fileObj.close()
-                dictObj[key] = None
-
-            dfodict = DATAFILE_FILE_OBJECTS[dataset_id][subdirectory]
-            DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory][filename] \
-                = threading.Timer(30.0, closeFile, [file_object, dfodict,
-                                                    filename])
-            DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory][filename].start()
+        def read_datafile(read_offset, read_length):
+            # Reads entirely within the start of a file (including the
+            # whole of a small file) are interactive, so they aren't held
+            # up behind bulk transfers, within the interactive allowance.
+            IO_THROTTLE.throttle(read_length, read_offset + read_length <=
+                                 _io_throttle_interactive_kb * 1024)
+            if HTTP_CONTENT is not None:
+                return HTTP_CONTENT.read(datafile_id, datafile_size,
+                                         read_offset, read_length)
+            file_object = get_file_object(experiment_id, dataset_id,
+                                          subdirectory, filename, datafile_id)
+            if file_object is None:
+                return None
+            return read_file_object(datafile_id, file_object,
+                                    read_offset, read_length)
+
+        # Cached content is keyed by the datafile's modification time too,
+        # so it isn't served after the datafile's content is replaced:
+        cache_key = (datafile_id, datafile_size, FILES[path].get_modified())
+
+        if DISK_CACHE is not None:
+            read_from_backend = read_datafile
+
+            def read_datafile(read_offset, read_length):
+                return DISK_CACHE.read(cache_key, datafile_size,
+                                       read_offset, read_length,
+                                       read_from_backend,
+                                       lambda: disk_cache_enabled_for(
+                                           datafile_id))
+
+        if _read_ahead_max_kb > 0:
+            def datafile_fileno():
+                if HTTP_CONTENT is not None:
+                    return None
+                file_object = \
+                    DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename]
+                if file_object is None:
+                    return None
+                return file_object.fileno()
+
+            read_datafile = sequential_reader(
+                datafile_id, offset,
+                lambda: SequentialReader(datafile_size,
+                                         _read_ahead_max_kb * 1024,
+                                         read_datafile,
+                                         datafile_fileno)).read
+
+        if BLOCK_CACHE is not None:
+            data = BLOCK_CACHE.read(cache_key, datafile_size, offset, leng,
+                                    read_datafile)
         else:
-            mytardis_datafile_descriptor = MyTardisDatafileDescriptor. \
-                get_file_descriptor(_mytardis_install_dir, _auth_provider,
-                                    experiment_id, datafile_id)
-            file_descriptor = None
-            logger.debug("Message: " +
-                         mytardis_datafile_descriptor.message)
-            if mytardis_datafile_descriptor.file_descriptor is not None:
-                file_descriptor = mytardis_datafile_descriptor.file_descriptor
-            else:
-                logger.info("mytardis_datafile_descriptor.file_descriptor "
-                            "is None.")
-
-            file_object = os.fdopen(file_descriptor)
-            DATAFILE_FILE_OBJECTS[dataset_id][subdirectory][filename] = \
-                file_object
-
-            # Schedule file to be closed in 30 seconds, unless it is used
-            # before then, in which case the timer will be reset.
-
-            def closeFile(fileObj, dictObj, key):
-                fileObj.close()
-                dictObj[key] = None
-
-            dfodict = DATAFILE_FILE_OBJECTS[dataset_id][subdirectory]
-            DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory][filename] = \
-                threading.Timer(30.0, closeFile, [file_object, dfodict,
-                                                  filename])
-            DATAFILE_CLOSE_TIMERS[dataset_id][subdirectory][filename].start()
-
-        file_object.seek(offset)
-        data = file_object.read(leng)
-
+            data = read_datafile(offset, leng)
+        if data is None:
+            return -errno.EACCES
+        transfers.record_read(datafile_id, path, len(data))
         return data
 
 if __name__ == '__main__':
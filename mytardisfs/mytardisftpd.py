@@ -1,43 +1,70 @@
 import sys
 import os
 import subprocess
-import time
+import select
+import errno
+import fcntl
 
+import sessions
 
-def run():
-    HOME = os.getenv("HOME")
+# Maximum time to wait for mytardisfs to report that it is ready:
+MOUNT_TIMEOUT_SECONDS = 10
 
-    proc = subprocess.Popen(["stat", "-f", "-c", "%T",
-                             os.path.join(HOME, "MyTardis")],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    stdout, stderr = proc.communicate()
-    filesystem_type = stdout.strip()
-    if filesystem_type == "fuseblk":
-        # Avoid STDOUT if run from /usr/local/lib/openssh/sftp-server
-        if sys.stdout.isatty():
-            print ""
-            print "ERROR: " + \
-                "You already have a FUSE filesystem mounted on ~/MyTardis"
-            print ""
-            print "You can unmount MyTardis by running:"
-            print ""
-            print "    fusermount -uz ~/MyTardis"
-            print ""
-        sys.exit(1)
 
+def print_unmount_instructions():
+    print "You can unmount MyTardis by running:"
+    print ""
+    print "    fusermount -uz ~/MyTardis"
+    print ""
+
+
+def wait_until_ready(ready_fd, timeout_seconds):
+    # mytardisfs writes "ready" to the pipe once the filesystem has
+    # been mounted.  If mytardisfs exits first, we get end-of-file.
+    message = ""
+    while not message.endswith("\n"):
+        try:
+            readable, _, _ = select.select([ready_fd], [], [],
+                                           timeout_seconds)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if len(readable) == 0:
+            return "timeout"
+        data = os.read(ready_fd, 64)
+        if data == "":
+            break
+        message = message + data
+    return message.strip()
+
+
+def start_mytardisfs(mount_dir):
+    # Starts mytardisfs, and returns "ready", "timeout" or the message
+    # mytardisfs reported instead (e.g. "" if it exited).
+    HOME = os.getenv("HOME")
     stdout_log_filename = os.path.join(HOME, "mytardisftpd.log")
     stderr_log_filename = os.path.join(HOME, "mytardisftpd-error.log")
 
     mytardisfs_proc = None
 
+    ready_read_fd, ready_write_fd = os.pipe()
+    # Only the write end is passed to mytardisfs (close_fds=False is needed
+    # for that), so that we see end-of-file if it exits before it is ready.
+    fcntl.fcntl(ready_read_fd, fcntl.F_SETFD,
+                fcntl.fcntl(ready_read_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    env = dict(os.environ)
+    env['MYTARDISFS_READY_FD'] = str(ready_write_fd)
+    env['MYTARDISFS_SESSIONS'] = "True"
+
     with open(stdout_log_filename, 'w') as out, \
             open(stderr_log_filename, 'w') as err:
         mytardisfs_proc = \
-            subprocess.Popen(["mytardisfs",
-                              os.path.join(HOME, "MyTardis"),
-                              "-f", "-o", "direct_io"],
-                             stdout=out, stderr=err)
+            subprocess.Popen(["mytardisfs", mount_dir,
+                              "-f", "-o", "direct_io,use_ino"],
+                             stdout=out, stderr=err, env=env,
+                             close_fds=False)
+    os.close(ready_write_fd)
 
     if mytardisfs_proc is None:
         print ""
@@ -47,39 +74,60 @@ def run():
         print "or to ~/mytardisftpd-error.log ?"
         print ""
 
-    count = 0
-    while count < 100:
-        mytardisfs_proc.poll()
-        if mytardisfs_proc.returncode is not None \
-                and mytardisfs_proc.returncode != 0:
-            break
+    status = wait_until_ready(ready_read_fd, MOUNT_TIMEOUT_SECONDS)
+    os.close(ready_read_fd)
+    return status
+
+
+def run():
+    HOME = os.getenv("HOME")
+    mount_dir = os.path.join(HOME, "MyTardis")
+
+    # The lock is held until the mytardisfs started here is ready, so
+    # that if several sessions start at once, only the first one mounts,
+    # and the others reuse its mount.
+    with sessions.SessionsLock():
+        # The session is the process which ran mytardisftpd, e.g. the
+        # sftp-server wrapper script or the shell running rsync.
+        sessions.register_session(os.getppid())
+
+        filesystem_type = sessions.fuse_mount_type(mount_dir)
+        if filesystem_type is not None and \
+                filesystem_type.startswith("fuse"):
+            if sessions.mount_is_healthy(mount_dir):
+                # Avoid STDOUT if run from /usr/local/lib/openssh/sftp-server
+                if sys.stdout.isatty():
+                    print ""
+                    print "Reusing your existing MyTardis mount " + \
+                        "at ~/MyTardis/"
+                    print ""
+                    print_unmount_instructions()
+                sys.exit(0)
+            # The mytardisfs process for this mount has gone away (or is
+            # hung), so clean up the stale mount before mounting again.
+            subprocess.call(["fusermount", "-uz", mount_dir])
+
+        status = ""
+        try:
+            status = start_mytardisfs(mount_dir)
+        finally:
+            if status != "ready":
+                sessions.unregister_session(os.getppid())
 
-        proc = subprocess.Popen(["stat", "-f", "-c", "%T",
-                                 os.path.join(HOME, "MyTardis")],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-        stdout, stderr = proc.communicate()
-        filesystem_type = stdout.strip()
-        if filesystem_type == "fuseblk":
-            # Avoid STDOUT if run from /usr/local/lib/openssh/sftp-server
-            if sys.stdout.isatty():
-                print ""
-                print "Your MyTardis data has been mounted at ~/MyTardis/"
-                print "You can unmount MyTardis by running:"
-                print ""
-                print "    fusermount -uz ~/MyTardis"
-                print ""
-            sys.exit(0)
-        time.sleep(0.1)
-        count = count + 1
+    if status == "ready":
+        # Avoid STDOUT if run from /usr/local/lib/openssh/sftp-server
+        if sys.stdout.isatty():
+            print ""
+            print "Your MyTardis data has been mounted at ~/MyTardis/"
+            print_unmount_instructions()
+        sys.exit(0)
 
     print ""
-    if count == 100:
-        print os.path.join(HOME, "MyTardis") + \
-            " still isn't mounted after 10 seconds."
+    if status == "timeout":
+        print mount_dir + " still isn't mounted after %d seconds." % \
+            MOUNT_TIMEOUT_SECONDS
     else:
-        print os.path.join(HOME, "MyTardis") + \
-            " failed to mount."
+        print mount_dir + " failed to mount."
     print ""
     print "You could look in: "
     print ""
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# Exports the complete hierarchy of experiments, datasets, subdirectories
+# and datafiles which the user has access to, as a compact index which
+# mytardisfs can memory-map, instead of building the tree one readdir at
+# a time with API queries and "_datasetdatafiles".
+
+# A client process, running as a regular POSIX username (matching a
+# MyTardis username) runs this script, which runs as user "mytardis",
+# via "sudo -u mytardis", thanks to a rule within /etc/sudoers.
+
+# This script can determine the username which the client script is
+# running as, thanks to the SUDO_USER environment variable, so it will
+# only provide access to experiment IDs available to that MyTardis
+# username.  Currently the username is matched using the auth_provider
+# authentication scheme in the MyTardis deployment in mytardis_install_dir
+# (defined in [mytardis_install_dir]/tardis/settings.py)
+
+# Index format (little-endian):
+#   header:  magic ("MTFSIDX1"), entry count, build time
+#   entries: fixed-size records (RECORD), sorted by (parent path, name),
+#            so that lookups and directory listings are binary searches
+#   strings: the entries' paths, e.g. "/12-Exp/34-Dataset/sub/file.dat"
+
+import os
+import sys
+import time
+import mmap
+import struct
+import getpass
+import traceback
+from collections import namedtuple
+
+import bootstrap
+from phases import PhaseTimer
+
+MAGIC = "MTFSIDX1"
+HEADER = struct.Struct("<8sIq")
+# path offset, path length, parent path length, kind, nlink, ID,
+# experiment ID, dataset ID, size, modified, created
+RECORD = struct.Struct("<IHHB3xIQQQQqq")
+
+KIND_EXPERIMENT = 0
+KIND_DATASET = 1
+KIND_DIRECTORY = 2
+KIND_DATAFILE = 3
+
+IndexEntry = namedtuple('IndexEntry',
+                        ['path', 'kind', 'nlink', 'id', 'experiment_id',
+                         'dataset_id', 'size', 'modified', 'created'])
+
+
+def sort_key(path):
+    parent, name = path.rsplit('/', 1)
+    return (parent, name)
+
+
+def build_index(entries, build_time=None):
+    # Returns the index (a string) for a list of IndexEntry tuples.
+    if build_time is None:
+        build_time = int(time.time())
+    entries = sorted(entries, key=lambda entry: sort_key(entry.path))
+    records = []
+    strings = []
+    path_offset = 0
+    for entry in entries:
+        parent_len = len(entry.path.rsplit('/', 1)[0])
+        records.append(RECORD.pack(path_offset, len(entry.path), parent_len,
+                                   entry.kind, entry.nlink, entry.id,
+                                   entry.experiment_id, entry.dataset_id,
+                                   entry.size, entry.modified,
+                                   entry.created))
+        strings.append(entry.path)
+        path_offset = path_offset + len(entry.path)
+    return HEADER.pack(MAGIC, len(entries), build_time) + \
+        "".join(records) + "".join(strings)
+
+
+class NamespaceIndex():
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as index_file:
+            self.mmap = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, self.count, self.build_time = \
+            HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a namespace index." % index_path)
+        self.strings_offset = HEADER.size + self.count * RECORD.size
+
+    def _fields(self, i):
+        return RECORD.unpack_from(self.mmap, HEADER.size + i * RECORD.size)
+
+    def _key(self, i):
+        fields = self._fields(i)
+        start = self.strings_offset + fields[0]
+        path = self.mmap[start:start + fields[1]]
+        return (path[:fields[2]], path[fields[2] + 1:])
+
+    def entry(self, i):
+        fields = self._fields(i)
+        start = self.strings_offset + fields[0]
+        return IndexEntry(self.mmap[start:start + fields[1]], *fields[3:])
+
+    def _lower_bound(self, key):
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, path):
+        # Returns the IndexEntry for path, or None.
+        if path == "/" or '/' not in path:
+            return None
+        key = sort_key(path)
+        i = self._lower_bound(key)
+        if i < self.count and self._key(i) == key:
+            return self.entry(i)
+        return None
+
+    def children(self, path):
+        # Yields the IndexEntry of each entry within directory path.
+        if path == "/":
+            path = ""
+        i = self._lower_bound((path, ""))
+        while i < self.count and self._key(i)[0] == path:
+            yield self.entry(i)
+            i = i + 1
+
+
+def timestamp(datetime_value, default):
+    if datetime_value is None:
+        return default
+    return int(time.mktime(datetime_value.timetuple()))
+
+
+def dir_name(object_id, title):
+    if title is None:
+        title = ""
+    return str(object_id) + "-" + \
+        title.encode('ascii', 'ignore').replace(" ", "_")
+
+
+def run():
+    timer = PhaseTimer()
+
+    if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
+        print "Usage: sudo -u mytardis _namespaceindex " + \
+            "mytardis_install_dir auth_provider"
+        sys.exit(1)
+
+    if len(sys.argv) < 3:
+        print "Usage: sudo -u mytardis _namespaceindex " + \
+            "mytardis_install_dir auth_provider"
+        sys.exit(1)
+
+    _mytardis_install_dir = sys.argv[1].strip('"')
+    _auth_provider = sys.argv[2]
+
+    bootstrap.setup_django(_mytardis_install_dir, timer)
+
+    from tardis.tardis_portal.models import Dataset, Dataset_File, Experiment
+    from tardis.tardis_portal.models import UserAuthentication
+    from django.core.exceptions import ObjectDoesNotExist
+
+    try:
+        userAuth = UserAuthentication.objects \
+            .get(username=os.environ['SUDO_USER'],
+                 authenticationMethod=_auth_provider)
+        mytardis_user = userAuth.userProfile.user
+        staff_or_superuser = mytardis_user.is_staff or \
+            mytardis_user.is_superuser
+
+        exps = Experiment.objects.all()
+        if not staff_or_superuser:
+            exps_owned_and_shared = Experiment.safe \
+                .owned_and_shared(mytardis_user)
+            public_exp_ids = [
+                exp_id for exp_id, public_access in
+                Experiment.objects.values_list('id', 'public_access')
+                if Experiment.public_access_implies_distribution(
+                    public_access)]
+            accessible_exp_ids = \
+                set(exps_owned_and_shared.values_list('id', flat=True)) | \
+                set(public_exp_ids)
+            exps = exps.filter(id__in=accessible_exp_ids)
+
+        now = int(time.time())
+        exp_paths = dict()
+        exp_times = dict()
+        for exp_id, title, created_time in exps \
+                .values_list('id', 'title', 'created_time').iterator():
+            exp_paths[exp_id] = '/' + dir_name(exp_id, title)
+            exp_times[exp_id] = timestamp(created_time, now)
+
+        dataset_paths = dict()
+        for exp_id, dataset_id, description in Dataset.objects \
+                .filter(experiments__id__in=exp_paths.keys()) \
+                .values_list('experiments__id', 'id', 'description') \
+                .iterator():
+            if exp_id not in exp_paths:
+                continue
+            dataset_paths[(exp_id, dataset_id)] = \
+                exp_paths[exp_id] + '/' + dir_name(dataset_id, description)
+
+        entries = []
+        # Latest modification time and number of subdirectories of each
+        # dataset and subdirectory, keyed by path:
+        dir_times = dict()
+        dir_subdirs = dict()
+        dir_ids = dict()
+        for exp_id, dataset_id, datafile_id, directory, filename, size, \
+                created_time, modification_time in Dataset_File.objects \
+                .filter(dataset__experiments__id__in=exp_paths.keys()) \
+                .values_list('dataset__experiments__id', 'dataset__id', 'id',
+                             'directory', 'filename', 'size', 'created_time',
+                             'modification_time').iterator():
+            if (exp_id, dataset_id) not in dataset_paths:
+                continue
+            dataset_path = dataset_paths[(exp_id, dataset_id)]
+            created = timestamp(created_time, exp_times[exp_id])
+            modified = timestamp(modification_time, created)
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = 0
+            parent_path = dataset_path
+            if directory is not None and directory.strip('/') != "":
+                for subdirectory in directory.encode('ascii', 'ignore') \
+                        .strip('/').split('/'):
+                    subdir_path = parent_path + '/' + subdirectory
+                    if subdir_path not in dir_times:
+                        dir_subdirs[parent_path] = \
+                            dir_subdirs.get(parent_path, 0) + 1
+                        dir_ids[subdir_path] = (exp_id, dataset_id)
+                    dir_times[subdir_path] = \
+                        max(dir_times.get(subdir_path, 0), modified)
+                    parent_path = subdir_path
+            dir_times[dataset_path] = \
+                max(dir_times.get(dataset_path, 0), modified)
+            entries.append(IndexEntry(parent_path + '/' +
+                                      filename.encode('ascii', 'ignore'),
+                                      KIND_DATAFILE, 1, datafile_id, exp_id,
+                                      dataset_id, size, modified, created))
+
+        for subdir_path, (exp_id, dataset_id) in dir_ids.iteritems():
+            entries.append(IndexEntry(subdir_path, KIND_DIRECTORY,
+                                      dir_subdirs.get(subdir_path, 0) + 2,
+                                      0, exp_id, dataset_id, 0,
+                                      dir_times[subdir_path],
+                                      dir_times[subdir_path]))
+        exp_datasets = dict()
+        for (exp_id, dataset_id), dataset_path in dataset_paths.iteritems():
+            exp_datasets[exp_id] = exp_datasets.get(exp_id, 0) + 1
+            dataset_time = dir_times.get(dataset_path, exp_times[exp_id])
+            entries.append(IndexEntry(dataset_path, KIND_DATASET,
+                                      dir_subdirs.get(dataset_path, 0) + 2,
+                                      dataset_id, exp_id, dataset_id, 0,
+                                      dataset_time, dataset_time))
+        for exp_id, exp_path in exp_paths.iteritems():
+            entries.append(IndexEntry(exp_path, KIND_EXPERIMENT,
+                                      exp_datasets.get(exp_id, 0) + 2,
+                                      exp_id, exp_id, 0, 0,
+                                      exp_times[exp_id], exp_times[exp_id]))
+
+        sys.stdout.write(build_index(entries, now))
+    except ObjectDoesNotExist:
+        print traceback.format_exc()
+    except:
+        print traceback.format_exc()
+
+    timer.mark("query")
+    timer.report()
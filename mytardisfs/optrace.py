@@ -0,0 +1,124 @@
+# Optional trace of FUSE operations and backend calls for mytardisfs.
+
+# When recording is started (see trace_file in /etc/mytardisfs.cnf),
+# each FUSE operation (getattr, readdir, read etc.) and each backend
+# call (sudo helper, API request, HTTP range read) is written to the
+# trace file as one line of JSON, e.g.
+#   {"k": "fuse", "op": "read", "path": "/12-Exp/34-Dataset/a.dat",
+#    "off": 0, "len": 131072, "th": "Thread-3", "t": 1.25, "d": 0.004,
+#    "r": 131072}
+# where "t" is the start time in seconds since recording started, "d" is
+# the duration in seconds and "r" is the result (a size, or a negative
+# errno).  The first line records the wall-clock start time and process
+# ID.  mytardisfs-replay can replay a trace against a mount.
+
+# Like the metrics module, the trace is module-level state, so any part
+# of mytardisfs can record to it without passing objects around.
+
+import os
+import json
+import time
+import threading
+import types
+import functools
+
+_lock = threading.Lock()
+_trace_file = None
+_start_time = None
+
+
+def start_recording(trace_path):
+    global _trace_file, _start_time
+    with _lock:
+        _start_time = time.time()
+        # Line-buffered, so that the trace survives a crash.
+        _trace_file = open(os.path.expanduser(trace_path), 'a', 1)
+        _trace_file.write(json.dumps(dict(trace_start=_start_time,
+                                          pid=os.getpid())) + "\n")
+        _trace_file.flush()
+
+
+def is_recording():
+    return _trace_file is not None
+
+
+def record(kind, op, start_time, duration, **fields):
+    if _trace_file is None:
+        return
+    fields['k'] = kind
+    fields['op'] = op
+    fields['th'] = threading.current_thread().name
+    fields['t'] = round(start_time - _start_time, 6)
+    fields['d'] = round(duration, 6)
+    line = json.dumps(fields, separators=(',', ':')) + "\n"
+    with _lock:
+        _trace_file.write(line)
+
+
+class span():
+    # Records the enclosed block as one trace entry, e.g.
+    #   with optrace.span("backend", "api", url=url):
+    #       ...
+    def __init__(self, kind, op, **fields):
+        self.kind = kind
+        self.op = op
+        self.fields = fields
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        record(self.kind, self.op, self.start_time,
+               time.time() - self.start_time, **self.fields)
+
+
+def _result(value):
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, str):
+        return len(value)
+    # e.g. a fuse.Stat
+    return 0
+
+
+def traced(op, arg_names):
+    # Decorator for MyFS methods, recording their arguments (named by
+    # arg_names, e.g. ["path", "len", "off"]) and result.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            if _trace_file is None:
+                return method(self, *args)
+            start_time = time.time()
+            fields = dict(zip(arg_names, args))
+            try:
+                result = method(self, *args)
+            except Exception, e:
+                fields['error'] = e.__class__.__name__
+                record("fuse", op, start_time, time.time() - start_time,
+                       **fields)
+                raise
+            if isinstance(result, types.GeneratorType):
+                # e.g. readdir, which is recorded once all of its
+                # entries have been consumed.
+                return _traced_generator(op, start_time, fields, result)
+            fields['r'] = _result(result)
+            record("fuse", op, start_time, time.time() - start_time,
+                   **fields)
+            return result
+        return wrapper
+    return decorator
+
+
+def _traced_generator(op, start_time, fields, generator):
+    count = 0
+    try:
+        for item in generator:
+            count = count + 1
+            yield item
+    finally:
+        fields['r'] = count
+        record("fuse", op, start_time, time.time() - start_time, **fields)
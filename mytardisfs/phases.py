@@ -0,0 +1,73 @@
+# Timing of the phases of backend calls made by mytardisfs, e.g. Django
+# start-up (setup_environ), permission queries and opening files, in the
+# sudo helper scripts.
+
+# mytardisfs gives each backend call a correlation ID, which it passes
+# to the helper in the MYTARDISFS_CORRELATION_ID environment variable
+# (see README.md for the sudoers env_keep rule).  A helper times its
+# phases with a PhaseTimer, and reports them on a line of STDERR, e.g.
+#   mytardisfs-phases id=1f2e-17 setup_environ=0.512000 query=0.031000
+# which mytardisfs parses with parse_phases, and records in its trace
+# and metrics, along with the time spent starting the helper (sudo and
+# Python start-up), which the helper can't measure itself.
+
+import os
+import sys
+import time
+
+CORRELATION_ID_VARIABLE = "MYTARDISFS_CORRELATION_ID"
+PHASES_PREFIX = "mytardisfs-phases "
+
+
+class PhaseTimer():
+    def __init__(self):
+        self.correlation_id = os.environ.get(CORRELATION_ID_VARIABLE, "-")
+        self.last_time = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        # Records the time since the previous mark as phase.
+        now = time.time()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+
+    def format(self):
+        return "id=" + self.correlation_id + "".join(
+            " %s=%.6f" % (phase, seconds) for phase, seconds in self.phases)
+
+    def report(self, stream=None):
+        if stream is None:
+            stream = sys.stderr
+        stream.write(PHASES_PREFIX + self.format() + "\n")
+
+
+def parse_fields(text):
+    # Returns (correlation_id, [(phase, seconds), ...]) from the
+    # output of PhaseTimer.format.
+    correlation_id = None
+    phases = []
+    for field in text.split():
+        if '=' not in field:
+            continue
+        name, value = field.split('=', 1)
+        if name == "id":
+            correlation_id = value
+            continue
+        try:
+            phases.append((name, float(value)))
+        except ValueError:
+            pass
+    return correlation_id, phases
+
+
+def parse_phases(stderr):
+    # Returns (phases, remaining_stderr) for a helper's STDERR, where
+    # phases is a list of (phase, seconds).
+    phases = []
+    lines = []
+    for line in (stderr or "").splitlines(True):
+        if line.startswith(PHASES_PREFIX):
+            phases.extend(parse_fields(line[len(PHASES_PREFIX):])[1])
+        else:
+            lines.append(line)
+    return phases, "".join(lines)
@@ -0,0 +1,157 @@
+# Sequential read-ahead for datafiles streamed through mytardisfs.
+
+# SFTP clients read large files in small chunks (32-256 KiB), and
+# without read-ahead, each chunk waits for a synchronous read from the
+# file store.  A SequentialReader watches the offsets requested for one
+# open datafile, and once the reads look sequential, it reads the next
+# window of the file in a background thread into a bounded buffer, and
+# hints to the kernel (posix_fadvise) that the file is being read
+# sequentially and which range will be needed next.
+
+# The window size adapts to the measured throughput of the background
+# reads, aiming to keep about TARGET_WINDOW_SECONDS of data in flight,
+# between MIN_WINDOW_BYTES and the configured maximum.
+
+import time
+import ctypes
+import ctypes.util
+import threading
+
+import metrics
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+
+SEQUENTIAL_READS_BEFORE_READ_AHEAD = 2
+MIN_WINDOW_BYTES = 256 * 1024
+TARGET_WINDOW_SECONDS = 0.5
+
+_libc = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                    ctypes.c_longlong, ctypes.c_int]
+except (OSError, AttributeError):
+    _libc = None
+
+
+def fadvise(fd, offset, length, advice):
+    # Python 2 doesn't have os.posix_fadvise, so we call libc directly.
+    # The advice is only a hint, so failures are ignored.
+    if _libc is None or fd is None:
+        return
+    _libc.posix_fadvise(fd, offset, length, advice)
+
+
+class SequentialReader():
+    def __init__(self, file_size, max_window_bytes, read_function,
+                 fileno_function=None):
+        # read_function(offset, length) reads from the datafile, and
+        # fileno_function() returns its file descriptor (for fadvise).
+        self.file_size = file_size
+        self.max_window_bytes = max_window_bytes
+        self.window_bytes = min(MIN_WINDOW_BYTES, max_window_bytes)
+        self.read_function = read_function
+        self.fileno_function = fileno_function
+        self.condition = threading.Condition()
+        self.next_offset = None
+        self.sequential_reads = 0
+        self.buffer_offset = 0
+        self.buffer = ""
+        self.in_flight = None
+
+    def read(self, offset, length):
+        with self.condition:
+            if offset == self.next_offset:
+                self.sequential_reads = self.sequential_reads + 1
+                if self.sequential_reads == \
+                        SEQUENTIAL_READS_BEFORE_READ_AHEAD:
+                    fadvise(self._fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+            else:
+                self.sequential_reads = 0
+                self.buffer = ""
+            self.next_offset = offset + length
+
+            # Wait for a background read which covers this request.
+            while self.in_flight is not None and \
+                    self.in_flight[0] <= offset < self.in_flight[1]:
+                metrics.increment("read_ahead.waits")
+                self.condition.wait()
+
+            data = self._from_buffer(offset, length)
+            if data is not None:
+                metrics.increment("read_ahead.hits")
+            if self.sequential_reads >= SEQUENTIAL_READS_BEFORE_READ_AHEAD:
+                self._start_read_ahead()
+
+        if data is None:
+            metrics.increment("read_ahead.misses")
+            data = self.read_function(offset, length)
+        return data
+
+    def _fileno(self):
+        if self.fileno_function is None:
+            return None
+        return self.fileno_function()
+
+    def _from_buffer(self, offset, length):
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if self.buffer_offset <= offset and \
+                (offset + length <= buffer_end or buffer_end ==
+                 self.file_size) and offset < buffer_end:
+            start = offset - self.buffer_offset
+            data = self.buffer[start:start + length]
+            # Discard data which has now been consumed.
+            self.buffer = self.buffer[start + len(data):]
+            self.buffer_offset = offset + len(data)
+            return data
+        return None
+
+    def _start_read_ahead(self):
+        if self.in_flight is not None:
+            return
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if self.buffer == "" or \
+                not self.buffer_offset <= self.next_offset <= buffer_end:
+            self.buffer = ""
+            self.buffer_offset = self.next_offset
+            buffer_end = self.next_offset
+        read_ahead_offset = buffer_end
+        # Keep the buffer within one window of the reader's position.
+        if read_ahead_offset - self.next_offset >= self.window_bytes or \
+                read_ahead_offset >= self.file_size:
+            return
+        read_ahead_length = min(self.window_bytes,
+                                self.file_size - read_ahead_offset)
+        self.in_flight = (read_ahead_offset,
+                          read_ahead_offset + read_ahead_length)
+        fadvise(self._fileno(), read_ahead_offset, read_ahead_length,
+                POSIX_FADV_WILLNEED)
+        thread = threading.Thread(target=self._read_ahead,
+                                  args=[read_ahead_offset,
+                                        read_ahead_length])
+        thread.daemon = True
+        thread.start()
+
+    def _read_ahead(self, read_ahead_offset, read_ahead_length):
+        start_time = time.time()
+        try:
+            data = self.read_function(read_ahead_offset, read_ahead_length)
+        except:
+            data = None
+        elapsed = time.time() - start_time
+        with self.condition:
+            self.in_flight = None
+            if data and self.buffer_offset + len(self.buffer) == \
+                    read_ahead_offset:
+                self.buffer = self.buffer + data
+                metrics.increment("read_ahead.bytes", len(data))
+                if elapsed > 0:
+                    throughput = len(data) / elapsed
+                    self.window_bytes = \
+                        int(min(self.max_window_bytes,
+                                max(MIN_WINDOW_BYTES,
+                                    throughput * TARGET_WINDOW_SECONDS)))
+                    metrics.set_gauge("read_ahead.window_bytes",
+                                      self.window_bytes)
+            self.condition.notify_all()
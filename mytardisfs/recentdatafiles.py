@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Lists the datafiles which were created or modified within a given time
+# range, across all experiments which the user has access to, using one
+# query on Dataset_File's created_time/modification_time (rather than
+# one _datasetdatafiles query per dataset).  This is used to populate
+# mytardisfs's virtual /.recent/ and /.by-date/ directories.
+
+# With "months" instead of a time range, it lists the months (YYYY-MM)
+# in which datafiles accessible to the user were created or modified.
+
+# A client process, running as a regular POSIX username (matching a
+# MyTardis username) runs this script, which runs as user "mytardis",
+# via "sudo -u mytardis", thanks to a rule within /etc/sudoers.
+
+# This script can determine the username which the client script is
+# running as, thanks to the SUDO_USER environment variable, so it will
+# only provide access to experiment IDs available to that MyTardis
+# username.  Currently the username is matched using the auth_provider
+# authentication scheme in the MyTardis deployment in mytardis_install_dir
+# (defined in [mytardis_install_dir]/tardis/settings.py)
+
+import os
+import sys
+import getpass
+import traceback
+from datetime import datetime
+
+import bootstrap
+from phases import PhaseTimer
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def run():
+    timer = PhaseTimer()
+
+    usage = "Usage: sudo -u mytardis _recentdatafiles " + \
+        "mytardis_install_dir auth_provider " + \
+        "(start_time end_time | months)"
+    if getpass.getuser() != "mytardis" or "SUDO_USER" not in os.environ:
+        print usage
+        sys.exit(1)
+
+    if len(sys.argv) < 4 or (sys.argv[3] != "months" and len(sys.argv) < 5):
+        print usage
+        sys.exit(1)
+
+    _mytardis_install_dir = sys.argv[1].strip('"')
+    _auth_provider = sys.argv[2]
+    _list_months = (sys.argv[3] == "months")
+    if not _list_months:
+        _start_time = datetime.strptime(sys.argv[3], TIME_FORMAT)
+        _end_time = datetime.strptime(sys.argv[4], TIME_FORMAT)
+
+    bootstrap.setup_django(_mytardis_install_dir, timer)
+
+    from tardis.tardis_portal.models import Dataset_File, Experiment
+    from tardis.tardis_portal.models import UserAuthentication
+    from django.core.exceptions import ObjectDoesNotExist
+    from django.db.models import Q
+
+    try:
+        userAuth = UserAuthentication.objects \
+            .get(username=os.environ['SUDO_USER'],
+                 authenticationMethod=_auth_provider)
+        mytardis_user = userAuth.userProfile.user
+        staff_or_superuser = mytardis_user.is_staff or \
+            mytardis_user.is_superuser
+
+        dfs = Dataset_File.objects.all()
+        accessible_exp_ids = None
+        if not staff_or_superuser:
+            exps_owned_and_shared = Experiment.safe \
+                .owned_and_shared(mytardis_user)
+            public_exp_ids = [
+                exp_id for exp_id, public_access in
+                Experiment.objects.values_list('id', 'public_access')
+                if Experiment.public_access_implies_distribution(
+                    public_access)]
+            accessible_exp_ids = \
+                set(exps_owned_and_shared.values_list('id', flat=True)) | \
+                set(public_exp_ids)
+            dfs = dfs.filter(dataset__experiments__id__in=accessible_exp_ids)
+
+        if _list_months:
+            # A datafile appears in the month it was created and the
+            # month it was modified (see the time range query below).
+            months = [month.strftime("%Y-%m") for month in
+                      list(dfs.dates('created_time', 'month')) +
+                      list(dfs.dates('modification_time', 'month'))]
+            print str(sorted(set(months)))
+            return
+
+        dfs = dfs.filter(Q(created_time__gte=_start_time,
+                           created_time__lt=_end_time) |
+                         Q(modification_time__gte=_start_time,
+                           modification_time__lt=_end_time))
+        df_list = []
+        for df in dfs.values('id', 'directory', 'filename', 'size',
+                             'created_time', 'modification_time',
+                             'dataset__id', 'dataset__description',
+                             'dataset__experiments__id',
+                             'dataset__experiments__title'):
+            if accessible_exp_ids is not None and \
+                    df['dataset__experiments__id'] not in accessible_exp_ids:
+                continue
+            df_fields = dict(id=df['id'], directory=df['directory'],
+                             created_time=str(df['created_time']),
+                             modification_time=str(df['modification_time']),
+                             filename=df['filename'], size=df['size'],
+                             dataset_id=df['dataset__id'],
+                             dataset_description=df['dataset__description'],
+                             experiment_id=df['dataset__experiments__id'],
+                             experiment_title=df['dataset__experiments__title'])
+            df_list.append(df_fields)
+        print str(df_list)
+    except ObjectDoesNotExist:
+        print traceback.format_exc()
+    except:
+        print traceback.format_exc()
+
+    timer.mark("query")
+    timer.report()
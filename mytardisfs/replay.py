@@ -0,0 +1,183 @@
+# Replays a trace recorded by mytardisfs (see trace_file in
+# /etc/mytardisfs.cnf and optrace.py) against a mounted mytardisfs,
+# e.g. to compare builds or configuration changes on a real workload:
+#
+#   mytardisfs-replay ~/mytardisfs-trace.json ~/MyTardis
+#
+# The FUSE operations in the trace are replayed as the corresponding
+# system calls on the mount (lstat for getattr, listdir for readdir,
+# readlink, and seek/read on an open file for read), with each of the
+# original threads replayed by its own thread, and each operation
+# started at its original time (divided by --speed).  With --no-timing,
+# each thread replays its operations back to back.  Backend calls in
+# the trace aren't replayed, because the mount makes its own.
+#
+# Latencies are reported per operation type, for the recording and for
+# the replay.
+
+import os
+import sys
+import json
+import time
+import errno
+import getopt
+import threading
+
+import metrics
+
+REPLAYED_OPERATIONS = ["getattr", "readdir", "readlink", "read"]
+
+
+def load_trace(trace_path):
+    # Returns the FUSE operations in the trace, grouped by thread, in
+    # order of their start times.
+    operations_by_thread = dict()
+    with open(trace_path, 'r') as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # e.g. a partly written final line.
+                continue
+            if record.get('k') != "fuse":
+                continue
+            operations_by_thread.setdefault(record['th'], []).append(record)
+    for operations in operations_by_thread.values():
+        operations.sort(key=lambda record: record['t'])
+    return operations_by_thread
+
+
+def replay_operation(mount_dir, record, open_files):
+    # Returns the result of replaying one operation, as recorded in the
+    # trace (a size, or a negative errno), or None if it isn't replayed.
+    path = os.path.join(mount_dir, record['path'].encode('utf-8')
+                        .lstrip('/'))
+    op = record['op']
+    try:
+        if op == "getattr":
+            os.lstat(path)
+            return 0
+        if op == "readdir":
+            # Including '.' and '..', as mytardisfs yields them.
+            return len(os.listdir(path)) + 2
+        if op == "readlink":
+            return len(os.readlink(path))
+        if op == "read":
+            if path not in open_files:
+                open_files[path] = open(path, 'rb')
+            open_files[path].seek(record['off'])
+            return len(open_files[path].read(record['len']))
+    except (IOError, OSError), e:
+        return -e.errno
+    return None
+
+
+class ReplayThread(threading.Thread):
+    def __init__(self, mount_dir, operations, start_time, speed, timing,
+                 results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mount_dir = mount_dir
+        self.operations = operations
+        self.start_time = start_time
+        self.speed = speed
+        self.timing = timing
+        self.results = results
+
+    def run(self):
+        open_files = dict()
+        for record in self.operations:
+            if record['op'] not in REPLAYED_OPERATIONS:
+                self.results.append((record, None, None))
+                continue
+            if self.timing:
+                delay = self.start_time + record['t'] / self.speed - \
+                    time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            operation_start_time = time.time()
+            result = replay_operation(self.mount_dir, record, open_files)
+            self.results.append((record, result,
+                                 time.time() - operation_start_time))
+        for file_object in open_files.values():
+            file_object.close()
+
+
+def format_latencies(latencies):
+    latencies = sorted(latencies)
+    if len(latencies) == 0:
+        return "-"
+    return "mean=%.6f p50=%.6f p99=%.6f max=%.6f" % \
+        (sum(latencies) / len(latencies),
+         metrics.percentile(latencies, 0.5),
+         metrics.percentile(latencies, 0.99), latencies[-1])
+
+
+def report(results, elapsed):
+    print "Replayed %d operations in %.3f seconds" % \
+        (len([r for r in results if r[1] is not None]), elapsed)
+    ops = sorted(set(record['op'] for record, _, _ in results))
+    for op in ops:
+        op_results = [r for r in results if r[0]['op'] == op]
+        replayed = [r for r in op_results if r[1] is not None]
+        print ""
+        print "%s: %d recorded, %d replayed" % \
+            (op, len(op_results), len(replayed))
+        if len(replayed) == 0:
+            continue
+        # A different result (e.g. -ENOENT instead of a size) usually
+        # means that the mount's data differs from the recording's.
+        mismatches = len([r for r in replayed if r[0].get('r') != r[1]])
+        print "    recorded: " + \
+            format_latencies([r[0]['d'] for r in replayed])
+        print "    replayed: " + format_latencies([r[2] for r in replayed])
+        if mismatches > 0:
+            print "    %d result(s) differed from the recording" % mismatches
+
+
+def usage():
+    print "Usage: mytardisfs-replay trace_file mount_dir " + \
+        "[--speed=FACTOR] [--no-timing]"
+
+
+def run():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h",
+                                   ["help", "speed=", "no-timing"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    speed = 1.0
+    timing = True
+    for opt, arg in opts:
+        if opt == '-h' or opt == '--help':
+            usage()
+            sys.exit()
+        if opt == '--speed':
+            speed = float(arg)
+        if opt == '--no-timing':
+            timing = False
+    if len(args) != 2:
+        usage()
+        sys.exit(1)
+    trace_path = os.path.expanduser(args[0])
+    mount_dir = os.path.expanduser(args[1])
+    if not os.path.isdir(mount_dir):
+        print mount_dir + " is not a directory."
+        sys.exit(errno.ENOTDIR)
+
+    operations_by_thread = load_trace(trace_path)
+    results = []
+    start_time = time.time()
+    threads = []
+    for operations in operations_by_thread.values():
+        thread = ReplayThread(mount_dir, operations, start_time, speed,
+                              timing, results)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    report(results, time.time() - start_time)
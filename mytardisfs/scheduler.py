@@ -0,0 +1,217 @@
+# Prioritized limits on concurrent backend calls made by mytardisfs.
+
+# Without a limit, a recursive listing or a parallel download can make
+# mytardisfs start any number of sudo helper processes (_datasetdatafiles,
+# _datafiledescriptord etc.) and API requests at once, which competes
+# with the MyTardis web application on the same server.
+
+# A BackendScheduler caps the number of calls running at once within one
+# mytardisfs mount.  Callers waiting for a slot within a mount are served
+# in priority order, so that work a user is waiting for
+# (PRIORITY_INTERACTIVE) goes ahead of background refreshes and
+# prefetching (PRIORITY_BACKGROUND).  Queue depth and wait times are
+# recorded in the metrics module.
+
+# Host-wide limits use a directory of lock files, one per slot (see
+# acquire_host_slot).  The limit on helper processes is taken by the
+# helpers themselves (see bootstrap.py), in a directory which only the
+# mytardis user can access, so users can't change it or hold its slots.
+# A slot is released when its holder exits, so a waiting helper keeps
+# waiting until one is free.  While interactive callers are waiting (each
+# holding a shared lock on [name]-interactive), background callers don't
+# take slots, so helpers are started in priority order across mounts (the
+# priority is passed to helpers in MYTARDISFS_PRIORITY).
+
+# A BackendScheduler can also take a host-wide slot for each call (e.g.
+# for API requests), in the same way, but as mytardisfs runs as the user,
+# that limit is only cooperative.  It doesn't hold its mount slot while
+# waiting for a host-wide slot, and if none is free within
+# host_wait_seconds, the call fails with EAGAIN.
+
+import os
+import time
+import errno
+import heapq
+import fcntl
+import threading
+
+import metrics
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_VARIABLE = "MYTARDISFS_PRIORITY"
+
+# How often to retry when all of the host-wide slots are in use:
+HOST_SLOT_RETRY_SECONDS = 0.02
+# How long a BackendScheduler waits for a host-wide slot:
+HOST_SLOT_WAIT_SECONDS = 5
+
+
+class BackendScheduler():
+    def __init__(self, name, max_concurrent, host_max_concurrent=0,
+                 host_lock_dir=None, host_wait_seconds=HOST_SLOT_WAIT_SECONDS):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.host_max_concurrent = host_max_concurrent
+        self.host_lock_dir = host_lock_dir
+        self.host_wait_seconds = host_wait_seconds
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = []
+        self.sequence = 0
+
+    def slot(self, priority=PRIORITY_INTERACTIVE):
+        return _Slot(self, priority)
+
+    def acquire(self, priority):
+        start_time = time.time()
+        waiting_fd = None
+        try:
+            while True:
+                self.acquire_mount_slot(priority)
+                if self.host_max_concurrent <= 0 or not self.host_lock_dir:
+                    host_slot = None
+                    break
+                host_slot = None
+                if priority == PRIORITY_INTERACTIVE or \
+                        not interactive_callers_waiting(self.host_lock_dir,
+                                                        self.name):
+                    host_slot = acquire_host_slot(self.host_lock_dir,
+                                                  self.name,
+                                                  self.host_max_concurrent)
+                if host_slot is not None:
+                    break
+                # Let other calls in this mount go ahead while waiting.
+                self.release(None)
+                if time.time() - start_time >= self.host_wait_seconds:
+                    metrics.increment(self.name + ".host_slot_timeouts")
+                    raise IOError(errno.EAGAIN,
+                                  "No host-wide %s slot is free" % self.name)
+                if priority == PRIORITY_INTERACTIVE and waiting_fd is None:
+                    waiting_fd = start_waiting(self.host_lock_dir, self.name)
+                time.sleep(HOST_SLOT_RETRY_SECONDS)
+        finally:
+            if waiting_fd is not None:
+                os.close(waiting_fd)
+        wait_seconds = time.time() - start_time
+        metrics.record_time(self.name + ".wait", wait_seconds)
+        if priority == PRIORITY_INTERACTIVE:
+            metrics.record_time(self.name + ".wait.interactive",
+                                wait_seconds)
+        else:
+            metrics.record_time(self.name + ".wait.background",
+                                wait_seconds)
+        return host_slot
+
+    def acquire_mount_slot(self, priority):
+        with self.condition:
+            self.sequence = self.sequence + 1
+            ticket = (priority, self.sequence)
+            heapq.heappush(self.waiting, ticket)
+            metrics.set_gauge(self.name + ".queue_depth", len(self.waiting))
+            while (self.max_concurrent > 0 and
+                   self.active >= self.max_concurrent) or \
+                    self.waiting[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.active = self.active + 1
+            metrics.set_gauge(self.name + ".queue_depth", len(self.waiting))
+            metrics.set_gauge(self.name + ".active", self.active)
+            # Let the next waiter check whether it can go ahead too.
+            self.condition.notify_all()
+
+    def release(self, host_slot):
+        if host_slot is not None:
+            # (Unlocking explicitly, in case a child process inherited
+            # the descriptor.)
+            fcntl.flock(host_slot, fcntl.LOCK_UN)
+            os.close(host_slot)
+        with self.condition:
+            self.active = self.active - 1
+            metrics.set_gauge(self.name + ".active", self.active)
+            self.condition.notify_all()
+
+
+def acquire_host_slot(lock_dir, name, max_concurrent):
+    # Returns a file descriptor holding a lock on one of the slot files
+    # [lock_dir]/[name]-0 ... [name]-[max_concurrent - 1], or None if
+    # they are all in use (or can't be opened).  Closing the descriptor,
+    # or exiting, releases the slot.  lock_dir isn't created here: it is
+    # either created by the helpers with mode 700, or by the administrator.
+    for i in range(max_concurrent):
+        slot_path = os.path.join(lock_dir, "%s-%d" % (name, i))
+        try:
+            slot_fd = os.open(slot_path, os.O_RDONLY | os.O_CREAT, 0444)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(slot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot_fd
+        except IOError:
+            os.close(slot_fd)
+    return None
+
+
+def waiting_lock_path(lock_dir, name):
+    return os.path.join(lock_dir, name + "-interactive")
+
+
+def start_waiting(lock_dir, name):
+    # Marks an interactive caller as waiting for one of name's host-wide
+    # slots, until the returned descriptor is closed.
+    try:
+        waiting_fd = os.open(waiting_lock_path(lock_dir, name),
+                             os.O_RDONLY | os.O_CREAT, 0444)
+    except OSError:
+        return None
+    fcntl.flock(waiting_fd, fcntl.LOCK_SH)
+    return waiting_fd
+
+
+def interactive_callers_waiting(lock_dir, name):
+    try:
+        waiting_fd = os.open(waiting_lock_path(lock_dir, name),
+                             os.O_RDONLY | os.O_CREAT, 0444)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(waiting_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except IOError:
+        return True
+    finally:
+        os.close(waiting_fd)
+
+
+def wait_for_host_slot(lock_dir, name, max_concurrent,
+                       priority=PRIORITY_INTERACTIVE):
+    # Like acquire_host_slot, but waits until a slot is free, behind any
+    # interactive callers if priority is PRIORITY_BACKGROUND.
+    waiting_fd = None
+    try:
+        while True:
+            if priority == PRIORITY_INTERACTIVE or \
+                    not interactive_callers_waiting(lock_dir, name):
+                slot_fd = acquire_host_slot(lock_dir, name, max_concurrent)
+                if slot_fd is not None:
+                    return slot_fd
+            if priority == PRIORITY_INTERACTIVE and waiting_fd is None:
+                waiting_fd = start_waiting(lock_dir, name)
+            time.sleep(HOST_SLOT_RETRY_SECONDS)
+    finally:
+        if waiting_fd is not None:
+            os.close(waiting_fd)
+
+
+class _Slot():
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.host_slot = None
+
+    def __enter__(self):
+        self.host_slot = self.scheduler.acquire(self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.scheduler.release(self.host_slot)
@@ -0,0 +1,122 @@
+# Reference counting of login sessions sharing one mytardisfs mount.
+
+# Each time mytardisftpd is run (e.g. for an SFTP session, or for an
+# rsync over SSH), it registers its parent process (the session) in
+# ~/.mytardisfs/sessions/, and either starts mytardisfs or reuses an
+# existing healthy mount.  mytardisfs periodically removes registrations
+# for sessions which have ended, and unmounts itself after the last
+# session has ended.  A lock file ensures that a new session can't be
+# registered while mytardisfs is deciding whether to unmount, and
+# mytardisftpd holds it until the mytardisfs it starts is ready, so that
+# simultaneous first sessions don't both start mytardisfs.
+
+import os
+import time
+import errno
+import fcntl
+import signal
+
+SESSIONS_DIR = os.path.join(os.path.expanduser('~'), '.mytardisfs',
+                            'sessions')
+SESSIONS_LOCK_FILE = os.path.join(os.path.expanduser('~'), '.mytardisfs',
+                                  'sessions.lock')
+
+# How long a healthy mount can take to respond to a stat:
+MOUNT_CHECK_TIMEOUT_SECONDS = 5
+
+
+class SessionsLock():
+    def __enter__(self):
+        if not os.path.exists(SESSIONS_DIR):
+            os.makedirs(SESSIONS_DIR)
+        self.lock_file = open(SESSIONS_LOCK_FILE, 'a')
+        # Don't let mytardisfs, started while holding the lock, inherit it.
+        fcntl.fcntl(self.lock_file, fcntl.F_SETFD,
+                    fcntl.fcntl(self.lock_file, fcntl.F_GETFD) |
+                    fcntl.FD_CLOEXEC)
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def register_session(pid):
+    if not os.path.exists(SESSIONS_DIR):
+        os.makedirs(SESSIONS_DIR)
+    open(os.path.join(SESSIONS_DIR, str(pid)), 'w').close()
+
+
+def unregister_session(pid):
+    try:
+        os.remove(os.path.join(SESSIONS_DIR, str(pid)))
+    except OSError:
+        pass
+
+
+def process_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def live_session_count():
+    # Removes registrations for sessions which have ended,
+    # and returns the number of sessions still running.
+    count = 0
+    if not os.path.exists(SESSIONS_DIR):
+        return count
+    for session in os.listdir(SESSIONS_DIR):
+        try:
+            pid = int(session)
+        except ValueError:
+            continue
+        if process_is_running(pid):
+            count = count + 1
+        else:
+            try:
+                os.remove(os.path.join(SESSIONS_DIR, session))
+            except OSError:
+                pass
+    return count
+
+
+def fuse_mount_type(mount_dir):
+    # Reads /proc/mounts, rather than running "stat -f", to avoid
+    # forking a process.  Returns None if mount_dir is not mounted.
+    mount_dir = os.path.realpath(mount_dir)
+    with open('/proc/mounts', 'r') as mounts:
+        for line in mounts:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            if fields[1].replace('\\040', ' ') == mount_dir:
+                return fields[2]
+    return None
+
+
+def mount_is_healthy(mount_dir,
+                     timeout_seconds=MOUNT_CHECK_TIMEOUT_SECONDS):
+    # A FUSE mount whose process has died gives ENOTCONN, and one whose
+    # process is hung never responds, so the stat is done in a child
+    # process, which is killed if it takes longer than timeout_seconds.
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.stat(mount_dir)
+            os._exit(0)
+        except:
+            os._exit(1)
+    deadline = time.time() + timeout_seconds
+    while True:
+        finished_pid, status = os.waitpid(pid, os.WNOHANG)
+        if finished_pid == pid:
+            return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        if time.time() >= deadline:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            return False
+        time.sleep(0.01)
@@ -0,0 +1,56 @@
+# Deduplication of identical backend calls which are in flight at the
+# same time.
+
+# When several FUSE threads need the same thing at once (e.g. a GUI
+# client listing a dataset from several threads after its cached listing
+# has expired, or several threads reading the first chunk of the same
+# datafile), only the first caller does the backend work.  The others
+# wait for it to finish and share its result (or its exception), so the
+# number of backend calls doesn't grow with client-side parallelism.
+
+import sys
+import threading
+
+import metrics
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight():
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            metrics.increment(self.name + ".shared")
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        metrics.increment(self.name + ".calls")
+        try:
+            call.result = function(*args)
+        except:
+            call.exc_info = sys.exc_info()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
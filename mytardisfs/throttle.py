@@ -0,0 +1,177 @@
+# Bandwidth and IOPS budgets for datafile reads, shared fairly between
+# the users on a host.
+
+# SFTP users share the MyTardis server's storage with the web
+# application, so one user's bulk transfer shouldn't be able to use all
+# of it.  IoThrottle is a token bucket for bytes and for reads, which
+# refills at this mount's budget (bytes_per_second, iops), or at an
+# equal share of the host-wide budget between the users who are
+# currently reading, whichever is lower.
+
+# The host-wide budget and the number of active users come from
+# host_activity, a function (in mytardisfs, the _ioactivity sudo helper)
+# which records that this user is reading and returns a dictionary like
+#   {'active_users': 3, 'host_io_throttle_mb_per_s': 300,
+#    'host_io_throttle_iops': 0}
+# or None if it fails.  It is called in the background every
+# REFRESH_SECONDS while reading.  As each mount throttles its own reads,
+# the budgets are cooperative: a user can change or disable their own
+# mount's budget, but can't shrink other users' shares.
+
+# Each read takes its bytes from the bucket, which may go negative, and
+# bulk reads wait until the bucket has refilled.  Bulk reads are queued
+# with tickets, and served one at a time in the order they arrived, so
+# no reader can overtake the others.  Interactive reads (e.g. the start
+# of a file, or a small file) also take their bytes, but don't wait or
+# queue, so they go ahead of bulk transfers, which slow down to make
+# room for them.  They are only exempt while they stay within their own
+# allowance (interactive_bytes_per_second, with up to a second's worth
+# saved up), so reading the start of many files can't get around the
+# budget; beyond it, they are treated as bulk reads.  A budget of 0
+# means no limit.
+
+import time
+import threading
+
+import metrics
+
+# Users who have read within this many seconds share the host budget:
+ACTIVE_SECONDS = 30
+# How often to touch this user's file and count the active users:
+REFRESH_SECONDS = 5
+# How many seconds of budget can be saved up while idle:
+BURST_SECONDS = 1.0
+
+
+class IoThrottle():
+    def __init__(self, bytes_per_second=0, iops=0, host_activity=None,
+                 interactive_bytes_per_second=0):
+        self.bytes_per_second = bytes_per_second
+        self.iops = iops
+        self.host_activity = host_activity
+        self.host_bytes_per_second = 0
+        self.host_iops = 0
+        self.active_users = 1
+        self.interactive_bytes_per_second = interactive_bytes_per_second
+        self.interactive_tokens = float(interactive_bytes_per_second)
+        self.lock = threading.Lock()
+        # Bulk reads wait for their ticket to be served:
+        self.queue = threading.Condition(threading.Lock())
+        self.next_ticket = 0
+        self.now_serving = 0
+        self.byte_rate = bytes_per_second
+        self.read_rate = iops
+        self.byte_tokens = 0.0
+        self.read_tokens = 0.0
+        self.last_time = time.time()
+        self.last_refresh_time = 0
+
+    def enabled(self):
+        return self.bytes_per_second > 0 or self.iops > 0 or \
+            self.host_activity is not None
+
+    def throttle(self, num_bytes, interactive=False):
+        # Waits until num_bytes can be read, and returns how long that
+        # took.
+        if not self.enabled():
+            return 0
+        now = time.time()
+        refresh = False
+        with self.lock:
+            if now - self.last_refresh_time > REFRESH_SECONDS:
+                self.last_refresh_time = now
+                refresh = True
+        if refresh:
+            refresh_thread = threading.Thread(target=self.refresh_rates)
+            refresh_thread.daemon = True
+            refresh_thread.start()
+        metrics.increment("io_throttle.bytes", num_bytes)
+        metrics.increment("io_throttle.reads")
+        with self.lock:
+            self.refill(now)
+            if interactive and self.interactive_tokens >= num_bytes:
+                self.interactive_tokens = \
+                    self.interactive_tokens - num_bytes
+                self.byte_tokens = self.byte_tokens - num_bytes
+                self.read_tokens = self.read_tokens - 1
+                metrics.increment("io_throttle.interactive_reads")
+                return 0
+
+        with self.queue:
+            ticket = self.next_ticket
+            self.next_ticket = self.next_ticket + 1
+            while self.now_serving != ticket:
+                self.queue.wait()
+        try:
+            with self.lock:
+                self.refill(time.time())
+                self.byte_tokens = self.byte_tokens - num_bytes
+                self.read_tokens = self.read_tokens - 1
+                delay = 0
+                if self.byte_rate > 0 and self.byte_tokens < 0:
+                    delay = max(delay, -self.byte_tokens / self.byte_rate)
+                if self.read_rate > 0 and self.read_tokens < 0:
+                    delay = max(delay, -self.read_tokens / self.read_rate)
+            if delay > 0:
+                metrics.increment("io_throttle.delayed_reads")
+                metrics.record_time("io_throttle.delay", delay)
+                time.sleep(delay)
+        finally:
+            with self.queue:
+                self.now_serving = self.now_serving + 1
+                self.queue.notify_all()
+        return delay
+
+    def refill(self, now):
+        if now <= self.last_time:
+            return
+        elapsed = now - self.last_time
+        self.last_time = now
+        self.interactive_tokens = min(self.interactive_tokens +
+                                      elapsed *
+                                      self.interactive_bytes_per_second,
+                                      self.interactive_bytes_per_second *
+                                      BURST_SECONDS)
+        if self.byte_rate > 0:
+            self.byte_tokens = min(self.byte_tokens +
+                                   elapsed * self.byte_rate,
+                                   self.byte_rate * BURST_SECONDS)
+        if self.read_rate > 0:
+            self.read_tokens = min(self.read_tokens +
+                                   elapsed * self.read_rate,
+                                   self.read_rate * BURST_SECONDS)
+
+    def refresh_rates(self):
+        # Marks this user as active, and recalculates this mount's share
+        # of the host-wide budget.
+        if self.host_activity is not None:
+            report = self.host_activity()
+            if report is not None:
+                self.active_users = max(1, report['active_users'])
+                self.host_bytes_per_second = \
+                    report['host_io_throttle_mb_per_s'] * 1024 * 1024
+                self.host_iops = report['host_io_throttle_iops']
+        byte_rate = fair_share(self.bytes_per_second,
+                               self.host_bytes_per_second, self.active_users)
+        read_rate = fair_share(self.iops, self.host_iops, self.active_users)
+        with self.lock:
+            self.refill(time.time())
+            self.byte_rate = byte_rate
+            self.read_rate = read_rate
+        metrics.set_gauge("io_throttle.active_users", self.active_users)
+        metrics.set_gauge("io_throttle.mb_per_s_budget",
+                          round(byte_rate / 1024.0 / 1024.0, 3))
+        metrics.set_gauge("io_throttle.iops_budget", round(read_rate, 1))
+
+
+def fair_share(mount_budget, host_budget, active_users):
+    # The lower of the mount's budget and its share of the host's
+    # budget, where 0 means no limit.
+    budgets = []
+    if mount_budget > 0:
+        budgets.append(float(mount_budget))
+    if host_budget > 0:
+        budgets.append(float(host_budget) / active_users)
+    if len(budgets) == 0:
+        return 0
+    return min(budgets)
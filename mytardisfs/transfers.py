@@ -0,0 +1,89 @@
+# Per-datafile transfer records for mytardisfs.
+
+# Each datafile read through mytardisfs counts as a transfer, from its
+# first read until it has been idle for idle_seconds (like the file
+# objects which are closed after 30 seconds without a read).  When a
+# transfer finishes, a record like
+#   {"datafile_id": 123, "path": "/12-Exp/34-Dataset/a.dat",
+#    "user": "jsmith", "bytes": 1048576, "seconds": 2.5, "mb_per_s": 0.4}
+# is written as one line of JSON to the transfer log (if any), and
+# counted in the metrics module.
+
+# Reads only update a dictionary, and finished transfers are found and
+# written by a background thread, so FUSE threads never wait for the
+# transfer log.
+
+import os
+import json
+import time
+import threading
+
+import metrics
+
+CHECK_INTERVAL_SECONDS = 5
+
+_lock = threading.Lock()
+# ACTIVE_TRANSFERS[datafile_id] = [path, first_read_time, last_read_time,
+#                                  bytes]
+ACTIVE_TRANSFERS = dict()
+_user = None
+_log_path = None
+_idle_seconds = 30
+
+
+def start(user, log_path, idle_seconds):
+    global _user, _log_path, _idle_seconds
+    _user = user
+    if log_path != "":
+        _log_path = os.path.expanduser(log_path)
+    _idle_seconds = idle_seconds
+    thread = threading.Thread(target=_finish_idle_transfers)
+    thread.daemon = True
+    thread.start()
+
+
+def record_read(datafile_id, path, num_bytes):
+    now = time.time()
+    with _lock:
+        transfer = ACTIVE_TRANSFERS.get(datafile_id)
+        if transfer is None:
+            ACTIVE_TRANSFERS[datafile_id] = [path, now, now, num_bytes]
+            metrics.add_to_gauge("transfers.active", 1)
+        else:
+            transfer[2] = now
+            transfer[3] += num_bytes
+
+
+def _finish_idle_transfers():
+    while True:
+        time.sleep(CHECK_INTERVAL_SECONDS)
+        finished = []
+        now = time.time()
+        with _lock:
+            for datafile_id, transfer in ACTIVE_TRANSFERS.items():
+                if now - transfer[2] > _idle_seconds:
+                    finished.append((datafile_id, transfer))
+                    del ACTIVE_TRANSFERS[datafile_id]
+        for datafile_id, transfer in finished:
+            _finish(datafile_id, *transfer)
+
+
+def _finish(datafile_id, path, first_read_time, last_read_time, num_bytes):
+    seconds = last_read_time - first_read_time
+    mb_per_s = 0.0
+    if seconds > 0:
+        mb_per_s = num_bytes / seconds / 1024 / 1024
+    metrics.add_to_gauge("transfers.active", -1)
+    metrics.increment("transfers.completed")
+    metrics.increment("transfers.bytes", num_bytes)
+    metrics.record_time("transfers.duration", seconds)
+    if _log_path is None:
+        return
+    record = dict(datafile_id=datafile_id, path=path, user=_user,
+                  bytes=num_bytes, start_time=round(first_read_time, 3),
+                  seconds=round(seconds, 3), mb_per_s=round(mb_per_s, 3))
+    try:
+        with open(_log_path, 'a') as log_file:
+            log_file.write(json.dumps(record) + "\n")
+    except (IOError, OSError):
+        metrics.increment("transfers.log_errors")
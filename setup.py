@@ -18,9 +18,17 @@ setup(name='mytardisfs',
               "_myapikey = mytardisfs.myapikey:run",
               "_datasetdatafiles = mytardisfs.datasetdatafiles:run",
               "_countexpdatasets = mytardisfs.countexpdatasets:run",
+              "_recentdatafiles = mytardisfs.recentdatafiles:run",
+              "_expdatasetsizes = mytardisfs.expdatasetsizes:run",
+              "_namespaceindex = mytardisfs.namespaceindex:run",
+              "_ioactivity = mytardisfs.ioactivity:run",
               "_datafiledescriptord = mytardisfs.datafiledescriptord:run",
               "mytardisfs = mytardisfs.mytardisfs:run",
               "mytardisftpd = mytardisfs.mytardisftpd:run",
+              "mytardisfs-replay = mytardisfs.replay:run",
+              "mytardisfs-loadtest = mytardisfs.loadtest:run",
+              "mytardisfs-fake-server = mytardisfs.fakemytardis:run",
+              "mytardisfs-invalidate = mytardisfs.invalidation:run",
           ],
       },
       #install_requires=['fuse-python==0.2.1', 'python-dateutil', 'requests',